@@ -0,0 +1,8 @@
+"""Contains the benchmark suite, and its generated test media corpus."""
+
+import os
+
+# The h265_transcoder modules read these variables on import
+for env_name, env_default in (("DEBUG", "False"), ("DELETE", "False"), ("TRANSCODE", "True"),
+                              ("PERSIST", "False"), ("RETRY_FAILED", "False")):
+    os.environ.setdefault(env_name, env_default)
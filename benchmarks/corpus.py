@@ -0,0 +1,130 @@
+"""Contains the generated test media corpus for the benchmarks.
+
+All of the media is generated offline with the ffmpeg 'lavfi' sources,
+so every run of a profile benchmarks the same files.
+"""
+
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from ffmpeg import FFmpeg
+
+logger = logging.getLogger("benchmarks")
+
+# Name: (resolutions, durations in seconds, hard links of each file for the scan)
+PROFILES = {
+    "quick": (("320x240",), (2,), 500),
+    "full": (("320x240", "1280x720", "1920x1080"), (2, 10), 5000)
+}
+# Name: (container, video codec, ffmpeg video options)
+VARIANTS = {
+    "h264_mp4": ("mp4", "libx264", {"preset": "ultrafast"}),
+    "h264_mkv": ("matroska", "libx264", {"preset": "ultrafast"}),
+    "hevc_hvc1_mp4": ("mp4", "libx265", {"preset": "ultrafast", "vtag": "hvc1"}),
+    "hevc_hev1_mp4": ("mp4", "libx265", {"preset": "ultrafast", "vtag": "hev1"}),
+    "hevc_mkv": ("matroska", "libx265", {"preset": "ultrafast"})
+}
+
+
+def generate_corpus(corpus_dir: Path, profile: str) -> dict:
+    """Generate the test media of a profile, unless it was already generated.
+
+    The corpus has a 'media' directory with a video file for each variant,
+    resolution, and duration, an 'invalid' directory with a truncated and
+    a non-video file, and a 'scan' directory with hard links of the media.
+
+    Args:
+        corpus_dir (Path): directory for the corpus.
+        profile (str): name of the corpus profile.
+
+    Returns:
+        Dictionary of the corpus manifest.
+    """
+    resolutions, durations, scan_links = PROFILES[profile]
+    # The same form as the JSON manifest, which has lists in place of the tuples
+    settings = [list(resolutions), list(durations), scan_links]
+    manifest_file = corpus_dir / "manifest.json"
+    if manifest_file.exists():
+        manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+        if manifest.get("profile") == profile and manifest.get("settings") == settings:
+            return manifest
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    media_dir = corpus_dir / "media"
+    invalid_dir = corpus_dir / "invalid"
+    scan_dir = corpus_dir / "scan"
+    for directory in (media_dir, invalid_dir, scan_dir):
+        directory.mkdir(parents=True)
+
+    media_files = []
+    for variant, (container, codec, video_options) in VARIANTS.items():
+        extension = "mkv" if container == "matroska" else "mp4"
+        for resolution in resolutions:
+            for duration in durations:
+                media_file = media_dir / f"{variant}_{resolution}_{duration}s.{extension}"
+                generate_media(media_file, container, codec, video_options, resolution, duration)
+                media_files.append(media_file.name)
+    generate_invalid(invalid_dir, media_dir / media_files[0])
+
+    for link_index in range(scan_links):
+        link_dir = scan_dir / f"{link_index // 100:03d}"
+        link_dir.mkdir(exist_ok=True)
+        media_file = media_files[link_index % len(media_files)]
+        os.link(media_dir / media_file, link_dir / f"{link_index:05d}_{media_file}")
+
+    manifest = {
+        "profile": profile,
+        "settings": settings,
+        "media": media_files,
+        "invalid": sorted(invalid_file.name for invalid_file in invalid_dir.iterdir()),
+        "scan_files": scan_links
+    }
+    manifest_file.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def generate_invalid(invalid_dir: Path, media_file: Path) -> None:
+    """Generate a truncated MP4 file, and a text file with a video extension.
+
+    Args:
+        invalid_dir (Path): directory for the invalid files.
+        media_file (Path): valid MP4 file to truncate.
+    """
+    with media_file.open(mode="rb") as media:
+        (invalid_dir / "truncated.mp4").write_bytes(media.read(1024))
+    (invalid_dir / "not_video.mkv").write_text("This is not a video file.\n", encoding="utf-8")
+
+
+def generate_media(media_file: Path, container: str, codec: str, video_options: dict,
+                   resolution: str, duration: int) -> None:
+    """Generate a video file with the 'testsrc2' video, and a 'sine' audio track.
+
+    Args:
+        media_file (Path): video file to generate.
+        container (str): ffmpeg output format.
+        codec (str): ffmpeg video encoder.
+        video_options (dict): ffmpeg options for the video encoder.
+        resolution (str): video resolution, as 'WIDTHxHEIGHT'.
+        duration (int): duration in seconds.
+    """
+    generate_msg = f"Generating '{media_file.name}'."
+    logger.info(generate_msg)
+    ffmpeg = (
+        FFmpeg()
+        .option("y")
+        .input(f"testsrc2=size={resolution}:rate=25:duration={duration}", {"f": "lavfi"})
+        .input(f"sine=frequency=440:duration={duration}", {"f": "lavfi"})
+        .output(
+            str(media_file),
+            {
+                "codec:v": codec,
+                "codec:a": "aac",
+                "pix_fmt": "yuv420p",
+                "f": container,
+                **video_options
+            }
+        )
+    )
+    ffmpeg.execute()
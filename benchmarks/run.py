@@ -0,0 +1,280 @@
+"""Contains the benchmark runner, and the comparison against a baseline.
+
+Usage:
+    python -m benchmarks.run [--profile quick|full] [--corpus DIR]
+                             [--output results.json] [--baseline baseline.json]
+                             [--tolerance 0.2] [--repeat 3] [--rows 20000]
+
+The results are written as JSON. With a baseline, every metric which is
+worse than the baseline by more than the tolerance is reported as a
+regression, and the runner exits with status 1.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.corpus import generate_corpus
+# log adds the TRANSCODE level for the progress messages
+from h265_transcoder import config, log, tasks
+from h265_transcoder.interfaces import DatabaseInterface, ExifToolInterface
+
+logger = logging.getLogger("benchmarks")
+# Name: True if a higher value is better
+METRICS = {
+    "scan.files_per_second": True,
+    "rescan.files_per_second": True,
+    "read_metadata.p50_ms": False,
+    "read_metadata.p95_ms": False,
+    "insert_scan_results.rows_per_second": True,
+    "update_status.writes_per_second": True,
+    "transcode.fps": True,
+    "remux.seconds": False
+}
+
+
+def benchmark_database(work_dir: Path, row_count: int) -> dict:
+    """Benchmark the bulk upsert of scan results, and the queued status writes.
+
+    Args:
+        work_dir (Path): directory for the SQLite database.
+        row_count (int): amount of rows to write.
+
+    Returns:
+        Dictionary of the results.
+    """
+    sqlite_db = str(work_dir / "database.db")
+    tasks.setup_database(sqlite_db)
+    insert_list = [
+        [f"/bench/{row // 1000:04d}", f"video_{row:07d}.mkv", "Y", "queued",
+         1800.0, 1920, 1080, 1000000000 + row, row, row, 4444444, 1]
+        for row in range(row_count)
+    ]
+    start_time = time.perf_counter()
+    tasks.insert_scan_results(sqlite_db, insert_list)
+    insert_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for path, filename, *_result in insert_list:
+        tasks.update_status(sqlite_db, path, filename, "done")
+    DatabaseInterface(sqlite_db).flush()
+    update_seconds = time.perf_counter() - start_time
+    return {
+        "insert_scan_results.rows_per_second": row_count / insert_seconds,
+        "update_status.writes_per_second": row_count / update_seconds
+    }
+
+
+def benchmark_read_metadata(corpus_dir: Path, manifest: dict, with_exiftool: bool) -> dict:
+    """Benchmark the metadata latency of each video file of the corpus.
+
+    Args:
+        corpus_dir (Path): directory of the corpus.
+        manifest (dict): corpus manifest.
+        with_exiftool (bool): include the invalid files, which are read by exiftool.
+
+    Returns:
+        Dictionary of the results.
+    """
+    video_list = [(str(corpus_dir / "media"), media_file) for media_file in manifest["media"]]
+    if with_exiftool:
+        video_list.extend((str(corpus_dir / "invalid"), invalid_file) for invalid_file in manifest["invalid"])
+    latencies = []
+    with ExifToolInterface() as exiftool:
+        for video_file in video_list:
+            start_time = time.perf_counter()
+            tasks.read_metadata(exiftool, [video_file])
+            latencies.append((time.perf_counter() - start_time) * 1000)
+    latencies.sort()
+    return {
+        "read_metadata.p50_ms": statistics.median(latencies),
+        "read_metadata.p95_ms": latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    }
+
+
+def benchmark_scan(corpus_dir: Path, work_dir: Path, manifest: dict) -> dict:
+    """Benchmark a full scan, and an incremental rescan, of the corpus.
+
+    Args:
+        corpus_dir (Path): directory of the corpus.
+        work_dir (Path): directory for the SQLite database.
+        manifest (dict): corpus manifest.
+
+    Returns:
+        Dictionary of the results.
+    """
+    sqlite_db = str(work_dir / "scan.db")
+    tasks.setup_database(sqlite_db)
+    config.scan_path = str(corpus_dir / "scan")
+    results = {}
+    for scan_name in ("scan", "rescan"):
+        start_time = time.perf_counter()
+        tasks.scan_directory(sqlite_db)
+        scan_seconds = time.perf_counter() - start_time
+        results[f"{scan_name}.files_per_second"] = manifest["scan_files"] / scan_seconds
+    return results
+
+
+def benchmark_transcode(corpus_dir: Path, work_dir: Path, manifest: dict) -> dict:
+    """Benchmark the encoding of the H.264 MP4 files, and a remux of an HEVC MKV file.
+
+    The video files are copied to the working directory first,
+    so the corpus is not changed.
+
+    Args:
+        corpus_dir (Path): directory of the corpus.
+        work_dir (Path): directory for the SQLite database and the copies.
+        manifest (dict): corpus manifest.
+
+    Returns:
+        Dictionary of the results.
+    """
+    sqlite_db = str(work_dir / "transcode.db")
+    tasks.setup_database(sqlite_db)
+    transcode_dir = work_dir / "transcode"
+    transcode_dir.mkdir()
+    encode_seconds = 0.0
+    for media_file in manifest["media"]:
+        if not media_file.startswith("h264_mp4"):
+            continue
+        shutil.copy(corpus_dir / "media" / media_file, transcode_dir / media_file)
+        start_time = time.perf_counter()
+        tasks.Transcode(sqlite_db, str(transcode_dir), media_file).transcode()
+        encode_seconds += time.perf_counter() - start_time
+    DatabaseInterface(sqlite_db).flush()
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        frames = db_cursor.execute("SELECT SUM(frames) FROM job_stats WHERE transcode = 'Y' ;").fetchone()[0]
+
+    remux_file = next(media_file for media_file in manifest["media"] if media_file.startswith("hevc_mkv"))
+    shutil.copy(corpus_dir / "media" / remux_file, transcode_dir / remux_file)
+    start_time = time.perf_counter()
+    tasks.Transcode(sqlite_db, str(transcode_dir), remux_file, remux=True).transcode()
+    remux_seconds = time.perf_counter() - start_time
+    return {
+        "transcode.fps": (frames or 0) / encode_seconds,
+        "remux.seconds": remux_seconds
+    }
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare the results against a baseline.
+
+    Args:
+        results (dict): results of this run.
+        baseline (dict): results of the baseline run.
+        tolerance (float): allowed relative change, such as 0.1 for 10%.
+
+    Returns:
+        List of the metric names which regressed.
+    """
+    regressions = []
+    for metric_name, higher_is_better in METRICS.items():
+        value = results["results"].get(metric_name)
+        baseline_value = baseline["results"].get(metric_name)
+        if value is None or not baseline_value:
+            continue
+        change = (value - baseline_value) / baseline_value
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        compare_msg = (f"{metric_name:40} {baseline_value:12.2f} -> {value:12.2f} "
+                       f"({change:+.1%}){' REGRESSION' if regressed else ''}")
+        logger.info(compare_msg)
+        if regressed:
+            regressions.append(metric_name)
+    return regressions
+
+
+def get_environment() -> dict:
+    """Get the machine and tool versions, to compare results from the same setup.
+
+    Returns:
+        Dictionary of the environment details.
+    """
+    try:
+        ffmpeg_version = subprocess.run(["ffmpeg", "-version"], capture_output=True,
+                                        encoding="utf-8", check=True).stdout.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        ffmpeg_version = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": len(os.sched_getaffinity(0)),
+        "ffmpeg": ffmpeg_version,
+        "exiftool": shutil.which(config.exiftool_path) is not None
+    }
+
+
+def main() -> int:
+    """Run the benchmarks, and compare them against the baseline.
+
+    Returns:
+        Exit status. 1 when a metric regressed.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the h.265 transcoding tool.")
+    parser.add_argument("--profile", choices=("quick", "full"), default="quick")
+    parser.add_argument("--corpus", type=Path, default=Path(tempfile.gettempdir()) / "h265-bench-corpus")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    manifest = generate_corpus(args.corpus, args.profile)
+    environment = get_environment()
+    if not environment["exiftool"]:
+        logger.info("exiftool not found. Benchmarking without the invalid files.")
+    # The best of the repeated runs is kept, as the slower runs
+    # measure the noise of the machine instead of the code
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="h265-bench-") as work_name:
+        for attempt in range(args.repeat):
+            work_dir = Path(work_name) / f"attempt_{attempt}"
+            work_dir.mkdir()
+            for benchmark_name, benchmark in (
+                ("scan", lambda: benchmark_scan(args.corpus, work_dir, manifest)),
+                ("read_metadata", lambda: benchmark_read_metadata(args.corpus, manifest,
+                                                                  environment["exiftool"])),
+                ("database", lambda: benchmark_database(work_dir, args.rows)),
+                ("transcode", lambda: benchmark_transcode(args.corpus, work_dir, manifest))
+            ):
+                benchmark_msg = f"Running the '{benchmark_name}' benchmark, attempt {attempt + 1}."
+                logger.info(benchmark_msg)
+                for metric_name, value in benchmark().items():
+                    best = max if METRICS[metric_name] else min
+                    results[metric_name] = best(results.get(metric_name, value), value)
+        DatabaseInterface.close_all()
+
+    output = {
+        "profile": args.profile,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment,
+        "results": results
+    }
+    args.output.write_text(json.dumps(output, indent=2), encoding="utf-8")
+    output_msg = f"Results written to '{args.output}'."
+    logger.info(output_msg)
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        if baseline.get("profile") != args.profile:
+            logger.warning("The baseline was run with a different corpus profile.")
+        if compare_results(output, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,7 @@ import logging
 import os
 from pathlib import Path
 
-from h265_transcoder import config, log, tasks
+from h265_transcoder import budget, config, estimate, lease, log, memory, metrics, segments, simulate, tasks, watch
 
 TRANSCODE = bool(os.environ["TRANSCODE"].lower() == "true")
 PERSIST = bool(os.environ["PERSIST"].lower() == "true")
@@ -12,6 +12,9 @@ RETRY_FAILED = bool(os.environ["RETRY_FAILED"].lower() == "true")
 
 logger = logging.getLogger("app")
 logger.setLevel(log.TRANSCODE)
+metrics.start_exporters()
+if simulate.SIMULATE:
+    simulate.install()
 
 # Setup SQLite database
 sqlite_db = ""
@@ -21,37 +24,70 @@ if PERSIST:
     if queue_count == 0:
         empty_table_msg = f"SQLite DB '{sqlite_db}' is empty. Setting up."
         logger.info(empty_table_msg)
-        tasks.scan_directory(sqlite_db)
     else:
-        queue_msg = f"Found {queue_count} video files in queue."
+        queue_msg = f"Found {queue_count} video files in queue. Rescanning for changes."
         logger.info(queue_msg)
 else:
     sqlite_db = Path(config.temp_dir.name) / config.temp_db
     temp_db_msg = f"Setting up temporary SQLite database at '{sqlite_db}'"
     logger.debug(temp_db_msg)
     tasks.setup_database(sqlite_db)
-    tasks.scan_directory(sqlite_db)
+
+# Scan in the background, so transcoding starts with the first video files found
+if watch.WATCH and TRANSCODE and not estimate.DRY_RUN:
+    # The watch keeps queueing new video files, so transcoding never finishes
+    scan_thread = watch.WatchThread(sqlite_db)
+else:
+    if watch.WATCH:
+        logger.warning("WATCH needs TRANSCODE without DRY_RUN. Scanning once.")
+    scan_thread = tasks.ScanThread(sqlite_db)
+scan_thread.start()
+
+# The time budget starts with the first transcoding, and covers the retries
+time_budget = None
+memory_budget = None
+if TRANSCODE and not estimate.DRY_RUN:
+    time_budget = budget.get_time_budget(sqlite_db)
+    memory_budget = memory.get_memory_budget(sqlite_db)
+    # Video files left active by a crash of this worker, or of workers whose lease expired
+    lease.reclaim_leases(sqlite_db, own=True)
+    segments.prune_segments()
 
 # Transcode the failed video files in queue
-if PERSIST and RETRY_FAILED:
+if PERSIST and RETRY_FAILED and not estimate.DRY_RUN:
     logger.info("Retrying failed video files.")
     retry_transcoding = tasks.retry_failed(sqlite_db)
     if retry_transcoding:
-        tasks.transcode_queue(sqlite_db, retry_transcoding)
+        tasks.transcode_queue(sqlite_db, retry_transcoding, time_budget, memory_budget)
 
-# Transcode the video file or only update the metadata
-if TRANSCODE:
-    transcode_list = tasks.get_batch(sqlite_db)
-    if transcode_list:
-        tasks.transcode_queue(sqlite_db, transcode_list)
+# Transcode the video file, only predict the transcoding, or only update the metadata
+if estimate.DRY_RUN:
+    scan_thread.wait()
+    estimate.estimate_queue(sqlite_db)
+    estimate.log_report(sqlite_db)
+elif TRANSCODE:
+    batch_limit = tasks.get_batch_limit()
+    if watch.WATCH and batch_limit:
+        logger.warning("BATCH is ignored in watch mode.")
+        batch_limit = None
+    transcoded_count = tasks.transcode_stream(sqlite_db, scan_thread, batch_limit, tasks.get_batch_order(),
+                                              time_budget, memory_budget)
+    if watch.WATCH:
+        # The transcoding only ends in watch mode when the time budget is over
+        scan_thread.stop()
+    scan_thread.wait()
+    if transcoded_count:
         if RETRY_FAILED:
             retry_transcoding = tasks.retry_failed(sqlite_db)
             if retry_transcoding:
-                tasks.transcode_queue(sqlite_db, retry_transcoding)
+                tasks.transcode_queue(sqlite_db, retry_transcoding, time_budget, memory_budget)
     else:
         logger.warning("No video files to transcode. Exiting.")
 else:
+    scan_thread.wait()
     tasks.update_metadata(sqlite_db)
 
 # Output the status count
 tasks.final_results(sqlite_db)
+if simulate.SIMULATE:
+    simulate.log_usage()
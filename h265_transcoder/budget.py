@@ -0,0 +1,236 @@
+"""Contains the time-budget selection of the x265 presets from the throughput history."""
+
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+from h265_transcoder import config, estimate, governor, lease, workers
+from h265_transcoder.interfaces import DatabaseInterface
+
+logger = logging.getLogger("app")
+TIME_BUDGET = os.getenv("TIME_BUDGET", "0")
+
+
+class TimeBudget:
+    """Pick the x265 preset of each job, to finish the queue before a deadline.
+
+    The remaining work is the media pixel-seconds of the queued and active
+    video files, and the throughput of each preset is the pixel-seconds
+    per wall second of its jobs in the 'job_stats' table. Active jobs update
+    the table every PROGRESS_INTERVAL, so each selection uses the real
+    throughput of the run so far. Presets without any history are scaled
+    from the nearest measured preset, by their relative speed in the config.
+    The queue is shared with the jobs of the other hosts, and this host runs
+    only THROTTLE_WORKERS jobs during the quiet hours of the governor.
+    """
+    def __init__(self, sqlite_db: str, budget_seconds: float) -> None:
+        """Setup the deadline of the time budget.
+
+        Args:
+            sqlite_db (str): SQLite database file to use.
+            budget_seconds (float): length of the time budget in seconds, from now.
+        """
+        self.sqlite_db = sqlite_db
+        self.deadline = time.monotonic() + budget_seconds
+        self.workers = workers.get_workers()
+        self.over = False
+        budget_msg = f"Time budget of {budget_seconds / 3600:.2f} hours for the queue."
+        logger.info(budget_msg)
+
+    def get_preset_rates(self) -> dict:
+        """Get the measured throughput of each x265 preset.
+
+        Jobs without a preset used the x265 default preset.
+
+        Returns:
+            Dictionary of each measured preset to its media pixel-seconds per wall second, per job.
+        """
+        rate_query = f"""SELECT COALESCE(job_stats.preset, '{config.x265_default_preset}'),
+                            SUM(job_stats.avg_speed * job_stats.wall_time * queue.width * queue.height),
+                            SUM(job_stats.wall_time)
+                            FROM job_stats
+                            JOIN queue USING (path, filename)
+                            WHERE job_stats.transcode = 'Y' AND
+                            job_stats.status IN ('active', 'done') AND
+                            job_stats.avg_speed > 0 AND
+                            job_stats.wall_time >= {config.time_budget_min_wall_time} AND
+                            queue.width > 0 AND
+                            queue.height > 0
+                            GROUP BY 1 ;
+        """
+        rate_data = []
+        with DatabaseInterface(self.sqlite_db) as (_connect, db_cursor):
+            try:
+                rate_data = db_cursor.execute(rate_query).fetchall()
+            except sqlite3.Error:
+                logger.error("SQLite preset history query failed.")
+                logger.exception(sqlite3.Error)
+            else:
+                db_cursor.close()
+        return {preset: pixel_seconds / wall_time for preset, pixel_seconds, wall_time in rate_data
+                if preset in config.x265_preset_speeds and wall_time}
+
+    def get_other_jobs(self) -> int:
+        """Get the number of video files transcoded by the other hosts of a shared queue.
+
+        Returns:
+            Amount of active video files claimed by another worker ID.
+        """
+        other_query = """SELECT COUNT(*)
+                            FROM queue
+                            WHERE transcode = 'Y' AND
+                            status = 'active' AND
+                            worker_id IS NOT ? ;
+        """
+        other_data = None
+        with DatabaseInterface(self.sqlite_db) as (_connect, db_cursor):
+            try:
+                other_data = db_cursor.execute(other_query, (lease.get_worker_id(),)).fetchone()
+            except sqlite3.Error:
+                logger.error("SQLite active jobs query failed.")
+                logger.exception(sqlite3.Error)
+            else:
+                db_cursor.close()
+        return other_data[0] if other_data else 0
+
+    def get_job_count(self, remaining_seconds: float, resource_governor: governor.Governor | None) -> float:
+        """Get the average number of jobs transcoding the queue until the deadline.
+
+        Args:
+            remaining_seconds (float): seconds left before the deadline.
+            resource_governor (Governor): governor of this host. None is never throttled.
+
+        Returns:
+            Jobs of this host, less the throttled jobs of the quiet hours, plus the running jobs of the other hosts.
+        """
+        job_count = float(self.workers)
+        if resource_governor and remaining_seconds > 0:
+            quiet_seconds = governor.get_quiet_seconds(resource_governor.quiet_hours, datetime.now(),
+                                                       remaining_seconds)
+            throttled_jobs = self.workers - min(self.workers, resource_governor.throttle_workers)
+            job_count -= throttled_jobs * quiet_seconds / remaining_seconds
+        return job_count + self.get_other_jobs()
+
+    def get_remaining_work(self) -> float:
+        """Get the media pixel-seconds of the video files left to transcode.
+
+        Active video files are counted whole, which leaves a margin for the running jobs.
+        With ESTIMATE, the video files predicted under MIN_SAVINGS are left out.
+
+        Returns:
+            Remaining work in media pixel-seconds.
+        """
+        savings_filter = ""
+        if estimate.ESTIMATE:
+            savings_filter = f"""AND NOT (est_size IS NOT NULL AND
+                            size > 0 AND
+                            (size - est_size) * 100.0 / size < {estimate.get_min_savings()})"""
+        work_query = f"""SELECT SUM(duration * width * height)
+                            FROM queue
+                            WHERE transcode = 'Y' AND
+                            status IN ('queued', 'active')
+                            {savings_filter} ;
+        """
+        work_data = None
+        with DatabaseInterface(self.sqlite_db) as (_connect, db_cursor):
+            try:
+                work_data = db_cursor.execute(work_query).fetchone()
+            except sqlite3.Error:
+                logger.error("SQLite remaining work query failed.")
+                logger.exception(sqlite3.Error)
+            else:
+                db_cursor.close()
+        return (work_data[0] or 0.0) if work_data else 0.0
+
+    def get_remaining_seconds(self) -> float:
+        """Get the seconds left before the deadline."""
+        return self.deadline - time.monotonic()
+
+    def is_over(self) -> bool:
+        """Check if the deadline has passed, logging it once.
+
+        Returns:
+            True if no more jobs should be started.
+        """
+        if not self.over and self.get_remaining_seconds() <= 0:
+            self.over = True
+            logger.warning("Time budget is over. The remaining video files stay queued.")
+        return self.over
+
+    def select_preset(self, resource_governor: governor.Governor | None = None) -> str:
+        """Select the slowest x265 preset which finishes the remaining work before the deadline.
+
+        Args:
+            resource_governor (Governor): governor of this host. None is never throttled.
+
+        Returns:
+            Name of the x265 preset. The x265 default preset without any history,
+            and the fastest preset when none of them finish in time.
+        """
+        preset_rates = self.get_preset_rates()
+        if not preset_rates:
+            history_msg = (f"No throughput history yet. Using the '{config.x265_default_preset}' "
+                           f"preset to measure it.")
+            logger.info(history_msg)
+            return config.x265_default_preset
+        remaining_work = self.get_remaining_work()
+        remaining_seconds = max(0.0, self.get_remaining_seconds())
+        # Without jobs during the whole window, such as quiet hours to the deadline, the fastest preset is used
+        job_count = max(self.get_job_count(remaining_seconds, resource_governor), 1e-9)
+        presets = list(config.x265_preset_speeds)
+        # The presets are ordered from the fastest to the slowest
+        for preset in reversed(presets):
+            preset_rate = get_preset_rate(preset, preset_rates)
+            needed_seconds = remaining_work / (preset_rate * job_count)
+            if needed_seconds <= remaining_seconds:
+                break
+        else:
+            preset = presets[0]
+            needed_seconds = remaining_work / (get_preset_rate(preset, preset_rates) * job_count)
+            overrun_msg = (f"The queue needs {needed_seconds / 3600:.2f} hours at the fastest preset, "
+                           f"with {remaining_seconds / 3600:.2f} hours left.")
+            logger.warning(overrun_msg)
+        preset_msg = (f"Selected the '{preset}' preset, finishing the queue in about "
+                      f"{needed_seconds / 3600:.2f} of the {remaining_seconds / 3600:.2f} hours left.")
+        logger.debug(preset_msg)
+        return preset
+
+
+def get_preset_rate(preset: str, preset_rates: dict) -> float:
+    """Get the throughput of a preset, scaled from the nearest measured preset when not measured.
+
+    Args:
+        preset (str): name of the x265 preset.
+        preset_rates (dict): measured throughput of each preset.
+
+    Returns:
+        Media pixel-seconds per wall second, per job.
+    """
+    if preset in preset_rates:
+        return preset_rates[preset]
+    presets = list(config.x265_preset_speeds)
+    nearest = min(preset_rates, key=lambda measured: abs(presets.index(measured) - presets.index(preset)))
+    speeds = config.x265_preset_speeds
+    return preset_rates[nearest] * speeds[preset] / speeds[nearest]
+
+
+def get_time_budget(sqlite_db: str) -> TimeBudget | None:
+    """Get the time budget from the TIME_BUDGET variable.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+
+    Returns:
+        TimeBudget, or None when TIME_BUDGET is not set.
+    """
+    try:
+        budget_hours = float(TIME_BUDGET)
+    except ValueError:
+        value_error_msg = f"TIME_BUDGET is not a number. {TIME_BUDGET=}. Using the default preset."
+        logger.error(value_error_msg)
+        return None
+    if budget_hours <= 0:
+        return None
+    return TimeBudget(sqlite_db, budget_hours * 3600)
@@ -1,7 +1,64 @@
 import tempfile
+from pathlib import Path
 
 temp_dir = tempfile.TemporaryDirectory(prefix="transcode-")
 log_filename = "transcode.log"
-schema_file = "/app/h265_transcoder/schema.sql"
+schema_dir = Path(__file__).parent / "migrations"
+scan_path = "/mnt"
 persist_db = "/tmp/transcode.db"
 temp_db = "transcode.db"
+exiftool_path = "/usr/bin/exiftool"
+exiftool_batch = 100
+db_timeout = 30
+segment_dir = "/tmp/segments"
+segment_max_age = 604800
+db_flush_interval = 1.0
+db_chunk_size = 1000
+scan_queue_size = 1000
+scan_threads = 8
+pipeline_poll_interval = 2.0
+watch_tick = 1.0
+hevc_bitrate_per_pixel = 1.2
+progress_samples = 32
+metrics_address = ""
+metrics_interval = 15
+simulate_progress_events = 10
+scratch_buffer_size = 8388608
+scratch_free_fraction = 0.9
+mp4_tag_padding = 4096
+estimate_samples = 3
+estimate_sample_seconds = 10
+x265_default_preset = "medium"
+# Relative speed of the x265 presets, from the fastest to the slowest, for presets without history
+x265_preset_speeds = {
+    "ultrafast": 10.0,
+    "superfast": 7.0,
+    "veryfast": 4.0,
+    "faster": 2.5,
+    "fast": 1.6,
+    "medium": 1.0,
+    "slow": 0.5,
+    "slower": 0.2,
+    "veryslow": 0.08
+}
+time_budget_min_wall_time = 30
+lease_renewals = 3
+lease_min_seconds = 30
+fallback_audio_bitrate = "192k"
+preflight_seconds = 2
+failure_stderr_lines = 50
+governor_interval = 10
+governor_resume_seconds = 120
+governor_probe_timeout = 10
+ionice_level = 7
+# Number of the 'ioprio_set' system call on each architecture
+ioprio_set_syscalls = {
+    "x86_64": 251,
+    "aarch64": 30
+}
+# Predicted peak memory of the jobs, scaled by the measured peak memory of the nearest resolution
+memory_base_bytes = 104857600
+memory_bytes_per_pixel = 300
+memory_remux_bytes = 104857600
+memory_default_pixels = 2073600
+memory_margin = 1.25
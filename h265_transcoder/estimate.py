@@ -0,0 +1,288 @@
+"""Contains the sample-encode estimator of the transcoding savings and time."""
+
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from ffmpeg import FFmpeg, FFmpegError, Progress
+
+from h265_transcoder import config, metrics, progress, workers
+from h265_transcoder.interfaces import DatabaseInterface
+from h265_transcoder.workers import WorkerPool
+
+logger = logging.getLogger("app")
+ESTIMATE = bool(os.getenv("ESTIMATE", "False").lower() == "true")
+DRY_RUN = bool(os.getenv("DRY_RUN", "False").lower() == "true")
+MIN_SAVINGS = os.getenv("MIN_SAVINGS", "10")
+
+
+def check_savings(sqlite_db: str, path: str, filename: str, cpus: list | None) -> bool:
+    """Check the predicted savings of a video file before transcoding it.
+
+    The video file is sampled when it has no stored prediction yet.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+        cpus (list): CPUs for the x265 thread pool. None uses all CPUs.
+
+    Returns:
+        True if the video file should be transcoded.
+    """
+    size, duration, est_size = get_estimate(sqlite_db, path, filename)
+    if est_size is None:
+        est_size = estimate_video(sqlite_db, path, filename, duration, cpus)
+    savings = get_savings(size, est_size)
+    if savings is None or savings >= get_min_savings():
+        return True
+    skip_msg = f"'{path}/{filename}' is predicted to save {savings:.1f}%. Skipping under MIN_SAVINGS."
+    logger.info(skip_msg)
+    return False
+
+
+def estimate_file(input_file: str, duration: float, cpus: list | None) -> tuple | None:
+    """Encode short samples spread across a video file, and extrapolate the whole file.
+
+    The samples use the production x265 settings, and copy the audio,
+    so the output bitrate of the samples includes the audio.
+
+    Args:
+        input_file (str): the video file.
+        duration (float): duration of the video file in seconds.
+        cpus (list): CPUs for the x265 thread pool. None uses all CPUs.
+
+    Returns:
+        Tuple of the predicted output size in bytes, the encode time in seconds, and the
+        CPU time in seconds. None when the samples could not be encoded.
+    """
+    sample_count = config.estimate_samples
+    sample_seconds = min(config.estimate_sample_seconds, duration / sample_count)
+    output_options = {
+        "codec:v": "libx265",
+        "codec:a": "copy",
+        "vtag": "hvc1",
+        "f": "mp4"
+    }
+    if cpus:
+        output_options["x265-params"] = workers.get_x265_params(cpus)
+    cpu_count = len(cpus) if cpus else len(os.sched_getaffinity(0))
+    sample_bytes = 0
+    encode_seconds = 0.0
+    cpu_seconds = 0.0
+    with tempfile.TemporaryDirectory(prefix="estimate-", dir=config.temp_dir.name) as sample_dir:
+        for sample_index in range(sample_count):
+            sample_start = duration * (sample_index + 0.5) / sample_count - sample_seconds / 2
+            sample_file = Path(sample_dir) / f"sample_{sample_index}.mp4"
+            ffmpeg = (
+                FFmpeg()
+                .option("y")
+                .input(input_file, {"ss": f"{max(0.0, sample_start):.3f}", "t": f"{sample_seconds:.3f}"})
+                .output(str(sample_file), output_options)
+            )
+            sample_cpu = []
+
+            @ffmpeg.on("progress")
+            def on_progress(_progress: Progress, ffmpeg=ffmpeg, sample_cpu=sample_cpu):
+                process = getattr(ffmpeg, "_process", None)
+                process_cpu = progress.get_cpu_seconds(process.pid) if process else None
+                if process_cpu is not None:
+                    sample_cpu.append(process_cpu)
+
+            sample_start_time = time.perf_counter()
+            try:
+                ffmpeg.execute()
+            except FFmpegError as sample_err:
+                sample_err_msg = f"Unable to encode a sample of '{input_file}': {sample_err.message}"
+                logger.warning(sample_err_msg)
+                return None
+            sample_wall = time.perf_counter() - sample_start_time
+            encode_seconds += sample_wall
+            # The last progress event is just before the end, or the CPU share is assumed busy
+            cpu_seconds += sample_cpu[-1] if sample_cpu else sample_wall * cpu_count
+            sample_bytes += progress.get_size(str(sample_file))
+    scale = duration / (sample_seconds * sample_count)
+    return int(sample_bytes * scale), encode_seconds * scale, cpu_seconds * scale
+
+
+def estimate_queue(sqlite_db: str) -> int:
+    """Sample every queued video file to transcode without a prediction, with the worker pool.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+
+    Returns:
+        Amount of video files estimated.
+    """
+    estimate_query = """SELECT path, filename, duration
+                        FROM queue
+                        WHERE transcode = 'Y' AND
+                        status = 'queued' AND
+                        est_size IS NULL AND
+                        duration > 0 ;
+    """
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            estimate_result = db_cursor.execute(estimate_query)
+            estimate_queue_data = estimate_result.fetchall()
+        except sqlite3.Error:
+            logger.error("SQLite estimate query failed.")
+            logger.exception(sqlite3.Error)
+            raise SystemExit(1) from sqlite3.Error
+        else:
+            db_cursor.close()
+
+    estimate_msg = f"Sampling {len(estimate_queue_data)} video file(s) to predict the savings."
+    logger.info(estimate_msg)
+    with WorkerPool(workers.get_workers()) as pool:
+        estimate_jobs = [pool.submit(estimate_video, sqlite_db, path, filename, duration)
+                         for path, filename, duration in estimate_queue_data]
+        for estimate_job in estimate_jobs:
+            estimate_job.result()
+    return len(estimate_queue_data)
+
+
+def estimate_video(sqlite_db: str, path: str, filename: str, duration: float | None,
+                   cpus: list | None) -> int | None:
+    """Predict the transcoding of a video file, and store the prediction.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+        duration (float): duration of the video file in seconds. None can not be estimated.
+        cpus (list): CPUs for the x265 thread pool. None uses all CPUs.
+
+    Returns:
+        Predicted output size in bytes, or None if it could not be estimated.
+    """
+    if not duration:
+        return None
+    start_time = time.perf_counter()
+    prediction = estimate_file(f"{path}/{filename}", duration, cpus)
+    metrics.estimate_seconds.observe(time.perf_counter() - start_time)
+    if prediction is None:
+        return None
+    est_size, est_seconds, est_cpu_seconds = prediction
+    estimate_update_query = """UPDATE queue
+                                SET est_size = ?,
+                                est_seconds = ?,
+                                est_cpu_seconds = ?
+                                WHERE path = ? AND
+                                filename = ? ;
+    """
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            db_cursor.execute(estimate_update_query, (est_size, est_seconds, est_cpu_seconds, path, filename))
+        except sqlite3.Error:
+            logger.error("SQLite estimate update failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+    prediction_msg = (f"'{path}/{filename}' is predicted at {est_size:,} bytes, "
+                      f"in {progress.format_seconds(est_seconds)}.")
+    logger.debug(prediction_msg)
+    return est_size
+
+
+def get_estimate(sqlite_db: str, path: str, filename: str) -> tuple:
+    """Get the stored prediction of a video file.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+
+    Returns:
+        Tuple of the size, duration, and predicted output size of the video file.
+        The values are None when not known.
+    """
+    estimate_query = "SELECT size, duration, est_size FROM queue WHERE path = ? AND filename = ? ;"
+    estimate_data = None
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            estimate_data = db_cursor.execute(estimate_query, (path, filename)).fetchone()
+        except sqlite3.Error:
+            logger.error("SQLite estimate query failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+    return estimate_data or (None, None, None)
+
+
+def get_min_savings() -> float:
+    """Get the savings threshold from the MIN_SAVINGS variable.
+
+    Returns:
+        Minimum predicted savings, in percent of the original size.
+    """
+    try:
+        return float(MIN_SAVINGS)
+    except ValueError:
+        value_error_msg = f"MIN_SAVINGS is not a number. {MIN_SAVINGS=}. Using 10."
+        logger.error(value_error_msg)
+        return 10.0
+
+
+def get_savings(size: int | None, est_size: int | None) -> float | None:
+    """Get the predicted savings in percent of the original size, or None if not known."""
+    if not size or est_size is None:
+        return None
+    return (size - est_size) * 100 / size
+
+
+def log_report(sqlite_db: str) -> None:
+    """Log the projected cost and savings of transcoding the queue.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+    """
+    report_query = """SELECT transcode, size, est_size, est_seconds, est_cpu_seconds
+                        FROM queue
+                        WHERE transcode IN ('Y', 'R') AND
+                        status = 'queued' ;
+    """
+    report_data = []
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            report_data = db_cursor.execute(report_query).fetchall()
+        except sqlite3.Error:
+            logger.error("SQLite report query failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+
+    min_savings = get_min_savings()
+    remux_count = 0
+    unknown_count = 0
+    skipped_count = 0
+    transcode_count = 0
+    size_total = 0
+    saved_total = 0
+    encode_total = 0.0
+    cpu_total = 0.0
+    for transcode, size, est_size, est_seconds, est_cpu_seconds in report_data:
+        savings = get_savings(size, est_size)
+        if transcode == "R":
+            remux_count += 1
+        elif savings is None:
+            unknown_count += 1
+        elif savings < min_savings:
+            skipped_count += 1
+        else:
+            transcode_count += 1
+            size_total += size
+            saved_total += size - est_size
+            encode_total += est_seconds
+            cpu_total += est_cpu_seconds
+    gigabyte = 1073741824
+    report_msg = (f"Dry run: {transcode_count} video file(s) to transcode, {remux_count} to remux, "
+                  f"{skipped_count} under MIN_SAVINGS={min_savings:g}%, {unknown_count} without a prediction.")
+    logger.info(report_msg)
+    projection_msg = (f"Projected {saved_total / gigabyte:,.1f}GB saved of {size_total / gigabyte:,.1f}GB, "
+                      f"in {cpu_total / 3600:,.1f} CPU-hours, "
+                      f"or {encode_total / workers.get_workers() / 3600:,.1f} hours with the workers.")
+    logger.info(projection_msg)
@@ -0,0 +1,185 @@
+"""Contains the classification of ffmpeg failures, their fallbacks, and the pre-flight check."""
+
+import logging
+import re
+import tempfile
+from pathlib import Path
+
+from ffmpeg import FFmpeg, FFmpegError
+
+from h265_transcoder import config
+
+logger = logging.getLogger("app")
+# ffmpeg names of the audio codecs, so a video or subtitle codec which MP4 can not carry is not an audio failure
+AUDIO_CODECS = (r"\b(aac\w*|ac3\w*|eac3|dts\w*|truehd|mlp|flac|alac|opus|vorbis|mp[123]\w*|pcm_\w+|adpcm_\w+|"
+                r"wma\w*|cook|ra_\w+|sipr|atrac\w*|ape|tta|wavpack|speex|amr_\w+|gsm\w*|qdm\w*|"
+                r"nellymoser|dsd_\w+|s302m|g72\w+|interplay_dpcm|roq_dpcm|\w+_dpcm)\b")
+# ffmpeg versions before 7 fail when the audio-only pre-flight check has no audio stream
+NO_STREAM_PATTERN = r"does not contain any stream"
+# Checked in order, as a full disk also breaks the muxing of every stream
+FAILURE_PATTERNS = {
+    "disk": (
+        r"no space left on device",
+        r"disk quota exceeded"
+    ),
+    "audio": (
+        rf"could not find tag for codec {AUDIO_CODECS} in stream",
+        rf"{AUDIO_CODECS} in mp4 support is experimental",
+        r"error initializing output stream.*audio",
+        r"audio.*incorrect codec parameters"
+    ),
+    "corrupt": (
+        # Also the result of a rejected output header, which is not about the input
+        r"^(?!.*could not write header).*invalid data found when processing input",
+        r"moov atom not found",
+        r"error while decoding",
+        r"corrupt (decoded )?(frame|packet|input)",
+        r"packet corrupt",
+        r"invalid nal unit",
+        r"error splitting the input into nal units",
+        r"non-existing pps",
+        r"ebml header parsing failed",
+        r"truncat"
+    ),
+    "killed": (
+        r"received signal (9|15)",
+        r"^killed"
+    )
+}
+# ffmpeg return codes of SIGKILL and SIGTERM, directly or through a shell
+KILLED_RETURN_CODES = (-9, -15, 137, 143)
+# The fallback added for a failure class. Other classes are retried as they are, or not at all
+FAILURE_FALLBACKS = {
+    "audio": "aac",
+    "corrupt": "tolerant"
+}
+NO_RETRY_FAILURES = ("disk",)
+
+
+def apply_fallbacks(fallbacks: set, input_options: dict, output_options: dict) -> None:
+    """Add the ffmpeg options of the fallbacks.
+
+    - aac: transcode the audio to AAC, for codecs which can not be copied into MP4.
+    - tolerant: ignore decoding errors, and discard corrupt packets.
+
+    Args:
+        fallbacks (set): names of the fallbacks.
+        input_options (dict): ffmpeg input options to update.
+        output_options (dict): ffmpeg output options to update.
+    """
+    if "aac" in fallbacks:
+        output_options["codec:a"] = "aac"
+        output_options["b:a"] = config.fallback_audio_bitrate
+    if "tolerant" in fallbacks:
+        input_options["err_detect"] = "ignore_err"
+        input_options["fflags"] = "+discardcorrupt+genpts"
+
+
+def classify_failure(message: str, stderr_lines, return_code: int | None = None) -> str:
+    """Classify an ffmpeg failure from its stderr and return code.
+
+    Args:
+        message (str): message of the FFmpegError, the last stderr line.
+        stderr_lines: the last stderr lines of the ffmpeg process.
+        return_code (int): return code of the ffmpeg process, if known.
+
+    Returns:
+        Failure class: "disk", "audio", "corrupt", "killed", or "unknown".
+    """
+    stderr_text = "\n".join([*stderr_lines, message or ""])
+    for failure, patterns in FAILURE_PATTERNS.items():
+        if any(re.search(pattern, stderr_text, flags=re.IGNORECASE | re.MULTILINE) for pattern in patterns):
+            return failure
+    if return_code in KILLED_RETURN_CODES:
+        return "killed"
+    return "unknown"
+
+
+def get_retry(failure: str | None, fallbacks: set) -> set | None:
+    """Get the fallbacks for the next attempt after a failure.
+
+    Args:
+        failure (str): failure class of the last attempt. None for a first attempt.
+        fallbacks (set): fallbacks used by the last attempt.
+
+    Returns:
+        Fallbacks for the next attempt, or None when it should not be retried.
+    """
+    if failure in NO_RETRY_FAILURES:
+        return None
+    fallback = FAILURE_FALLBACKS.get(failure)
+    if fallback is None:
+        return set(fallbacks)
+    if fallback in fallbacks:
+        # The fallback for this failure did not help
+        return None
+    return {*fallbacks, fallback}
+
+
+def join_fallbacks(fallbacks: set) -> str | None:
+    """Join the fallbacks for the 'fallback' column, or None when there are none."""
+    return ",".join(sorted(fallbacks)) or None
+
+
+def preflight(input_file: str, fallbacks: set) -> tuple:
+    """Check that the audio of a video file can be muxed into MP4, within seconds.
+
+    The first seconds of the audio streams are stream copied into a scratch
+    MP4, with the same audio options as the transcoding. The video is left
+    out, as the transcoding encodes it to HEVC, which MP4 always carries.
+    Unreadable input still fails, as the input is opened. Failures which
+    have a fallback are retried with it, so only the doomed video files fail:
+    a full disk, or a failure which its fallback did not fix. Other failures,
+    such as a network error during the check, leave it to the transcoding.
+
+    Args:
+        input_file (str): the video file to check.
+        fallbacks (set): fallbacks already used for the video file.
+
+    Returns:
+        Tuple of the fallbacks to transcode with, and the failure class,
+        or None if the check passed.
+    """
+    fallbacks = set(fallbacks)
+    with tempfile.TemporaryDirectory(prefix="preflight-", dir=config.temp_dir.name) as preflight_dir:
+        while True:
+            input_options = {"t": config.preflight_seconds}
+            output_options = {"map": "0:a?", "codec:a": "copy", "f": "mp4"}
+            apply_fallbacks(fallbacks, input_options, output_options)
+            ffmpeg = (
+                FFmpeg()
+                .option("y")
+                .input(input_file, input_options)
+                .output(str(Path(preflight_dir) / "preflight.mp4"), output_options)
+            )
+            stderr_lines = []
+            ffmpeg.on("stderr", stderr_lines.append)
+            try:
+                ffmpeg.execute()
+            except FFmpegError as preflight_err:
+                if any(re.search(NO_STREAM_PATTERN, line, flags=re.IGNORECASE) for line in stderr_lines):
+                    return fallbacks, None
+                return_code = getattr(getattr(ffmpeg, "_process", None), "returncode", None)
+                failure = classify_failure(preflight_err.message, stderr_lines[-config.failure_stderr_lines:],
+                                           return_code)
+                retry_fallbacks = get_retry(failure, fallbacks)
+                if failure in FAILURE_FALLBACKS and retry_fallbacks:
+                    fallback_msg = (f"Pre-flight check of '{input_file}' failed with the {failure} failure class. "
+                                    f"Using the '{FAILURE_FALLBACKS[failure]}' fallback.")
+                    logger.warning(fallback_msg)
+                    fallbacks = retry_fallbacks
+                    continue
+                if retry_fallbacks is not None:
+                    unknown_msg = (f"Pre-flight check of '{input_file}' failed with the {failure} failure class, "
+                                   f"which does not doom the video file. Transcoding it.")
+                    logger.warning(unknown_msg)
+                    return fallbacks, None
+                preflight_err_msg = f"Pre-flight check of '{input_file}' failed with the {failure} failure class."
+                logger.error(preflight_err_msg)
+                return fallbacks, failure
+            return fallbacks, None
+
+
+def split_fallbacks(fallback: str | None) -> set:
+    """Split the 'fallback' column into the set of fallbacks."""
+    return set(fallback.split(",")) if fallback else set()
@@ -0,0 +1,391 @@
+"""Contains the resource governor, which throttles the transcoding on a shared host."""
+
+import contextlib
+import ctypes
+import logging
+import os
+import platform
+import signal
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta
+
+from ffmpeg import FFmpeg
+
+from h265_transcoder import config, metrics, progress
+
+logger = logging.getLogger("app")
+GOVERNOR = bool(os.getenv("GOVERNOR", "False").lower() == "true")
+NICE = os.getenv("NICE", "10")
+IONICE = os.getenv("IONICE", "idle")
+MAX_LOAD = os.getenv("MAX_LOAD", "50")
+PLAYBACK_PROBE = os.getenv("PLAYBACK_PROBE", "")
+QUIET_HOURS = os.getenv("QUIET_HOURS", "")
+THROTTLE_WORKERS = os.getenv("THROTTLE_WORKERS", "0")
+# I/O scheduling classes of the 'ioprio_set' system call, which do not need privileges
+IOPRIO_CLASSES = {
+    "best-effort": 2,
+    "idle": 3
+}
+
+
+class Governor(threading.Thread):
+    """Throttle the transcoding jobs while the host is needed for something else.
+
+    The host is needed during the quiet hours, while the playback probe
+    succeeds, or while the other processes use more than MAX_LOAD percent
+    of the CPUs. The CPU time of this container is left out of the load,
+    so pausing the jobs does not end the throttling by itself. While
+    throttled, only THROTTLE_WORKERS jobs keep running, and the ffmpeg
+    processes of the newer jobs are stopped with SIGSTOP, until the host
+    has not been needed for a while and they get SIGCONT.
+    """
+    def __init__(self, worker_count: int) -> None:
+        """Setup the throttling conditions of the governor.
+
+        Args:
+            worker_count (int): number of concurrent transcoding jobs when not throttled.
+        """
+        super().__init__(name="governor", daemon=True)
+        self.worker_count = worker_count
+        self.throttle_workers = min(worker_count, get_setting(THROTTLE_WORKERS, "THROTTLE_WORKERS", 0))
+        self.max_load = get_setting(MAX_LOAD, "MAX_LOAD", 50)
+        self.quiet_hours = get_quiet_hours()
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.stopped_pids = set()
+        self.paused = {}
+        self.throttle_reason = None
+        self.last_needed = 0.0
+        self.playback_active = False
+        self.cpu_times = get_cpu_times()
+        self.own_seconds = self.get_own_cpu_seconds()
+        governor_msg = (f"Governor throttles to {self.throttle_workers} job(s) for "
+                        f"MAX_LOAD={self.max_load}%, {QUIET_HOURS=}, and the playback probe.")
+        logger.info(governor_msg)
+
+    def __enter__(self) -> "Governor":
+        """Check the host before the first job, start the governor, and returns it."""
+        self.update()
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        """Stop the governor, and continue every stopped ffmpeg process."""
+        self.stop_event.set()
+        self.join()
+        with self.lock:
+            self.throttle_reason = None
+            self.apply()
+
+    def run(self) -> None:
+        """Check the host at every interval."""
+        while not self.stop_event.wait(config.governor_interval):
+            self.update()
+
+    def get_allowed_workers(self) -> int:
+        """Get the number of jobs allowed to run now."""
+        return self.throttle_workers if self.throttle_reason else self.worker_count
+
+    def get_load(self) -> float | None:
+        """Get the CPU use of the other processes since the last check.
+
+        Returns:
+            Percent of all of the CPUs, or None if /proc/stat can not be read.
+        """
+        last_cpu_times, last_own_seconds = self.cpu_times, self.own_seconds
+        self.cpu_times, self.own_seconds = get_cpu_times(), self.get_own_cpu_seconds()
+        if self.cpu_times is None or last_cpu_times is None:
+            return None
+        busy_seconds = self.cpu_times[0] - last_cpu_times[0]
+        total_seconds = self.cpu_times[1] - last_cpu_times[1]
+        if total_seconds <= 0:
+            return None
+        return max(0.0, busy_seconds - (self.own_seconds - last_own_seconds)) * 100 / total_seconds
+
+    def get_own_cpu_seconds(self) -> float:
+        """Get the CPU time of this process, its finished children, and the running ffmpeg processes."""
+        own_times = os.times()
+        own_seconds = own_times.user + own_times.system + own_times.children_user + own_times.children_system
+        with self.lock:
+            processes = [ffmpeg._process for ffmpegs in self.jobs.values() for ffmpeg in ffmpegs
+                         if getattr(ffmpeg, "_process", None) is not None]
+        for process in processes:
+            if process.returncode is None:
+                own_seconds += progress.get_cpu_seconds(process.pid) or 0.0
+        return own_seconds
+
+    def get_throttle_reason(self) -> str | None:
+        """Get the reason the host is needed now.
+
+        Returns:
+            "quiet_hours", "playback", or "load". None when the host is not needed.
+        """
+        if in_quiet_hours(self.quiet_hours, datetime.now()):
+            return "quiet_hours"
+        if PLAYBACK_PROBE:
+            try:
+                probe_result = subprocess.run(PLAYBACK_PROBE, shell=True, capture_output=True,
+                                              timeout=config.governor_probe_timeout, check=False)
+            except subprocess.TimeoutExpired:
+                logger.warning("PLAYBACK_PROBE timed out. Keeping the last playback state.")
+            else:
+                self.playback_active = probe_result.returncode == 0
+            if self.playback_active:
+                return "playback"
+        load = self.get_load()
+        if self.max_load and load is not None and load > self.max_load:
+            load_msg = f"Other processes use {load:.0f}% of the CPUs."
+            logger.debug(load_msg)
+            return "load"
+        return None
+
+    def update(self) -> None:
+        """Start or end the throttling, and stop or continue the ffmpeg processes to match."""
+        now = time.monotonic()
+        reason = self.get_throttle_reason()
+        if reason:
+            self.last_needed = now
+        with self.lock:
+            if reason and reason != self.throttle_reason:
+                throttle_msg = f"Throttling the transcoding to {self.throttle_workers} job(s) for {reason}."
+                logger.info(throttle_msg)
+                self.throttle_reason = reason
+            elif not reason and self.throttle_reason and now - self.last_needed >= config.governor_resume_seconds:
+                resume_msg = f"Resuming the transcoding with {self.worker_count} job(s)."
+                logger.info(resume_msg)
+                self.throttle_reason = None
+            if self.throttle_reason:
+                metrics.throttled_seconds_total.inc(config.governor_interval, reason=self.throttle_reason)
+            self.apply()
+
+    def apply(self) -> None:
+        """Stop the ffmpeg processes of the jobs over the allowed number, and continue the others.
+
+        The jobs are in the order they started, so the oldest jobs keep running. Hold the lock.
+        """
+        allowed_workers = self.get_allowed_workers()
+        now = time.monotonic()
+        for job_index, (job, ffmpegs) in enumerate(self.jobs.items()):
+            paused_seconds, paused_since = self.paused.get(job, (0.0, None))
+            if job_index >= allowed_workers and paused_since is None:
+                self.paused[job] = (paused_seconds, now)
+            elif job_index < allowed_workers and paused_since is not None:
+                self.paused[job] = (paused_seconds + now - paused_since, None)
+            for ffmpeg in ffmpegs:
+                process = getattr(ffmpeg, "_process", None)
+                if process is None or process.returncode is not None:
+                    continue
+                if job_index >= allowed_workers:
+                    self.signal_process(process.pid, signal.SIGSTOP)
+                else:
+                    self.signal_process(process.pid, signal.SIGCONT)
+
+    def get_paused_seconds(self, job: str) -> float:
+        """Get the seconds a job has been stopped by the governor so far.
+
+        Args:
+            job (str): the video file of the job.
+
+        Returns:
+            Paused seconds, including the running pause.
+        """
+        with self.lock:
+            paused_seconds, paused_since = self.paused.get(job, (0.0, None))
+        if paused_since is not None:
+            paused_seconds += time.monotonic() - paused_since
+        return paused_seconds
+
+    def release(self, job: str) -> None:
+        """Forget the ffmpeg processes of a finished job.
+
+        Args:
+            job (str): the video file of the job.
+        """
+        with self.lock:
+            self.paused.pop(job, None)
+            for ffmpeg in self.jobs.pop(job, []):
+                process = getattr(ffmpeg, "_process", None)
+                if process is not None:
+                    self.stopped_pids.discard(process.pid)
+            # A job waiting for its turn takes the place of the finished job
+            self.apply()
+
+    def signal_process(self, pid: int, signal_number: int) -> None:
+        """Stop or continue an ffmpeg process, unless it already is.
+
+        Args:
+            pid (int): process ID of the ffmpeg process.
+            signal_number (int): SIGSTOP or SIGCONT.
+        """
+        stopping = signal_number == signal.SIGSTOP
+        if stopping == (pid in self.stopped_pids):
+            return
+        try:
+            os.kill(pid, signal_number)
+        except ProcessLookupError:
+            return
+        if stopping:
+            self.stopped_pids.add(pid)
+        else:
+            self.stopped_pids.discard(pid)
+        signal_msg = f"{'Stopped' if stopping else 'Continued'} the ffmpeg process {pid}."
+        logger.debug(signal_msg)
+
+    def watch(self, ffmpeg: FFmpeg, job: str) -> None:
+        """Govern an ffmpeg process of a job, stopping it right away when the job is not allowed to run.
+
+        Args:
+            ffmpeg (FFmpeg): ffmpeg command to govern, before it is executed.
+            job (str): the video file of the job.
+        """
+        with self.lock:
+            self.jobs.setdefault(job, []).append(ffmpeg)
+        started = threading.Event()
+
+        # The 'start' event is before the process exists, so the first stderr line is used
+        @ffmpeg.on("stderr")
+        def on_stderr(_line: str):
+            if not started.is_set():
+                started.set()
+                with self.lock:
+                    self.apply()
+
+
+def get_cpu_times() -> tuple | None:
+    """Get the busy and total CPU time of the host from /proc/stat.
+
+    Returns:
+        Tuple of the busy and the total seconds of all of the CPUs, or None if /proc/stat can not be read.
+    """
+    try:
+        with open("/proc/stat", encoding="utf-8") as proc_stat:
+            cpu_fields = [int(field) for field in proc_stat.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # The idle and iowait fields are the 4th and 5th, and the guest time is already in the user time
+    total_ticks = sum(cpu_fields[:8])
+    busy_ticks = total_ticks - sum(cpu_fields[3:5])
+    return busy_ticks / progress.CLOCK_TICKS, total_ticks / progress.CLOCK_TICKS
+
+
+def get_governor(worker_count: int):
+    """Get the governor when GOVERNOR is enabled.
+
+    Args:
+        worker_count (int): number of concurrent transcoding jobs when not throttled.
+
+    Returns:
+        Governor, or a null context when GOVERNOR is not enabled.
+    """
+    if not GOVERNOR:
+        return contextlib.nullcontext()
+    return Governor(worker_count)
+
+
+def get_quiet_hours() -> list:
+    """Parse the QUIET_HOURS variable, such as "18:00-23:30,06:00-07:00".
+
+    Returns:
+        List of tuples with the start and end minute of the day of each window.
+    """
+    quiet_hours = []
+    for window in QUIET_HOURS.replace(" ", "").split(","):
+        if not window:
+            continue
+        try:
+            start, end = (datetime.strptime(window_time, "%H:%M") for window_time in window.split("-"))
+        except ValueError:
+            value_error_msg = f"QUIET_HOURS window is not 'HH:MM-HH:MM'. {window=}. Skipping it."
+            logger.error(value_error_msg)
+            continue
+        quiet_hours.append((start.hour * 60 + start.minute, end.hour * 60 + end.minute))
+    return quiet_hours
+
+
+def get_setting(value: str, name: str, default: int) -> int:
+    """Parse a numeric governor setting.
+
+    Args:
+        value (str): value of the environment variable.
+        name (str): name of the environment variable.
+        default (int): value when it is not a number.
+
+    Returns:
+        The setting, at least 0.
+    """
+    try:
+        setting = int(float(value))
+    except ValueError:
+        value_error_msg = f"{name} is not a number. {value=}. Using {default}."
+        logger.error(value_error_msg)
+        setting = default
+    return max(0, setting)
+
+
+def get_quiet_seconds(quiet_hours: list, start: datetime, seconds: float) -> float:
+    """Get the seconds within the quiet hours of a period, to the minute.
+
+    Args:
+        quiet_hours (list): start and end minute of the day of each window.
+        start (datetime): local time the period starts.
+        seconds (float): length of the period in seconds.
+
+    Returns:
+        Seconds of the period in any window.
+    """
+    if not quiet_hours:
+        return 0.0
+    quiet_minutes = sum(in_quiet_hours(quiet_hours, start + timedelta(minutes=minute))
+                        for minute in range(int(seconds // 60)))
+    return min(seconds, quiet_minutes * 60.0)
+
+
+def in_quiet_hours(quiet_hours: list, now: datetime) -> bool:
+    """Check if a time is within the quiet hours. Windows past midnight wrap around.
+
+    Args:
+        quiet_hours (list): start and end minute of the day of each window.
+        now (datetime): local time to check.
+
+    Returns:
+        True if the time is in any window.
+    """
+    minute = now.hour * 60 + now.minute
+    for start, end in quiet_hours:
+        if start <= end and start <= minute < end:
+            return True
+        if start > end and (minute >= start or minute < end):
+            return True
+    return False
+
+
+def set_priority() -> None:
+    """Lower the CPU and I/O priority of the calling thread from NICE and IONICE.
+
+    Both priorities are per thread on Linux, and inherited by the threads
+    and processes it starts, so the ffmpeg processes of a worker thread get them.
+    """
+    nice = min(19, get_setting(NICE, "NICE", 10))
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+    except OSError:
+        nice_err_msg = f"Unable to set the CPU priority to {nice=}."
+        logger.warning(nice_err_msg)
+    io_class = IONICE.lower().strip()
+    if io_class in ("", "none"):
+        return
+    syscall_number = config.ioprio_set_syscalls.get(platform.machine())
+    if io_class not in IOPRIO_CLASSES or syscall_number is None:
+        ionice_msg = f"IONICE '{IONICE}' is not supported on {platform.machine()}. Skipping."
+        logger.warning(ionice_msg)
+        return
+    # The class is in the top bits, and the level within the class in the low bits
+    ioprio = IOPRIO_CLASSES[io_class] << 13 | config.ionice_level
+    libc = ctypes.CDLL(None, use_errno=True)
+    # IOPRIO_WHO_PROCESS with 0 is the calling thread
+    if libc.syscall(syscall_number, 1, 0, ioprio) != 0:
+        ionice_err_msg = f"Unable to set the I/O priority to '{IONICE}'. errno={ctypes.get_errno()}."
+        logger.warning(ionice_err_msg)
@@ -1,40 +1,306 @@
-"""Contains the SQLite database connection class."""
+"""Contains the SQLite database connection and exiftool session classes."""
 
+import atexit
+import json
 import logging
+import os
 import sqlite3
+import subprocess
+import threading
+
+from h265_transcoder import config, metrics
 
 logger = logging.getLogger("app")
+SHARED_QUEUE = bool(os.getenv("SHARED_QUEUE", "False").lower() == "true")
+
 
 class DatabaseInterface:
     """Interface with the SQLite database.
 
-    Ensure the SQLite database file is accessible, and a cursor is available.
+    One DatabaseInterface is shared for each SQLite database file.
+    Each thread keeps a long-lived connection in WAL journal mode,
+    and queued writes are coalesced into a single transaction
+    by a background thread. With SHARED_QUEUE, the rollback journal
+    is used instead, as WAL needs memory shared by every process.
     """
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __new__(cls, db_file: str):
+        """Return the shared DatabaseInterface of the SQLite database file."""
+        with cls.instances_lock:
+            instance = cls.instances.get(str(db_file))
+            if instance is None:
+                instance = super().__new__(cls)
+                instance.setup(str(db_file))
+                cls.instances[str(db_file)] = instance
+        return instance
+
     def __init__(self, db_file: str):
-        """Create the SQLite database connection."""
+        """The shared instance is setup once by 'setup'."""
+
+    def setup(self, db_file: str) -> None:
+        """Setup the per-thread connections and the write-behind queue."""
         logger.debug("Initializing DatabaseInterface.")
         self.db_file = db_file
-        self.db_connect = None
-        self.db_cursor = None
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.write_queue = {}
+        self.write_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.flush_thread = None
 
     def __enter__(self) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
-        """Connects to the database, and returns the connection and cursor."""
+        """Writes the queued writes, and returns the connection and cursor."""
+        db_connect = self.get_connection()
+        if self.write_queue:
+            self.flush()
+        self.local.db_cursor = db_connect.cursor()
+        return db_connect, self.local.db_cursor
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        """Commit the transaction. The connection is kept open for the thread."""
+        if exception_type:
+            exception_msg = f"An exception occurred: {exception_type}, {exception_value}"
+            logger.error(exception_msg)
+
+        self.local.db_connect.commit()
+        logger.debug("Database transaction committed.")
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread, connecting on first use.
+
+        Returns:
+            SQLite connection of the current thread.
+        """
+        db_connect = getattr(self.local, "db_connect", None)
+        if db_connect is not None:
+            return db_connect
         try:
-            self.db_connect = sqlite3.connect(self.db_file)
-            self.db_cursor = self.db_connect.cursor()
+            db_connect = sqlite3.connect(self.db_file,
+                                         timeout=config.db_timeout,
+                                         check_same_thread=False)
+            db_connect.execute(f"PRAGMA journal_mode = {'DELETE' if SHARED_QUEUE else 'WAL'} ;")
+            db_connect.execute("PRAGMA synchronous = NORMAL ;")
+            db_connect.execute(f"PRAGMA busy_timeout = {config.db_timeout * 1000} ;")
         except sqlite3.Error:
             logger.error("Failed to connect to the database.")
             logger.exception(sqlite3.Error)
             raise SystemExit(1) from sqlite3.Error
+        self.local.db_connect = db_connect
+        with self.connections_lock:
+            self.connections.append(db_connect)
+        logger.debug("Database connection opened.")
+        return db_connect
+
+    def queue_write(self, statement: str, parameters: tuple, key: tuple) -> None:
+        """Queue a write for the background thread.
+
+        Queued writes with the same statement and key are coalesced,
+        and only the latest parameters are written.
+
+        Args:
+            statement (str): SQLite statement to execute.
+            parameters (tuple): parameters for the statement.
+            key (tuple): key of the row being written.
+        """
+        with self.write_lock:
+            self.write_queue[(statement, key)] = parameters
+        if self.flush_thread is None:
+            with self.connections_lock:
+                if self.flush_thread is None:
+                    self.flush_thread = threading.Thread(target=self.flush_loop,
+                                                         name="db-flush",
+                                                         daemon=True)
+                    self.flush_thread.start()
+
+    def flush(self) -> None:
+        """Write all of the queued writes in a single transaction.
+
+        Flushes are serialized, so queued writes are committed in order.
+        """
+        with self.flush_lock:
+            with self.write_lock:
+                write_queue = self.write_queue
+                self.write_queue = {}
+            if not write_queue:
+                return
+            db_connect = self.get_connection()
+            try:
+                with db_connect, metrics.db_seconds.time(operation="flush"):
+                    for (statement, _key), parameters in write_queue.items():
+                        db_connect.execute(statement, parameters)
+            except sqlite3.Error:
+                flush_err_msg = f"SQLite queued write failed. Discarded {len(write_queue)} write(s)."
+                logger.error(flush_err_msg)
+                logger.exception(sqlite3.Error)
+            else:
+                flush_msg = f"Wrote {len(write_queue)} queued write(s)."
+                logger.debug(flush_msg)
+
+    def flush_loop(self) -> None:
+        """Write the queued writes at every flush interval."""
+        while not self.flush_event.wait(config.db_flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        """Write the queued writes, and close all of the connections."""
+        self.flush_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
+        with self.connections_lock:
+            for db_connect in self.connections:
+                db_connect.close()
+            self.connections.clear()
+        self.local = threading.local()
+        self.flush_event.clear()
+        logger.debug("Database connections closed.")
+
+    @classmethod
+    def close_all(cls) -> None:
+        """Close every shared DatabaseInterface."""
+        with cls.instances_lock:
+            for instance in cls.instances.values():
+                instance.close()
 
-        return self.db_connect, self.db_cursor
+
+atexit.register(DatabaseInterface.close_all)
+
+
+class ExifToolInterface:
+    """Interface with a long-lived exiftool process.
+
+    Run exiftool in '-stay_open' mode, so many files are read or written
+    by one Perl interpreter instead of starting one for every file.
+    """
+    def __init__(self, executable: str = config.exiftool_path):
+        """Setup the exiftool session. The process is started on first use."""
+        logger.debug("Initializing ExifToolInterface.")
+        self.executable = executable
+        self.exiftool_process = None
+        self.execute_count = 0
+        self.write_queue = []
+
+    def __enter__(self) -> "ExifToolInterface":
+        """Returns the exiftool session."""
+        return self
 
     def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
-        """Close the database connection."""
+        """Write any queued metadata, then stop the exiftool process."""
         if exception_type:
             exception_msg = f"An exception occurred: {exception_type}, {exception_value}"
             logger.error(exception_msg)
+        else:
+            self.flush_writes()
+        self.close()
+
+    def start(self) -> None:
+        """Start the exiftool process, reading arguments from stdin."""
+        start_cmd = [self.executable,
+                     "-stay_open", "True",
+                     "-@", "-"]
+        try:
+            self.exiftool_process = subprocess.Popen(start_cmd,
+                                                     stdin = subprocess.PIPE,
+                                                     stdout = subprocess.PIPE,
+                                                     stderr = subprocess.DEVNULL,
+                                                     encoding = "utf-8")
+        except OSError:
+            logger.error("Failed to start the exiftool process.")
+            logger.exception(OSError)
+            raise SystemExit(1) from OSError
+        logger.debug("Started exiftool in stay_open mode.")
+
+    def close(self) -> None:
+        """Stop the exiftool process."""
+        if self.exiftool_process is None:
+            return
+        try:
+            self.exiftool_process.stdin.write("-stay_open\nFalse\n")
+            self.exiftool_process.stdin.flush()
+            self.exiftool_process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.exiftool_process.kill()
+            self.exiftool_process.wait()
+        self.exiftool_process = None
+        logger.debug("exiftool process closed.")
+
+    def execute(self, *args: str) -> str:
+        """Run one exiftool command in the running process.
+
+        Args:
+            args (str): exiftool arguments, one per line of the argument file.
+
+        Returns:
+            stdout of the exiftool command.
+        """
+        if self.exiftool_process is None or self.exiftool_process.poll() is not None:
+            self.start()
+        self.execute_count += 1
+        ready_line = f"{{ready{self.execute_count}}}"
+        command = "\n".join(args) + f"\n-execute{self.execute_count}\n"
+        self.exiftool_process.stdin.write(command)
+        self.exiftool_process.stdin.flush()
+
+        output = []
+        for line in self.exiftool_process.stdout:
+            if line.rstrip() == ready_line:
+                break
+            output.append(line)
+        else:
+            logger.error("exiftool process ended unexpectedly.")
+            self.exiftool_process = None
+        return "".join(output)
+
+    def read_tags(self, video_files: list, tags: list) -> dict:
+        """Read tags from many video files in one exiftool command.
+
+        Args:
+            video_files (list): video files to read.
+            tags (list): tag names to read from each video file.
+
+        Returns:
+            Dictionary of each video file to a dictionary of its tags,
+            with numerical values. Video files which exiftool could not read are not included.
+        """
+        tag_args = [f"-{tag}" for tag in tags]
+        output = self.execute("-api", "largefilesupport",
+                              "-json",
+                              "-n",
+                              *tag_args,
+                              *video_files)
+        try:
+            metadata_list = json.loads(output)
+        except json.JSONDecodeError:
+            logger.debug("exiftool returned no JSON metadata.")
+            metadata_list = []
+        return {metadata["SourceFile"]: metadata for metadata in metadata_list}
+
+    def queue_write(self, video_file: str, tags: dict) -> None:
+        """Queue tags to write to a video file.
+
+        Args:
+            video_file (str): video file to update.
+            tags (dict): tag names and values to write. Empty values clear the tag.
+        """
+        self.write_queue.append((video_file, tags))
+
+    def flush_writes(self) -> dict:
+        """Write all of the queued tags.
 
-        self.db_connect.commit()
-        self.db_connect.close()
-        logger.debug("Database connection closed.")
+        Returns:
+            Dictionary of each video file to True if it was updated.
+        """
+        write_results = {}
+        for video_file, tags in self.write_queue:
+            tag_args = [f"-{tag}={value}" for tag, value in tags.items()]
+            output = self.execute("-overwrite_original",
+                                  *tag_args,
+                                  video_file)
+            write_results[video_file] = "1 image files updated" in output
+        self.write_queue.clear()
+        return write_results
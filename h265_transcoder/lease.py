@@ -0,0 +1,219 @@
+"""Contains the lease-based claiming of queued video files, for several hosts sharing one queue."""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from h265_transcoder import config, metrics
+from h265_transcoder.interfaces import DatabaseInterface
+
+logger = logging.getLogger("app")
+WORKER_ID = os.getenv("WORKER_ID", "")
+LEASE_SECONDS = os.getenv("LEASE_SECONDS", "300")
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Renew the leases of this worker, and reclaim the expired leases of the others.
+
+    A claimed video file is 'active' with the worker ID and a lease expiry.
+    The heartbeat extends the leases of every running job of this worker
+    several times per lease, so only the leases of a stopped or crashed
+    worker expire, and their video files are queued again for any worker.
+    """
+    def __init__(self, sqlite_db: str) -> None:
+        """Setup the heartbeat of the SQLite database.
+
+        Args:
+            sqlite_db (str): SQLite database file to use.
+        """
+        super().__init__(name="lease", daemon=True)
+        self.sqlite_db = sqlite_db
+        self.interval = get_lease_seconds() / config.lease_renewals
+        self.stop_event = threading.Event()
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        """Start the heartbeat, and returns it."""
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        """Stop the heartbeat. The leases left are released by the status updates."""
+        self.stop_event.set()
+        self.join()
+
+    def run(self) -> None:
+        """Renew and reclaim the leases at every interval."""
+        while not self.stop_event.wait(self.interval):
+            renew_leases(self.sqlite_db)
+            reclaim_leases(self.sqlite_db)
+
+
+def claim_batch(sqlite_db: str, batch_filter: str, order_by: str, limit: int) -> list:
+    """Atomically claim queued video files for this worker.
+
+    The selection and the claim are a single 'UPDATE ... RETURNING'
+    statement, so two workers never claim the same video file.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        batch_filter (str): extra SQLite 'WHERE' conditions of the batch.
+        order_by (str): SQLite 'ORDER BY' clause of the batch order policy.
+        limit (int): maximum amount of video files to claim.
+
+    Returns:
+        List of tuples containing the '(path, filename, transcode)' of the claimed files.
+    """
+    claim_query = f"""UPDATE queue
+                        SET status = 'active',
+                        worker_id = ?,
+                        lease_expires = ?
+                        WHERE rowid IN (
+                            SELECT rowid
+                            FROM queue
+                            WHERE transcode IN ('Y', 'R') AND
+                            status = 'queued'
+                            {batch_filter}
+                            ORDER BY {order_by}
+                            LIMIT ?)
+                        RETURNING path, filename, transcode ;"""
+    claim_data = (get_worker_id(), time.time() + get_lease_seconds(), limit)
+    with DatabaseInterface(sqlite_db) as (connection, db_cursor):
+        try:
+            with connection, metrics.db_seconds.time(operation="claim"):
+                claimed_files = db_cursor.execute(claim_query, claim_data).fetchall()
+        except sqlite3.Error:
+            logger.error("SQLite claim query failed.")
+            logger.exception(sqlite3.Error)
+            raise SystemExit(1) from sqlite3.Error
+        else:
+            db_cursor.close()
+    for path, filename, _transcode in claimed_files:
+        claim_msg = f"Claimed '{path}/{filename}' as '{get_worker_id()}'."
+        logger.debug(claim_msg)
+    return claimed_files
+
+
+def claim_file(sqlite_db: str, path: str, filename: str, status: str) -> bool:
+    """Atomically claim a video file with a status for this worker.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+        status (str): status the video file must still have, such as 'failed'.
+
+    Returns:
+        True if the video file was claimed, False if another worker has it.
+    """
+    claim_query = """UPDATE queue
+                        SET status = 'active',
+                        worker_id = ?,
+                        lease_expires = ?
+                        WHERE path = ? AND
+                        filename = ? AND
+                        status = ?
+                        RETURNING path ;"""
+    claim_data = (get_worker_id(), time.time() + get_lease_seconds(), path, filename, status)
+    claimed = []
+    with DatabaseInterface(sqlite_db) as (connection, db_cursor):
+        try:
+            with connection, metrics.db_seconds.time(operation="claim"):
+                claimed = db_cursor.execute(claim_query, claim_data).fetchall()
+        except sqlite3.Error:
+            logger.error("SQLite claim query failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+    if not claimed:
+        claimed_msg = f"'{path}/{filename}' is no longer '{status}'. Skipping."
+        logger.debug(claimed_msg)
+    return bool(claimed)
+
+
+def get_lease_seconds() -> float:
+    """Get the lease length from the LEASE_SECONDS variable.
+
+    Returns:
+        Lease length in seconds, at least the minimum in the config.
+    """
+    try:
+        lease_seconds = float(LEASE_SECONDS)
+    except ValueError:
+        value_error_msg = f"LEASE_SECONDS is not a number. {LEASE_SECONDS=}. Using 300."
+        logger.error(value_error_msg)
+        lease_seconds = 300.0
+    return max(config.lease_min_seconds, lease_seconds)
+
+
+def get_worker_id() -> str:
+    """Get the worker ID from the WORKER_ID variable, or the hostname of the container."""
+    return WORKER_ID or socket.gethostname()
+
+
+def reclaim_leases(sqlite_db: str, own: bool = False) -> int:
+    """Queue the video files again whose lease has expired.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        own (bool): also reclaim the video files left active by an earlier run of this worker.
+            Only use it before this worker starts any job.
+
+    Returns:
+        Amount of video files queued again.
+    """
+    # The worker ID is kept, so a late status update of that worker still applies until another claim
+    reclaim_query = """UPDATE queue
+                        SET status = 'queued',
+                        lease_expires = NULL
+                        WHERE status = 'active' AND
+                        (lease_expires IS NULL OR
+                        lease_expires < ? OR
+                        worker_id = ?)
+                        RETURNING path, filename, worker_id ;"""
+    reclaim_data = (time.time(), get_worker_id() if own else None)
+    reclaimed_files = []
+    with DatabaseInterface(sqlite_db) as (connection, db_cursor):
+        try:
+            with connection, metrics.db_seconds.time(operation="reclaim"):
+                reclaimed_files = db_cursor.execute(reclaim_query, reclaim_data).fetchall()
+        except sqlite3.Error:
+            logger.error("SQLite reclaim query failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+    for path, filename, worker_id in reclaimed_files:
+        reclaim_msg = f"Lease of '{path}/{filename}' by '{worker_id}' is over. Queued again."
+        logger.warning(reclaim_msg)
+    return len(reclaimed_files)
+
+
+def renew_leases(sqlite_db: str) -> int:
+    """Extend the leases of the video files claimed by this worker.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+
+    Returns:
+        Amount of leases renewed.
+    """
+    renew_query = """UPDATE queue
+                        SET lease_expires = ?
+                        WHERE status = 'active' AND
+                        worker_id = ? ;"""
+    renew_data = (time.time() + get_lease_seconds(), get_worker_id())
+    renewed_count = 0
+    with DatabaseInterface(sqlite_db) as (connection, db_cursor):
+        try:
+            with connection, metrics.db_seconds.time(operation="renew"):
+                renewed_count = db_cursor.execute(renew_query, renew_data).rowcount
+        except sqlite3.Error:
+            logger.error("SQLite lease renewal failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+    renew_msg = f"Renewed {renewed_count} lease(s) of '{get_worker_id()}'."
+    logger.debug(renew_msg)
+    return renewed_count
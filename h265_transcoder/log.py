@@ -1,23 +1,86 @@
+"""Contains the logging setup, writing the log records from a background thread."""
+
+import atexit
+import json
 import logging
 import os
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
 from h265_transcoder import config
 
 log_file = Path(config.temp_dir.name) / config.log_filename
 DEBUG = bool(os.environ["DEBUG"].lower() == "true")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_MAX_SIZE = os.getenv("LOG_MAX_SIZE", "10")
+LOG_BACKUPS = os.getenv("LOG_BACKUPS", "5")
 TRANSCODE = 5
 
 logger = logging.getLogger("app")
 logging.addLevelName(TRANSCODE, "TRANSCODE")
 
 
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line."""
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a log record as JSON.
+
+        Args:
+            record (LogRecord): the log record.
+
+        Returns:
+            JSON object with the time, level, thread, message, and exception.
+        """
+        log_entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, ensure_ascii=False)
+
+
 def transcode(self, message, *args, **kwargs):
     if self.isEnabledFor(TRANSCODE):
         self._log(TRANSCODE, message, args, **kwargs)
 
 
+def get_setting(value: str, name: str, default: int) -> int:
+    """Parse a numeric logging setting.
+
+    Args:
+        value (str): value of the environment variable.
+        name (str): name of the environment variable.
+        default (int): value when it is not a number.
+
+    Returns:
+        The setting, at least 0.
+    """
+    try:
+        setting = int(float(value))
+    except ValueError:
+        # The handlers are not setup yet, so the error goes to stderr
+        print(f"{name} is not a number. {value=}. Using {default}.", file=sys.stderr)
+        setting = default
+    return max(0, setting)
+
+
+def stop() -> None:
+    """Write the queued log records, then log synchronously until the exit.
+
+    Log records of the other exit handlers, such as closing the
+    database connections, are still written after the listener stops.
+    """
+    listener.stop()
+    logger.removeHandler(queue_handler)
+    for handler in listener.handlers:
+        logger.addHandler(handler)
+
+
 logging.Logger.transcode = transcode
 logger.setLevel(TRANSCODE)
 
@@ -25,11 +88,11 @@ logger.setLevel(TRANSCODE)
 stdout_handler = logging.StreamHandler(sys.stdout)
 stdout_handler.setLevel("TRANSCODE")
 stdout_format = logging.Formatter("[{levelname}] {message}", style="{")
-stdout_handler.setFormatter(stdout_format)
-logger.addHandler(stdout_handler)
 
-# Logging to a file defaults to INFO
-file_handler = logging.FileHandler(filename=log_file, mode="a", encoding="utf-8")
+# Logging to a file defaults to INFO, and rotates at LOG_MAX_SIZE megabytes
+file_handler = RotatingFileHandler(filename=log_file, mode="a", encoding="utf-8",
+                                   maxBytes=get_setting(LOG_MAX_SIZE, "LOG_MAX_SIZE", 10) * 1048576,
+                                   backupCount=get_setting(LOG_BACKUPS, "LOG_BACKUPS", 5))
 if DEBUG:
     file_handler.setLevel("DEBUG")
 else:
@@ -37,5 +100,15 @@ else:
 file_format = logging.Formatter("{asctime} [{levelname}] {message}",
                                 datefmt="%Y-%m-%d %H:%M:%S",
                                 style="{",)
+if LOG_FORMAT.lower().strip() == "json":
+    stdout_format = file_format = JsonFormatter()
+stdout_handler.setFormatter(stdout_format)
 file_handler.setFormatter(file_format)
-logger.addHandler(file_handler)
+
+# The callers only put the log records on a queue, and a background thread writes them
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+logger.addHandler(queue_handler)
+listener = QueueListener(log_queue, stdout_handler, file_handler, respect_handler_level=True)
+listener.start()
+atexit.register(stop)
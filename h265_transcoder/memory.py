@@ -0,0 +1,248 @@
+"""Contains the memory admission control of the concurrent transcoding jobs."""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from h265_transcoder import config
+from h265_transcoder.interfaces import DatabaseInterface
+
+logger = logging.getLogger("app")
+MEMORY_BUDGET = os.getenv("MEMORY_BUDGET", "0")
+
+
+class MemoryBudget:
+    """Admit transcoding jobs only while their predicted peak memory fits the budget.
+
+    The peak resident memory of an x265 job is predicted from the video
+    resolution, as a fixed base plus a number of bytes per pixel in the
+    config. The measured peak memory of the finished jobs in the
+    'job_stats' table refines it: a resolution with history uses its
+    highest measured peak, and the other resolutions are scaled from the
+    nearest measured one, which includes the lookahead and frame threads
+    of the encoder settings in use. A job is always admitted when nothing
+    else is running, so a video file which does not fit the budget on its
+    own still runs alone.
+    """
+    def __init__(self, sqlite_db: str, budget_bytes: int) -> None:
+        """Setup the reservations of the memory budget.
+
+        Args:
+            sqlite_db (str): SQLite database file to use.
+            budget_bytes (int): memory budget of the transcoding jobs in bytes.
+        """
+        self.sqlite_db = sqlite_db
+        self.budget_bytes = budget_bytes
+        self.reserved = {}
+        self.condition = threading.Condition()
+        budget_msg = f"Memory budget of {budget_bytes / 1073741824:.1f}GB for the transcoding jobs."
+        logger.info(budget_msg)
+
+    def acquire(self, path: str, filename: str, transcode: str) -> int:
+        """Wait until a video file fits the memory budget, and reserve its memory.
+
+        Args:
+            path (str): path for the video file.
+            filename (str): filename for the video file.
+            transcode (str): "Y" to transcode, or "R" to remux the video file.
+
+        Returns:
+            Reserved memory in bytes.
+        """
+        job_bytes = self.estimate(transcode, self.get_pixels(path, filename), self.get_history())
+        with self.condition:
+            self.condition.wait_for(lambda: not self.reserved or job_bytes <= self.get_free_bytes())
+            return self.reserve(path, filename, transcode, job_bytes)
+
+    def estimate(self, transcode: str, pixels: int | None, history: dict) -> int:
+        """Predict the peak memory of a job.
+
+        Args:
+            transcode (str): "Y" to transcode, or "R" to remux the video file.
+            pixels (int): pixels of the video resolution. None uses the default resolution.
+            history (dict): highest measured peak memory of each resolution.
+
+        Returns:
+            Peak resident memory in bytes, with the safety margin of the config.
+        """
+        if transcode == "R":
+            return config.memory_remux_bytes
+        pixels = pixels or config.memory_default_pixels
+        if pixels in history:
+            return int(history[pixels] * config.memory_margin)
+        job_bytes = get_model_bytes(pixels)
+        if history:
+            nearest = min(history, key=lambda measured: abs(measured - pixels))
+            job_bytes *= history[nearest] / get_model_bytes(nearest)
+        return int(job_bytes * config.memory_margin)
+
+    def get_filter(self) -> str:
+        """Get the SQLite 'WHERE' conditions of the video files which fit the free memory.
+
+        The batch order is kept, so the smaller video files fill the gaps
+        around the larger ones which do not fit yet.
+
+        Returns:
+            Extra conditions of the batch, empty when nothing is running.
+        """
+        with self.condition:
+            if not self.reserved:
+                return ""
+            free_bytes = self.get_free_bytes()
+        history = self.get_history()
+        fitting_pixels = [str(pixels) for pixels in self.get_queued_pixels()
+                          if self.estimate("Y", pixels, history) <= free_bytes]
+        fitting_filters = []
+        if config.memory_remux_bytes <= free_bytes:
+            fitting_filters.append("transcode = 'R'")
+        if fitting_pixels:
+            fitting_filters.append(f"""(transcode = 'Y' AND
+                            COALESCE(NULLIF(width * height, 0), {config.memory_default_pixels})
+                            IN ({", ".join(fitting_pixels)}))""")
+        if not fitting_filters:
+            return "AND 0"
+        return f"AND ({' OR '.join(fitting_filters)})"
+
+    def get_free_bytes(self) -> int:
+        """Get the memory left in the budget by the running jobs. Hold the condition."""
+        return self.budget_bytes - sum(self.reserved.values())
+
+    def get_history(self) -> dict:
+        """Get the highest measured peak memory of the finished x265 jobs, for each resolution.
+
+        Returns:
+            Dictionary of the pixels of each measured resolution to its peak resident memory in bytes.
+        """
+        history_query = """SELECT queue.width * queue.height, MAX(job_stats.peak_rss)
+                            FROM job_stats
+                            JOIN queue USING (path, filename)
+                            WHERE job_stats.transcode = 'Y' AND
+                            job_stats.status = 'done' AND
+                            job_stats.peak_rss > 0 AND
+                            queue.width > 0 AND
+                            queue.height > 0
+                            GROUP BY 1 ;
+        """
+        history_data = []
+        with DatabaseInterface(self.sqlite_db) as (_connect, db_cursor):
+            try:
+                history_data = db_cursor.execute(history_query).fetchall()
+            except sqlite3.Error:
+                logger.error("SQLite memory history query failed.")
+                logger.exception(sqlite3.Error)
+            else:
+                db_cursor.close()
+        return dict(history_data)
+
+    def get_pixels(self, path: str, filename: str) -> int | None:
+        """Get the pixels of the video resolution of a video file.
+
+        Args:
+            path (str): path for the video file.
+            filename (str): filename for the video file.
+
+        Returns:
+            Width times height, or None if not known.
+        """
+        pixels_query = "SELECT width * height FROM queue WHERE path = ? AND filename = ? ;"
+        pixels_data = None
+        with DatabaseInterface(self.sqlite_db) as (_connect, db_cursor):
+            try:
+                pixels_data = db_cursor.execute(pixels_query, (path, filename)).fetchone()
+            except sqlite3.Error:
+                logger.error("SQLite resolution query failed.")
+                logger.exception(sqlite3.Error)
+            else:
+                db_cursor.close()
+        return pixels_data[0] if pixels_data else None
+
+    def get_queued_pixels(self) -> list:
+        """Get the distinct resolutions of the queued video files to transcode.
+
+        Returns:
+            List of the pixels of each resolution. Unknown resolutions are the default resolution.
+        """
+        pixels_query = f"""SELECT DISTINCT COALESCE(NULLIF(width * height, 0), {config.memory_default_pixels})
+                            FROM queue
+                            WHERE transcode = 'Y' AND
+                            status = 'queued' ;
+        """
+        pixels_data = []
+        with DatabaseInterface(self.sqlite_db) as (_connect, db_cursor):
+            try:
+                pixels_data = db_cursor.execute(pixels_query).fetchall()
+            except sqlite3.Error:
+                logger.error("SQLite resolution query failed.")
+                logger.exception(sqlite3.Error)
+            else:
+                db_cursor.close()
+        return [pixels for (pixels,) in pixels_data]
+
+    def release(self, path: str, filename: str) -> None:
+        """Release the memory of a finished job, and wake the jobs waiting for it.
+
+        Args:
+            path (str): path for the video file.
+            filename (str): filename for the video file.
+        """
+        with self.condition:
+            self.reserved.pop((path, filename), None)
+            self.condition.notify_all()
+
+    def reserve(self, path: str, filename: str, transcode: str, job_bytes: int | None = None) -> int:
+        """Reserve the memory of an admitted job.
+
+        Args:
+            path (str): path for the video file.
+            filename (str): filename for the video file.
+            transcode (str): "Y" to transcode, or "R" to remux the video file.
+            job_bytes (int): predicted peak memory of the job. None predicts it.
+
+        Returns:
+            Reserved memory in bytes.
+        """
+        if job_bytes is None:
+            job_bytes = self.estimate(transcode, self.get_pixels(path, filename), self.get_history())
+        with self.condition:
+            if job_bytes > self.get_free_bytes():
+                over_msg = (f"'{path}/{filename}' needs about {job_bytes / 1048576:,.0f}MB, "
+                            f"over the MEMORY_BUDGET. Running it alone.")
+                logger.warning(over_msg)
+            self.reserved[(path, filename)] = job_bytes
+            reserve_msg = (f"Reserved {job_bytes / 1048576:,.0f}MB for '{path}/{filename}', "
+                           f"{self.get_free_bytes() / 1048576:,.0f}MB left.")
+            logger.debug(reserve_msg)
+        return job_bytes
+
+
+def get_model_bytes(pixels: int) -> float:
+    """Get the peak memory of an x265 job from the config, without any history.
+
+    Args:
+        pixels (int): pixels of the video resolution.
+
+    Returns:
+        Peak resident memory in bytes.
+    """
+    return config.memory_base_bytes + config.memory_bytes_per_pixel * pixels
+
+
+def get_memory_budget(sqlite_db: str) -> MemoryBudget | None:
+    """Get the memory budget from the MEMORY_BUDGET variable.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+
+    Returns:
+        MemoryBudget, or None when MEMORY_BUDGET is not set.
+    """
+    try:
+        budget_gigabytes = float(MEMORY_BUDGET)
+    except ValueError:
+        value_error_msg = f"MEMORY_BUDGET is not a number. {MEMORY_BUDGET=}. Admitting every job."
+        logger.error(value_error_msg)
+        return None
+    if budget_gigabytes <= 0:
+        return None
+    return MemoryBudget(sqlite_db, int(budget_gigabytes * 1073741824))
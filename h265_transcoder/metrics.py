@@ -0,0 +1,267 @@
+"""Contains the stage metrics, and their Prometheus textfile and HTTP exporters."""
+
+import atexit
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from h265_transcoder import config
+
+logger = logging.getLogger("app")
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_PORT = os.getenv("METRICS_PORT", "0")
+REGISTRY = []
+
+
+class Counter:
+    """Prometheus counter, with a value for each set of label values."""
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()) -> None:
+        """Setup the counter, and add it to the registry.
+
+        Args:
+            name (str): metric name.
+            help_text (str): metric description.
+            label_names (tuple): names of the metric labels.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the counter.
+
+        Args:
+            amount (float): amount to add.
+            labels (str): value of each metric label.
+        """
+        label_values = tuple(str(labels[label_name]) for label_name in self.label_names)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        """Render the counter in the Prometheus text format.
+
+        Returns:
+            List of the text format lines.
+        """
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Prometheus histogram, with buckets for each set of label values."""
+    def __init__(self, name: str, help_text: str, buckets: tuple, label_names: tuple = ()) -> None:
+        """Setup the histogram, and add it to the registry.
+
+        Args:
+            name (str): metric name.
+            help_text (str): metric description.
+            buckets (tuple): sorted upper bounds of the buckets.
+            label_names (tuple): names of the metric labels.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record an observation.
+
+        Args:
+            value (float): observed value.
+            labels (str): value of each metric label.
+        """
+        label_values = tuple(str(labels[label_name]) for label_name in self.label_names)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            bucket_counts, total = self.values.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            bucket_counts[bucket] += 1
+            self.values[label_values] = (bucket_counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observe the wall time of the block.
+
+        Args:
+            labels (str): value of each metric label.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def render(self) -> list:
+        """Render the histogram in the Prometheus text format.
+
+        Returns:
+            List of the text format lines.
+        """
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (bucket_counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for upper_bound, bucket_count in zip((*self.buckets, "+Inf"), bucket_counts):
+                    cumulative += bucket_count
+                    bucket_labels = format_labels((*self.label_names, "le"),
+                                                  (*label_values, str(upper_bound)))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the metrics at '/metrics'."""
+    def do_GET(self) -> None:
+        """Respond with the metrics in the Prometheus text format."""
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        """Log the requests at DEBUG level, instead of stderr."""
+        request_msg = f"Metrics request: {format % args}"
+        logger.debug(request_msg)
+
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+ENCODE_BUCKETS = (10, 60, 300, 600, 1800, 3600, 7200, 14400, 28800, 57600)
+
+scan_seconds = Histogram("h265_scan_seconds",
+                         "Wall time of the directory scans.",
+                         ENCODE_BUCKETS)
+walk_seconds = Histogram("h265_walk_directory_seconds",
+                         "Wall time of listing each directory during the walk.",
+                         SECONDS_BUCKETS)
+probe_seconds = Histogram("h265_probe_seconds",
+                          "Wall time of each metadata probe. exiftool reads a batch of files.",
+                          SECONDS_BUCKETS, ("method",))
+db_seconds = Histogram("h265_db_seconds",
+                       "Wall time of each SQLite operation.",
+                       SECONDS_BUCKETS, ("operation",))
+encode_seconds = Histogram("h265_encode_seconds",
+                           "Wall time of each transcoding job.",
+                           ENCODE_BUCKETS, ("transcode", "status"))
+encode_cpu_seconds = Histogram("h265_encode_cpu_seconds",
+                               "CPU time of the ffmpeg processes of each transcoding job.",
+                               ENCODE_BUCKETS, ("transcode", "status"))
+estimate_seconds = Histogram("h265_estimate_seconds",
+                             "Wall time of the sample encodes predicting each video file.",
+                             ENCODE_BUCKETS)
+files_total = Counter("h265_files_total",
+                      "Video files by stage and resulting status.",
+                      ("stage", "status"))
+encode_bytes_total = Counter("h265_encode_bytes_total",
+                             "Bytes read and written by the finished transcoding jobs.",
+                             ("direction",))
+throttled_seconds_total = Counter("h265_throttled_seconds_total",
+                                  "Seconds the governor throttled the transcoding, by reason.",
+                                  ("reason",))
+
+
+def escape_label(label_value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return label_value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    """Format the labels of a metric.
+
+    Args:
+        label_names (tuple): names of the metric labels.
+        label_values (tuple): values of the metric labels.
+
+    Returns:
+        Labels in the Prometheus text format, or an empty string without labels.
+    """
+    if not label_names:
+        return ""
+    labels = ",".join(
+        f'{label_name}="{escape_label(label_value)}"'
+        for label_name, label_value in zip(label_names, label_values)
+    )
+    return f"{{{labels}}}"
+
+
+def render_metrics() -> str:
+    """Render all of the metrics in the Prometheus text format.
+
+    Returns:
+        The metrics text.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def start_exporters() -> None:
+    """Start the textfile writer with METRICS_FILE, and the HTTP server with METRICS_PORT."""
+    if METRICS_FILE:
+        def write_loop():
+            while True:
+                time.sleep(config.metrics_interval)
+                write_textfile(METRICS_FILE)
+
+        threading.Thread(target=write_loop, name="metrics-file", daemon=True).start()
+        atexit.register(write_textfile, METRICS_FILE)
+        textfile_msg = f"Writing metrics to '{METRICS_FILE}'."
+        logger.info(textfile_msg)
+    try:
+        metrics_port = int(METRICS_PORT)
+    except ValueError:
+        value_error_msg = f"METRICS_PORT is not an integer. {METRICS_PORT=}."
+        logger.error(value_error_msg)
+        metrics_port = 0
+    if metrics_port > 0:
+        try:
+            metrics_server = ThreadingHTTPServer((config.metrics_address, metrics_port), MetricsHandler)
+        except OSError:
+            server_err_msg = f"Unable to serve the metrics on port {metrics_port}."
+            logger.error(server_err_msg)
+            return
+        metrics_server.daemon_threads = True
+        threading.Thread(target=metrics_server.serve_forever, name="metrics-http", daemon=True).start()
+        server_msg = f"Serving metrics at 'http://{config.metrics_address or '0.0.0.0'}:{metrics_port}/metrics'."
+        logger.info(server_msg)
+
+
+def write_textfile(metrics_file: str) -> None:
+    """Write the metrics for the node exporter textfile collector.
+
+    The file is replaced atomically, so the collector never reads a partial file.
+
+    Args:
+        metrics_file (str): path of the '.prom' file.
+    """
+    temp_file = Path(f"{metrics_file}.tmp")
+    try:
+        temp_file.write_text(render_metrics(), encoding="utf-8")
+        temp_file.replace(metrics_file)
+    except OSError:
+        write_err_msg = f"Unable to write the metrics to '{metrics_file}'."
+        logger.error(write_err_msg)
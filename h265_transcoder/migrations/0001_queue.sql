@@ -4,4 +4,4 @@ CREATE TABLE IF NOT EXISTS queue (
     filename TEXT UNIQUE NOT NULL,
     transcode TEXT DEFAULT "N" NOT NULL,
     status TEXT DEFAULT "skipped" NOT NULL
-);
\ No newline at end of file
+);
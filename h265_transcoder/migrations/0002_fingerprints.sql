@@ -0,0 +1,3 @@
+ALTER TABLE queue ADD COLUMN size INTEGER;
+ALTER TABLE queue ADD COLUMN mtime_ns INTEGER;
+ALTER TABLE queue ADD COLUMN inode INTEGER;
@@ -0,0 +1,45 @@
+-- Filenames are unique per path, not across the whole volume
+CREATE TABLE queue_v3 (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    transcode TEXT DEFAULT "N" NOT NULL,
+    status TEXT DEFAULT "skipped" NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    UNIQUE (path, filename)
+);
+INSERT OR IGNORE INTO queue_v3 (id, path, filename, transcode, status, size, mtime_ns, inode)
+    SELECT id, path, filename, transcode, status, size, mtime_ns, inode FROM queue;
+DROP TABLE queue;
+ALTER TABLE queue_v3 RENAME TO queue;
+
+CREATE INDEX IF NOT EXISTS queue_status_transcode ON queue (status, transcode);
+
+-- Row count per status, maintained by triggers
+CREATE TABLE IF NOT EXISTS status_count (
+    status TEXT PRIMARY KEY,
+    count INTEGER DEFAULT 0 NOT NULL
+);
+INSERT INTO status_count (status, count)
+    SELECT status, COUNT(*) FROM queue GROUP BY status;
+
+CREATE TRIGGER IF NOT EXISTS queue_status_insert AFTER INSERT ON queue
+BEGIN
+    INSERT INTO status_count (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS queue_status_delete AFTER DELETE ON queue
+BEGIN
+    UPDATE status_count SET count = count - 1 WHERE status = OLD.status;
+END;
+
+CREATE TRIGGER IF NOT EXISTS queue_status_update AFTER UPDATE OF status ON queue
+WHEN OLD.status != NEW.status
+BEGIN
+    UPDATE status_count SET count = count - 1 WHERE status = OLD.status;
+    INSERT INTO status_count (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+END;
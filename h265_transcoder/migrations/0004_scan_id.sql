@@ -0,0 +1 @@
+ALTER TABLE queue ADD COLUMN scan_id INTEGER;
@@ -0,0 +1,4 @@
+ALTER TABLE queue ADD COLUMN duration REAL;
+ALTER TABLE queue ADD COLUMN bitrate INTEGER;
+ALTER TABLE queue ADD COLUMN width INTEGER;
+ALTER TABLE queue ADD COLUMN height INTEGER;
@@ -0,0 +1,18 @@
+-- Throughput history, one row per transcoding attempt
+CREATE TABLE IF NOT EXISTS job_stats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    started INTEGER NOT NULL,
+    transcode TEXT,
+    status TEXT,
+    wall_time REAL,
+    cpu_time REAL,
+    frames INTEGER,
+    avg_fps REAL,
+    avg_speed REAL,
+    avg_bitrate REAL,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    UNIQUE (path, filename, started)
+);
@@ -0,0 +1,7 @@
+-- Directory listings of the last scan, so unchanged directories are not listed again
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL,
+    scan_id INTEGER
+);
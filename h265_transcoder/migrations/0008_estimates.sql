@@ -0,0 +1,4 @@
+-- Predictions of the sample-encode estimator, cleared when the video file changes
+ALTER TABLE queue ADD COLUMN est_size INTEGER;
+ALTER TABLE queue ADD COLUMN est_seconds REAL;
+ALTER TABLE queue ADD COLUMN est_cpu_seconds REAL;
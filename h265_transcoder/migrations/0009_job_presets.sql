@@ -0,0 +1,2 @@
+-- x265 preset of each transcoding attempt, for the time budget. NULL is the x265 default preset
+ALTER TABLE job_stats ADD COLUMN preset TEXT;
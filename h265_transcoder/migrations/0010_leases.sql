@@ -0,0 +1,4 @@
+-- Claims of the active video files, so several workers can share one queue
+ALTER TABLE queue ADD COLUMN worker_id TEXT;
+ALTER TABLE queue ADD COLUMN lease_expires REAL;
+CREATE INDEX IF NOT EXISTS queue_lease ON queue (lease_expires) WHERE status = 'active';
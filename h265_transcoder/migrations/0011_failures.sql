@@ -0,0 +1,3 @@
+-- Failure class of the last attempt, and the fallbacks it used, cleared when the video file changes
+ALTER TABLE queue ADD COLUMN failure TEXT;
+ALTER TABLE queue ADD COLUMN fallback TEXT;
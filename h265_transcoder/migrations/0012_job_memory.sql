@@ -0,0 +1,2 @@
+-- Peak resident memory of the ffmpeg processes of each transcoding attempt, for the memory budget
+ALTER TABLE job_stats ADD COLUMN peak_rss INTEGER;
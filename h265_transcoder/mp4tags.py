@@ -0,0 +1,266 @@
+"""Contains the in-place writer of the MP4 title and comment tags."""
+
+import io
+import logging
+import os
+import struct
+
+from h265_transcoder import config
+from h265_transcoder.probe import ProbeError, iter_boxes
+
+logger = logging.getLogger("app")
+TITLE_ITEM = b"\xa9nam"
+COMMENT_ITEM = b"\xa9cmt"
+PADDING_TYPES = (b"free", b"skip")
+# Handler of the iTunes item list: version/flags, pre_defined, handler type, reserved, and an empty name
+METADATA_HANDLER = struct.pack(">II4s4sII", 0, 0, b"mdir", b"appl", 0, 0) + b"\x00"
+
+
+def build_udta(udta_box: bytes | None, title: str) -> bytes:
+    """Build the user data box with the title, and without the comment.
+
+    The other boxes and items are kept as they are. The meta, handler,
+    and item list boxes are added when missing.
+
+    Args:
+        udta_box (bytes): the current user data box, or None if missing.
+        title (str): the new title.
+
+    Returns:
+        The new user data box.
+    """
+    title_item = make_box(TITLE_ITEM, make_box(b"data", struct.pack(">II", 1, 0) + title.encode("utf-8")))
+    udta_children = split_boxes(udta_box, 8) if udta_box else []
+    meta_index = next((index for index, child in enumerate(udta_children) if child[0] == b"meta"), None)
+    if meta_index is None:
+        meta_payload = bytes(4) + make_box(b"hdlr", METADATA_HANDLER) + make_box(b"ilst", title_item)
+        udta_children.append((b"meta", make_box(b"meta", meta_payload)))
+    else:
+        meta_box = udta_children[meta_index][1]
+        # ISO meta boxes start with version/flags, QuickTime meta boxes start with the handler
+        version_flags = b"" if meta_box[12:16] == b"hdlr" else meta_box[8:12]
+        meta_children = split_boxes(meta_box, 8 + len(version_flags))
+        ilst_index = next((index for index, child in enumerate(meta_children) if child[0] == b"ilst"), None)
+        if ilst_index is None:
+            meta_children.append((b"ilst", make_box(b"ilst", title_item)))
+        else:
+            items = []
+            for item_type, item_box in split_boxes(meta_children[ilst_index][1], 8):
+                if item_type == COMMENT_ITEM:
+                    continue
+                if item_type == TITLE_ITEM:
+                    if title_item not in items:
+                        items.append(title_item)
+                    continue
+                items.append(item_box)
+            if title_item not in items:
+                items.append(title_item)
+            meta_children[ilst_index] = (b"ilst", make_box(b"ilst", b"".join(items)))
+        meta_payload = version_flags + b"".join(child[1] for child in meta_children)
+        udta_children[meta_index] = (b"meta", make_box(b"meta", meta_payload))
+    return make_box(b"udta", b"".join(child[1] for child in udta_children))
+
+
+def get_tags(udta_box: bytes) -> tuple:
+    """Get the title and comment items of a user data box.
+
+    Args:
+        udta_box (bytes): the user data box.
+
+    Returns:
+        Tuple of the title, or None if missing, and True if there is a comment.
+    """
+    title = None
+    has_comment = False
+    for udta_type, udta_child in split_boxes(udta_box, 8):
+        if udta_type != b"meta":
+            continue
+        meta_start = 8 if udta_child[12:16] == b"hdlr" else 12
+        for meta_type, meta_child in split_boxes(udta_child, meta_start):
+            if meta_type != b"ilst":
+                continue
+            for item_type, item_box in split_boxes(meta_child, 8):
+                if item_type == COMMENT_ITEM:
+                    has_comment = True
+                elif item_type == TITLE_ITEM and title is None:
+                    data_boxes = [data_box for data_type, data_box in split_boxes(item_box, 8)
+                                  if data_type == b"data"]
+                    # data box header, then the value type and the locale
+                    title = data_boxes[0][16:].decode("utf-8", errors="replace") if data_boxes else ""
+    return title, has_comment
+
+
+def list_boxes(video, start: int, end: int) -> list:
+    """List the MP4 boxes between two byte offsets.
+
+    Args:
+        video: video file opened in binary mode.
+        start (int): byte offset of the first box.
+        end (int): byte offset where the boxes end.
+
+    Returns:
+        List of tuples of the box type, box offset, and box end offset.
+    """
+    boxes = []
+    offset = start
+    for box_type, _payload, box_end in iter_boxes(video, start, end):
+        boxes.append((box_type, offset, box_end))
+        offset = box_end
+    return boxes
+
+
+def make_box(box_type: bytes, payload: bytes) -> bytes:
+    """Make an MP4 box with a 32-bit size.
+
+    Args:
+        box_type (bytes): four character box type.
+        payload (bytes): payload of the box.
+
+    Returns:
+        The box.
+    """
+    if len(payload) + 8 > 0xFFFFFFFF:
+        raise ProbeError(f"'{box_type!r}' box is too large.")
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def make_free(size: int) -> bytes:
+    """Make a free box of a size, which is at least 8 bytes, or empty for 0."""
+    return make_box(b"free", bytes(size - 8)) if size else b""
+
+
+def split_boxes(box: bytes, start: int) -> list:
+    """Split the payload of a box in memory into its child boxes.
+
+    Args:
+        box (bytes): the parent box.
+        start (int): byte offset of the first child box.
+
+    Returns:
+        List of tuples of the box type and the child box. Bytes after
+        the last child box, such as a QuickTime terminator, have the type None.
+    """
+    children = []
+    offset = start
+    for box_type, _payload, box_end in iter_boxes(io.BytesIO(box), start, len(box)):
+        children.append((box_type, box[offset:box_end]))
+        offset = box_end
+    if offset < len(box):
+        children.append((None, box[offset:]))
+    return children
+
+
+def write_tags(video_file: str, title: str) -> bool:
+    """Write the title, and remove the comment, of an MP4 file in place.
+
+    Only the box headers and the user data box are read. The new user data
+    box replaces the old one when it fits in its space and the free boxes
+    after it. Otherwise the movie box grows into the free boxes after it, or
+    past the end of the file when it is the last box. When neither fits, the
+    movie box is moved to the end of the file with padding for later updates,
+    and the old movie box is turned into a free box. The media data is never
+    moved, so the chunk offsets stay valid.
+
+    Args:
+        video_file (str): MP4 file to update.
+        title (str): the new title.
+
+    Returns:
+        True if the file was updated. False if the tags already matched.
+
+    Raises:
+        ProbeError: when the file could not be parsed.
+    """
+    with open(video_file, "r+b") as video:
+        file_end = video.seek(0, 2)
+        top_boxes = list_boxes(video, 0, file_end)
+        if not top_boxes or top_boxes[0][0] not in (b"ftyp", b"moov", b"free", b"skip", b"wide", b"mdat"):
+            raise ProbeError("Not an MP4 file.")
+        moov_index = next((index for index, box in enumerate(top_boxes) if box[0] == b"moov"), None)
+        if moov_index is None:
+            raise ProbeError("No 'moov' box found.")
+        _moov_type, moov_start, moov_end = top_boxes[moov_index]
+        video.seek(moov_start)
+        moov_header = 16 if struct.unpack(">I", video.read(4))[0] == 1 else 8
+        free_end = moov_end
+        for box_type, _box_start, box_end in top_boxes[moov_index + 1:]:
+            if box_type not in PADDING_TYPES:
+                break
+            free_end = box_end
+
+        moov_children = list_boxes(video, moov_start + moov_header, moov_end)
+        udta_index = next((index for index, box in enumerate(moov_children) if box[0] == b"udta"), None)
+        if udta_index is None:
+            udta_box = None
+            region_start = region_end = moov_end
+        else:
+            _udta_type, region_start, region_end = moov_children[udta_index]
+            video.seek(region_start)
+            udta_box = video.read(region_end - region_start)
+            if get_tags(udta_box) == (title, False):
+                return False
+            for box_type, _box_start, box_end in moov_children[udta_index + 1:]:
+                if box_type not in PADDING_TYPES:
+                    break
+                region_end = box_end
+        new_udta = build_udta(udta_box, title)
+
+        region_size = region_end - region_start
+        if len(new_udta) == region_size or len(new_udta) + 8 <= region_size:
+            write_at(video, region_start, new_udta + make_free(region_size - len(new_udta)))
+            return True
+
+        # The boxes after the user data box move with it, but the media data does not
+        video.seek(region_end)
+        moov_tail = video.read(moov_end - region_end)
+        free_size = free_end - region_start - len(new_udta) - len(moov_tail)
+        if free_end == file_end:
+            new_end = new_udta + make_free(config.mp4_tag_padding) + moov_tail
+            write_at(video, region_start, new_end)
+            video.truncate(region_start + len(new_end))
+            write_size(video, moov_start, moov_header, region_start + len(new_end) - moov_start)
+        elif free_size == 0 or free_size >= 8:
+            write_at(video, region_start, new_udta + moov_tail + make_free(free_size))
+            write_size(video, moov_start, moov_header, free_end - free_size - moov_start)
+        else:
+            video.seek(top_boxes[-1][1])
+            if struct.unpack(">I", video.read(4))[0] == 0:
+                raise ProbeError("The last box has no size, so the 'moov' box can not be moved after it.")
+            video.seek(moov_start + moov_header)
+            moov_head = video.read(region_start - moov_start - moov_header)
+            new_moov = make_box(b"moov", moov_head + new_udta + make_free(config.mp4_tag_padding) + moov_tail)
+            write_at(video, file_end, new_moov)
+            # The old movie box is only freed after the new one is on disk
+            write_at(video, moov_start + 4, b"free")
+            relocate_msg = f"Moved the 'moov' box of '{video_file}' to the end of the file."
+            logger.debug(relocate_msg)
+    return True
+
+
+def write_at(video, offset: int, data: bytes) -> None:
+    """Write bytes at an offset, and flush them to disk.
+
+    Args:
+        video: video file opened in binary read/write mode.
+        offset (int): byte offset to write at.
+        data (bytes): bytes to write.
+    """
+    video.seek(offset)
+    video.write(data)
+    video.flush()
+    os.fsync(video.fileno())
+
+
+def write_size(video, box_start: int, box_header: int, box_size: int) -> None:
+    """Write the size of a box header.
+
+    Args:
+        video: video file opened in binary read/write mode.
+        box_start (int): byte offset of the box.
+        box_header (int): size of the box header, 16 for a 64-bit size.
+        box_size (int): the new size of the box.
+    """
+    if box_header == 16:
+        write_at(video, box_start + 8, struct.pack(">Q", box_size))
+    else:
+        write_at(video, box_start, struct.pack(">I", box_size))
@@ -0,0 +1,397 @@
+"""Contains the in-process MP4 and Matroska codec probe."""
+
+import logging
+import struct
+from pathlib import Path
+
+logger = logging.getLogger("app")
+
+# Matroska element IDs
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+MKV_SEGMENT = 0x18538067
+MKV_CLUSTER = 0x1F43B675
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_VIDEO_TRACK = 1
+
+
+class ProbeError(Exception):
+    """The video file could not be parsed by the probe."""
+
+
+def probe_metadata(video_file: str) -> dict | None:
+    """Read the codec metadata of video track 0 without reading the media payload.
+
+    MP4 files report the sample entry fourcc as 'CompressorID'.
+    Matroska files report the EBML 'DocType', and the 'CodecID' of the video track.
+    Both report the 'Duration' in seconds, and the 'ImageWidth' and 'ImageHeight'
+    of the video track, when found.
+
+    Args:
+        video_file (str): video file to probe.
+
+    Returns:
+        Dictionary of the metadata tags, matching the exiftool tag names.
+        None when the file could not be parsed, and exiftool should be used.
+    """
+    try:
+        with Path(video_file).open(mode="rb") as video:
+            magic = video.read(4)
+            video.seek(0)
+            if magic == EBML_HEADER.to_bytes(4, "big"):
+                metadata = read_matroska(video)
+            else:
+                metadata = read_mp4(video)
+    except (OSError, ProbeError, struct.error, ValueError) as probe_err:
+        probe_err_msg = f"Unable to probe '{video_file}': {probe_err}"
+        logger.debug(probe_err_msg)
+        return None
+    return metadata
+
+
+def read_exact(video, length: int) -> bytes:
+    """Read a number of bytes, which must all be in the file.
+
+    Args:
+        video: video file opened in binary mode.
+        length (int): number of bytes to read.
+
+    Returns:
+        The bytes read.
+    """
+    data = video.read(length)
+    if len(data) < length:
+        raise ProbeError(f"Truncated file at {video.tell()}.")
+    return data
+
+
+def read_ascii(video, length: int) -> str:
+    """Read an ASCII string element, without its trailing NUL padding.
+
+    Args:
+        video: video file opened in binary mode.
+        length (int): number of bytes to read.
+
+    Returns:
+        The decoded string.
+    """
+    data = read_exact(video, length).rstrip(b"\x00")
+    try:
+        return data.decode("ascii")
+    except UnicodeDecodeError as decode_err:
+        raise ProbeError(f"Invalid ASCII string {data[:32]!r}.") from decode_err
+
+
+def read_box_header(video, offset: int, end: int) -> tuple:
+    """Read the MP4 box header at the offset.
+
+    Args:
+        video: video file opened in binary mode.
+        offset (int): byte offset of the box.
+        end (int): byte offset where the parent box ends.
+
+    Returns:
+        Tuple of the box type, payload offset, and box end offset.
+    """
+    video.seek(offset)
+    header = video.read(8)
+    if len(header) < 8:
+        raise ProbeError(f"Truncated box header at {offset}.")
+    box_size, box_type = struct.unpack(">I4s", header)
+    payload = offset + 8
+    if box_size == 1:
+        box_size = struct.unpack(">Q", read_exact(video, 8))[0]
+        payload += 8
+    elif box_size == 0:
+        box_size = end - offset
+    if box_size < payload - offset or offset + box_size > end:
+        raise ProbeError(f"Invalid '{box_type!r}' box size at {offset}.")
+    return box_type, payload, offset + box_size
+
+
+def iter_boxes(video, start: int, end: int):
+    """Iterate over the MP4 boxes between two byte offsets.
+
+    Args:
+        video: video file opened in binary mode.
+        start (int): byte offset of the first box.
+        end (int): byte offset where the boxes end.
+
+    Yields:
+        Tuple of the box type, payload offset, and box end offset.
+    """
+    offset = start
+    while offset + 8 <= end:
+        box_type, payload, box_end = read_box_header(video, offset, end)
+        yield box_type, payload, box_end
+        offset = box_end
+
+
+def find_box(video, start: int, end: int, box_type: bytes) -> tuple | None:
+    """Find the first child box of a type.
+
+    Returns:
+        Tuple of the payload offset and box end offset, or None if not found.
+    """
+    for child_type, payload, box_end in iter_boxes(video, start, end):
+        if child_type == box_type:
+            return payload, box_end
+    return None
+
+
+def read_mp4(video) -> dict:
+    """Read the duration, and the sample entry of the first video track.
+
+    Only the box headers, the movie header, the handler, and the sample description are read.
+
+    Args:
+        video: video file opened in binary mode.
+
+    Returns:
+        Dictionary with the 'Duration', and the 'CompressorID', 'ImageWidth',
+        and 'ImageHeight', if there is a video track.
+    """
+    file_end = video.seek(0, 2)
+    first_type = read_box_header(video, 0, file_end)[0]
+    if first_type not in (b"ftyp", b"moov", b"free", b"skip", b"wide", b"mdat"):
+        raise ProbeError(f"Not an MP4 file. First box is {first_type!r}.")
+    moov = find_box(video, 0, file_end, b"moov")
+    if moov is None:
+        raise ProbeError("No 'moov' box found.")
+
+    metadata = {}
+    mvhd = find_box(video, *moov, b"mvhd")
+    if mvhd is not None:
+        metadata.update(read_mvhd(video, mvhd[0]))
+    for box_type, payload, box_end in iter_boxes(video, *moov):
+        if box_type != b"trak":
+            continue
+        mdia = find_box(video, payload, box_end, b"mdia")
+        if mdia is None:
+            continue
+        hdlr = find_box(video, *mdia, b"hdlr")
+        if hdlr is None:
+            continue
+        # Full box version/flags, then pre_defined, then the handler type
+        video.seek(hdlr[0] + 8)
+        if video.read(4) != b"vide":
+            continue
+        minf = find_box(video, *mdia, b"minf")
+        stbl = find_box(video, *minf, b"stbl") if minf else None
+        if stbl is None:
+            raise ProbeError("Video track has no sample table.")
+        stsd = find_box(video, *stbl, b"stsd")
+        if stsd is None:
+            raise ProbeError("Video track has no sample description.")
+        # Full box version/flags, entry count, then the first visual sample entry
+        video.seek(stsd[0] + 8)
+        sample_entry = video.read(36)
+        if len(sample_entry) < 36:
+            raise ProbeError("Truncated sample description.")
+        metadata["CompressorID"] = sample_entry[4:8].decode("latin-1")
+        metadata["ImageWidth"], metadata["ImageHeight"] = struct.unpack(">HH", sample_entry[32:36])
+        return metadata
+    return metadata
+
+
+def read_mvhd(video, payload: int) -> dict:
+    """Read the duration from the MP4 movie header.
+
+    Args:
+        video: video file opened in binary mode.
+        payload (int): byte offset of the 'mvhd' payload.
+
+    Returns:
+        Dictionary with the 'Duration' in seconds, if the timescale is set.
+    """
+    video.seek(payload)
+    version = read_exact(video, 4)[0]
+    if version == 1:
+        _created, _modified, timescale, duration = struct.unpack(">QQIQ", read_exact(video, 28))
+    else:
+        _created, _modified, timescale, duration = struct.unpack(">IIII", read_exact(video, 16))
+    if timescale == 0:
+        return {}
+    return {"Duration": duration / timescale}
+
+
+def read_vint(video, keep_marker: bool = False) -> tuple:
+    """Read an EBML variable length integer.
+
+    Args:
+        video: video file opened in binary mode.
+        keep_marker (bool): keep the length marker bit, as used by element IDs.
+
+    Returns:
+        Tuple of the value and its length in bytes.
+        The value is None for an unknown element size.
+    """
+    first = video.read(1)
+    if not first:
+        raise ProbeError("Truncated EBML element.")
+    first_byte = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first_byte & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ProbeError("Invalid EBML variable length integer.")
+    rest = video.read(length - 1)
+    if len(rest) < length - 1:
+        raise ProbeError("Truncated EBML element.")
+    value = first_byte if keep_marker else first_byte & (mask - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def iter_elements(video, start: int, end: int):
+    """Iterate over the EBML elements between two byte offsets.
+
+    Args:
+        video: video file opened in binary mode.
+        start (int): byte offset of the first element.
+        end (int): byte offset where the elements end.
+
+    Yields:
+        Tuple of the element ID, data offset, and element end offset.
+    """
+    offset = start
+    while offset < end:
+        video.seek(offset)
+        element_id, id_length = read_vint(video, keep_marker=True)
+        element_size, size_length = read_vint(video)
+        data = offset + id_length + size_length
+        element_end = end if element_size is None else data + element_size
+        if element_end > end:
+            raise ProbeError(f"Invalid EBML element size at {offset}.")
+        yield element_id, data, element_end
+        offset = element_end
+
+
+def read_matroska(video) -> dict:
+    """Read the EBML DocType, the duration, and the first video track.
+
+    Only the EBML header, and the Info and Tracks elements are read.
+
+    Args:
+        video: video file opened in binary mode.
+
+    Returns:
+        Dictionary with the 'DocType', 'Duration', and the video track
+        'CodecID', 'ImageWidth', and 'ImageHeight', if found.
+    """
+    file_end = video.seek(0, 2)
+    metadata = {}
+    for element_id, data, element_end in iter_elements(video, 0, file_end):
+        if element_id == EBML_HEADER:
+            for child_id, child_data, child_end in iter_elements(video, data, element_end):
+                if child_id == EBML_DOCTYPE:
+                    video.seek(child_data)
+                    metadata["DocType"] = read_ascii(video, child_end - child_data)
+        elif element_id == MKV_SEGMENT:
+            metadata.update(read_matroska_segment(video, data, element_end))
+            break
+    if "DocType" not in metadata:
+        raise ProbeError("No EBML DocType found.")
+    return metadata
+
+
+def read_matroska_segment(video, start: int, end: int) -> dict:
+    """Read the Info and Tracks elements of the Segment.
+
+    Args:
+        video: video file opened in binary mode.
+        start (int): byte offset of the Segment data.
+        end (int): byte offset where the Segment ends.
+
+    Returns:
+        Dictionary with the 'Duration', and the video track metadata.
+    """
+    metadata = {}
+    tracks_found = False
+    for element_id, data, element_end in iter_elements(video, start, end):
+        if element_id == MKV_CLUSTER:
+            break
+        if element_id == MKV_INFO:
+            metadata.update(read_matroska_info(video, data, element_end))
+        elif element_id == MKV_TRACKS:
+            metadata.update(read_matroska_tracks(video, data, element_end))
+            tracks_found = True
+        if tracks_found and "Duration" in metadata:
+            break
+    if not tracks_found:
+        raise ProbeError("Reached the media clusters before the Tracks element.")
+    return metadata
+
+
+def read_matroska_info(video, start: int, end: int) -> dict:
+    """Read the duration from the Segment Info element.
+
+    Args:
+        video: video file opened in binary mode.
+        start (int): byte offset of the Info data.
+        end (int): byte offset where the Info element ends.
+
+    Returns:
+        Dictionary with the 'Duration' in seconds, if found.
+    """
+    timestamp_scale = 1000000
+    duration = None
+    for element_id, data, element_end in iter_elements(video, start, end):
+        video.seek(data)
+        if element_id == MKV_TIMESTAMP_SCALE:
+            timestamp_scale = int.from_bytes(video.read(element_end - data), "big")
+        elif element_id == MKV_DURATION:
+            float_format = ">d" if element_end - data == 8 else ">f"
+            duration = struct.unpack(float_format, video.read(element_end - data))[0]
+    if duration is None:
+        return {}
+    return {"Duration": duration * timestamp_scale / 1000000000}
+
+
+def read_matroska_tracks(video, start: int, end: int) -> dict:
+    """Read the CodecID and the dimensions of the first video track.
+
+    Args:
+        video: video file opened in binary mode.
+        start (int): byte offset of the Tracks data.
+        end (int): byte offset where the Tracks element ends.
+
+    Returns:
+        Dictionary with the 'CodecID', 'ImageWidth', and 'ImageHeight'
+        of the first video track. Empty if there is no video track.
+    """
+    for entry_id, entry_data, entry_end in iter_elements(video, start, end):
+        if entry_id != MKV_TRACK_ENTRY:
+            continue
+        track_type = None
+        track = {}
+        for child_id, child_data, child_end in iter_elements(video, entry_data, entry_end):
+            video.seek(child_data)
+            if child_id == MKV_TRACK_TYPE:
+                track_type = int.from_bytes(video.read(child_end - child_data), "big")
+            elif child_id == MKV_CODEC_ID:
+                track["CodecID"] = read_ascii(video, child_end - child_data)
+            elif child_id == MKV_VIDEO:
+                for video_id, video_data, video_end in iter_elements(video, child_data, child_end):
+                    video.seek(video_data)
+                    if video_id == MKV_PIXEL_WIDTH:
+                        track["ImageWidth"] = int.from_bytes(video.read(video_end - video_data), "big")
+                    elif video_id == MKV_PIXEL_HEIGHT:
+                        track["ImageHeight"] = int.from_bytes(video.read(video_end - video_data), "big")
+        if track_type == MKV_VIDEO_TRACK:
+            return track
+    return {}
@@ -0,0 +1,274 @@
+"""Contains the progress sampling and throughput history of transcoding jobs."""
+
+import logging
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+from ffmpeg import FFmpeg, Progress
+
+from h265_transcoder import config, metrics
+from h265_transcoder.interfaces import DatabaseInterface
+
+logger = logging.getLogger("app")
+PROGRESS_INTERVAL = os.getenv("PROGRESS_INTERVAL", "5")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class ProgressSampler:
+    """Sample the progress of the ffmpeg processes of a transcoding job.
+
+    Every progress event is kept in a small ring buffer, but the progress
+    is only logged, and the job summary only queued for the 'job_stats'
+    table, once per interval. Segmented jobs watch one ffmpeg process
+    per segment, and their frames, media time, and CPU time are summed. Their
+    peak memory is the highest sum of the peaks of the processes running at
+    the same time, so segments which ran one after another are not added up.
+    """
+    def __init__(self, sqlite_db: str, path: str, filename: str, transcode: str,
+                 preset: str | None = None, paused_seconds=None) -> None:
+        """Setup the samples and the job summary.
+
+        Args:
+            sqlite_db (str): SQLite database file to use.
+            path (str): the absolute path to the video file.
+            filename (str): the video filename.
+            transcode (str): "Y" to transcode, or "R" to remux the video file.
+            preset (str): x265 preset of the job. None is the x265 default preset.
+            paused_seconds: callable returning the seconds the job was stopped by the governor,
+                which are left out of the wall time. None when the job is never stopped.
+        """
+        self.sqlite_db = sqlite_db
+        self.path = path
+        self.filename = filename
+        self.transcode = transcode
+        self.preset = preset
+        self.paused_seconds = paused_seconds
+        self.interval = get_progress_interval()
+        self.samples = deque(maxlen=config.progress_samples)
+        self.started = time.time_ns()
+        self.start_time = time.monotonic()
+        self.last_emit = self.start_time
+        self.frames = {}
+        self.media_seconds = {}
+        self.cpu_seconds = {}
+        self.running_rss = {}
+        self.peak_rss = 0
+        self.bytes_in = get_size(f"{path}/{filename}")
+        self.bytes_out = 0
+
+    def watch(self, ffmpeg: FFmpeg) -> None:
+        """Sample the progress events of an ffmpeg process.
+
+        Args:
+            ffmpeg (FFmpeg): ffmpeg command to watch, before it is executed.
+        """
+        @ffmpeg.on("progress")
+        def on_progress(progress: Progress):
+            self.sample(ffmpeg, progress)
+
+    def sample(self, ffmpeg: FFmpeg, progress: Progress) -> None:
+        """Record a progress event, and emit the progress once per interval.
+
+        Args:
+            ffmpeg (FFmpeg): the ffmpeg command which sent the progress.
+            progress (Progress): the progress event.
+        """
+        now = time.monotonic()
+        process = getattr(ffmpeg, "_process", None)
+        # The ffmpeg objects of finished segments are not kept, so their ids are reused
+        process_key = id(ffmpeg) if process is None else process.pid
+        self.frames[process_key] = progress.frame
+        self.media_seconds[process_key] = progress.time.total_seconds()
+        self.samples.append((now, progress.fps, progress.speed, progress.bitrate))
+        if process is not None:
+            cpu_seconds = get_cpu_seconds(process.pid)
+            if cpu_seconds is not None:
+                self.cpu_seconds[process.pid] = cpu_seconds
+            peak_rss = get_peak_rss(process.pid)
+            if peak_rss is not None:
+                self.running_rss[process.pid] = (process, peak_rss)
+            for pid, (running_process, _peak_rss) in list(self.running_rss.items()):
+                if running_process.returncode is not None:
+                    del self.running_rss[pid]
+            self.peak_rss = max(self.peak_rss, sum(peak_rss for _process, peak_rss in self.running_rss.values()))
+        if now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+        progress_bar = (
+            f"File={self.filename} "
+            f"Frame={sum(self.frames.values())} "
+            f"FPS={progress.fps:.0f} "
+            f"Size={progress.size}B "
+            f"Time={format_seconds(progress.time.total_seconds())} "
+            f"Bitrate={progress.bitrate}kb/s "
+            f"Speed={progress.speed}x"
+        )
+        logger.transcode(progress_bar)
+        self.save("active")
+
+    def summary(self) -> dict:
+        """Summarize the job throughput so far.
+
+        Returns:
+            Dictionary of the 'job_stats' columns.
+        """
+        wall_time = time.monotonic() - self.start_time
+        if self.paused_seconds:
+            wall_time = max(0.0, wall_time - self.paused_seconds())
+        frames = sum(self.frames.values())
+        media_seconds = sum(self.media_seconds.values())
+        bitrates = [sample[3] for sample in self.samples if sample[3] > 0]
+        return {
+            "wall_time": wall_time,
+            "cpu_time": sum(self.cpu_seconds.values()),
+            "peak_rss": self.peak_rss or None,
+            "frames": frames,
+            "avg_fps": frames / wall_time if wall_time else None,
+            "avg_speed": media_seconds / wall_time if wall_time else None,
+            "avg_bitrate": sum(bitrates) / len(bitrates) if bitrates else None,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out
+        }
+
+    def save(self, status: str) -> None:
+        """Queue the job summary for the 'job_stats' table.
+
+        Args:
+            status (str): status of the job.
+        """
+        job_stats_statement = """INSERT INTO job_stats (
+                                    path, filename, started, transcode, preset, status,
+                                    wall_time, cpu_time, peak_rss, frames, avg_fps,
+                                    avg_speed, avg_bitrate, bytes_in, bytes_out)
+                                VALUES (
+                                    :path, :filename, :started, :transcode, :preset, :status,
+                                    :wall_time, :cpu_time, :peak_rss, :frames, :avg_fps,
+                                    :avg_speed, :avg_bitrate, :bytes_in, :bytes_out)
+                                ON CONFLICT (path, filename, started) DO UPDATE SET
+                                    status = excluded.status,
+                                    wall_time = excluded.wall_time,
+                                    cpu_time = excluded.cpu_time,
+                                    peak_rss = excluded.peak_rss,
+                                    frames = excluded.frames,
+                                    avg_fps = excluded.avg_fps,
+                                    avg_speed = excluded.avg_speed,
+                                    avg_bitrate = excluded.avg_bitrate,
+                                    bytes_in = excluded.bytes_in,
+                                    bytes_out = excluded.bytes_out ;
+        """
+        job_stats = {
+            "path": self.path,
+            "filename": self.filename,
+            "started": self.started,
+            "transcode": self.transcode,
+            "preset": self.preset,
+            "status": status,
+            **self.summary()
+        }
+        DatabaseInterface(self.sqlite_db).queue_write(job_stats_statement, job_stats,
+                                                      (self.path, self.filename, self.started))
+
+    def finish(self, status: str, output_file: str) -> None:
+        """Save the final job summary.
+
+        Args:
+            status (str): "done" or "failed".
+            output_file (str): the transcoded video file.
+        """
+        self.bytes_out = get_size(output_file)
+        self.save(status)
+        job_stats = self.summary()
+        metrics.encode_seconds.observe(job_stats["wall_time"], transcode=self.transcode, status=status)
+        metrics.encode_cpu_seconds.observe(job_stats["cpu_time"], transcode=self.transcode, status=status)
+        metrics.files_total.inc(stage="transcode", status=status)
+        if status == "done":
+            metrics.encode_bytes_total.inc(self.bytes_in, direction="in")
+            metrics.encode_bytes_total.inc(self.bytes_out, direction="out")
+        stats_msg = (f"'{self.filename}' {status} in {format_seconds(job_stats['wall_time'])}, "
+                     f"{job_stats['cpu_time']:.1f}s CPU time, "
+                     f"{job_stats['avg_fps'] or 0:.1f} average FPS.")
+        logger.debug(stats_msg)
+
+
+def format_seconds(seconds: float) -> str:
+    """Format seconds as 'HH:MM:SS.ss'.
+
+    Args:
+        seconds (float): amount of seconds.
+
+    Returns:
+        Formatted time.
+    """
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:05.2f}"
+
+
+def get_cpu_seconds(pid: int) -> float | None:
+    """Get the CPU time used by a process so far.
+
+    Args:
+        pid (int): process ID.
+
+    Returns:
+        User and system CPU time in seconds, or None if the process has ended.
+    """
+    try:
+        with Path(f"/proc/{pid}/stat").open(mode="rb") as proc_stat:
+            stat_fields = proc_stat.read().rsplit(b")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    # utime and stime are the 14th and 15th fields, after the pid and command
+    return (int(stat_fields[11]) + int(stat_fields[12])) / CLOCK_TICKS
+
+
+def get_peak_rss(pid: int) -> int | None:
+    """Get the peak resident memory of a process so far.
+
+    Args:
+        pid (int): process ID.
+
+    Returns:
+        Peak resident memory (VmHWM) in bytes, or None if the process has ended.
+    """
+    try:
+        with Path(f"/proc/{pid}/status").open(mode="rb") as proc_status:
+            for status_line in proc_status:
+                if status_line.startswith(b"VmHWM:"):
+                    # The value is in kB
+                    return int(status_line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        return None
+    return None
+
+
+def get_progress_interval() -> float:
+    """Get the interval between progress log messages.
+
+    Returns:
+        Interval in seconds.
+    """
+    try:
+        interval = float(PROGRESS_INTERVAL)
+    except ValueError:
+        value_error_msg = f"PROGRESS_INTERVAL is not a number. {PROGRESS_INTERVAL=}."
+        logger.error(value_error_msg)
+        interval = 5.0
+    return max(0.0, interval)
+
+
+def get_size(video_file: str) -> int:
+    """Get the size of a video file.
+
+    Args:
+        video_file (str): the video file.
+
+    Returns:
+        Size in bytes, or 0 if the file is not found.
+    """
+    try:
+        return Path(video_file).stat().st_size
+    except OSError:
+        return 0
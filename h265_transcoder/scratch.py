@@ -0,0 +1,314 @@
+"""Contains the local scratch staging of video files on network storage."""
+
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from h265_transcoder import config
+
+logger = logging.getLogger("app")
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", "")
+SCRATCH_BUDGET = os.getenv("SCRATCH_BUDGET", "0")
+
+
+class ScratchSpace:
+    """Stage the video files on local disk while they are transcoded.
+
+    The next queued video file is prefetched with large sequential reads
+    while the current one is transcoded, and ffmpeg writes its output
+    locally, so the network share only sees two streaming copies. Outputs
+    are copied back by a background thread to a hidden file next to the
+    original, then renamed into place. Each staged video file reserves
+    twice its size from the budget, for the input and the output.
+    """
+    def __init__(self, scratch_dir: str, budget: int) -> None:
+        """Setup the scratch directory, removing files left by an earlier run.
+
+        Args:
+            scratch_dir (str): local directory for the staged video files.
+            budget (int): maximum bytes of staged video files.
+        """
+        self.staged_dir = Path(scratch_dir) / "staged"
+        shutil.rmtree(self.staged_dir, ignore_errors=True)
+        self.staged_dir.mkdir(parents=True)
+        self.budget = budget
+        self.reserved = 0
+        self.copying = 0
+        self.condition = threading.Condition()
+        self.staged = {}
+        self.prefetching = None
+        self.prefetch_cancel = threading.Event()
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.copy_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="copy-back")
+        scratch_msg = f"Staging video files in '{scratch_dir}', with a budget of {budget:,} bytes."
+        logger.info(scratch_msg)
+
+    def __enter__(self) -> "ScratchSpace":
+        """Returns the scratch space."""
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        """Wait for the outputs to be copied back, and remove the unused prefetches."""
+        self.prefetch_executor.shutdown(wait=True)
+        self.copy_executor.shutdown(wait=True)
+        for input_file in list(self.staged):
+            self.unstage(input_file, keep_output=False)
+
+    def get_stage_dir(self, input_file: str) -> Path:
+        """Get the local directory of a staged video file.
+
+        The directory is named after the original video file,
+        so an interrupted segmented transcoding resumes.
+
+        Args:
+            input_file (str): the original video file.
+
+        Returns:
+            Path of the directory.
+        """
+        return self.staged_dir / hashlib.sha1(input_file.encode("utf-8")).hexdigest()[:16]
+
+    def reserve(self, size: int, wait: bool) -> bool:
+        """Reserve space from the budget.
+
+        Args:
+            size (int): bytes to reserve.
+            wait (bool): wait for the running copies to release space.
+
+        Returns:
+            True if the space was reserved.
+        """
+        with self.condition:
+            while self.reserved + size > self.budget:
+                if not wait or not self.copying:
+                    return False
+                self.condition.wait()
+            self.reserved += size
+            return True
+
+    def release(self, size: int) -> None:
+        """Release space to the budget.
+
+        Args:
+            size (int): bytes to release.
+        """
+        with self.condition:
+            self.reserved = max(0, self.reserved - size)
+            self.condition.notify_all()
+
+    def prefetch(self, input_file: str | None, active_files: set) -> None:
+        """Copy the next video file to the scratch directory in the background.
+
+        Only one video file is prefetched ahead of the workers, and none when
+        the budget is full. A prefetch which is no longer the next video file,
+        and was not claimed by this worker, is discarded, such as when another
+        host claimed it, or the memory budget or the batch end skip it.
+
+        Args:
+            input_file (str): the next video file to claim. None when no video file is next.
+            active_files (set): the video files claimed by this worker, which may be staging.
+        """
+        with self.condition:
+            prefetching = self.prefetching
+        if prefetching is not None and prefetching != input_file and prefetching not in active_files:
+            self.discard_prefetch()
+        with self.condition:
+            if input_file is None or self.prefetching is not None or input_file in self.staged:
+                return
+        try:
+            input_stat = os.stat(input_file)
+        except OSError:
+            return
+        if not self.reserve(input_stat.st_size * 2, wait=False):
+            return
+        local_input = str(self.get_stage_dir(input_file) / Path(input_file).name)
+        self.prefetch_cancel.clear()
+        copy_job = self.prefetch_executor.submit(copy_file, input_file, local_input, False, self.prefetch_cancel)
+        with self.condition:
+            self.staged[input_file] = (copy_job, input_stat.st_size, input_stat.st_mtime_ns)
+            self.prefetching = input_file
+        prefetch_msg = f"Prefetching '{input_file}'."
+        logger.debug(prefetch_msg)
+
+    def discard_prefetch(self) -> None:
+        """Stop the running prefetch, remove its copy, and release its space."""
+        with self.condition:
+            input_file = self.prefetching
+            if input_file is None:
+                return
+            self.prefetch_cancel.set()
+        discard_msg = f"Discarding the prefetch of '{input_file}', which is no longer next."
+        logger.debug(discard_msg)
+        self.unstage(input_file, keep_output=False)
+
+    def stage(self, input_file: str, output_file: str) -> tuple | None:
+        """Stage a video file for transcoding.
+
+        The prefetched copy is used when the original has not changed since,
+        otherwise the video file is copied now.
+
+        Args:
+            input_file (str): the original video file.
+            output_file (str): the output file on the network share.
+
+        Returns:
+            Tuple of the local input file and the local output file,
+            or None to transcode on the network share.
+        """
+        stage_dir = self.get_stage_dir(input_file)
+        local_input = str(stage_dir / Path(input_file).name)
+        local_output = str(stage_dir / Path(output_file).name)
+        try:
+            input_stat = os.stat(input_file)
+        except OSError:
+            return None
+        with self.condition:
+            if self.prefetching == input_file:
+                self.prefetching = None
+            staged = self.staged.get(input_file)
+        if staged:
+            copy_job, staged_size, staged_mtime_ns = staged
+            if copy_job.exception() is None and (staged_size, staged_mtime_ns) == (input_stat.st_size,
+                                                                                  input_stat.st_mtime_ns):
+                stage_msg = f"Using the prefetched copy of '{input_file}'."
+                logger.debug(stage_msg)
+                return local_input, local_output
+            self.unstage(input_file, keep_output=False)
+
+        if not self.reserve(input_stat.st_size * 2, wait=True):
+            budget_msg = f"Scratch budget is full. Transcoding '{input_file}' on the network share."
+            logger.info(budget_msg)
+            return None
+        copy_job = Future()
+        with self.condition:
+            self.staged[input_file] = (copy_job, input_stat.st_size, input_stat.st_mtime_ns)
+        try:
+            copy_file(input_file, local_input, False)
+        except OSError as copy_err:
+            copy_job.set_exception(copy_err)
+            self.unstage(input_file, keep_output=False)
+            copy_err_msg = f"Unable to stage '{input_file}': {copy_err}. Transcoding on the network share."
+            logger.warning(copy_err_msg)
+            return None
+        copy_job.set_result(None)
+        return local_input, local_output
+
+    def unstage(self, input_file: str, keep_output: bool) -> None:
+        """Remove the local copy of a video file, and release its space.
+
+        Args:
+            input_file (str): the original video file.
+            keep_output (bool): keep the local output, and its space, for 'copy_back'.
+        """
+        with self.condition:
+            staged = self.staged.pop(input_file, None)
+            if self.prefetching == input_file:
+                self.prefetching = None
+        if staged is None:
+            return
+        copy_job, staged_size, _staged_mtime_ns = staged
+        copy_job.exception()
+        stage_dir = self.get_stage_dir(input_file)
+        if keep_output:
+            (stage_dir / Path(input_file).name).unlink(missing_ok=True)
+            self.release(staged_size)
+        else:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            self.release(staged_size * 2)
+
+    def copy_back(self, local_output: str, output_file: str, input_size: int, on_copied) -> None:
+        """Copy an output file back to the network share in the background.
+
+        Args:
+            local_output (str): the local output file.
+            output_file (str): the output file on the network share.
+            input_size (int): size of the original video file, reserved for the output.
+            on_copied: callable accepting True when the output was copied, or False.
+        """
+        with self.condition:
+            self.copying += 1
+        self.copy_executor.submit(self.run_copy_back, local_output, output_file, input_size, on_copied)
+
+    def run_copy_back(self, local_output: str, output_file: str, input_size: int, on_copied) -> None:
+        """Copy an output file back to the network share, then release its space.
+
+        The output is copied to a hidden file next to the original, synced,
+        and renamed into place, so the share never has a partial output.
+
+        Args:
+            local_output (str): the local output file.
+            output_file (str): the output file on the network share.
+            input_size (int): size of the original video file, reserved for the output.
+            on_copied: callable accepting True when the output was copied, or False.
+        """
+        partial_file = Path(output_file).with_name(f".{Path(output_file).name}.partial")
+        try:
+            copy_file(local_output, str(partial_file), True)
+            partial_file.replace(output_file)
+        except OSError as copy_err:
+            copied = False
+            copy_err_msg = f"Unable to copy '{local_output}' to '{output_file}': {copy_err}"
+            logger.error(copy_err_msg)
+            partial_file.unlink(missing_ok=True)
+        else:
+            copied = True
+            copied_msg = f"Copied '{local_output}' to '{output_file}'."
+            logger.debug(copied_msg)
+        finally:
+            shutil.rmtree(Path(local_output).parent, ignore_errors=True)
+            self.release(input_size)
+            with self.condition:
+                self.copying -= 1
+                self.condition.notify_all()
+        on_copied(copied)
+
+
+def copy_file(source_file: str, destination_file: str, sync: bool,
+              cancel_event: threading.Event | None = None) -> None:
+    """Copy a file with large sequential reads, keeping its modification time.
+
+    Args:
+        source_file (str): file to copy.
+        destination_file (str): copy of the file.
+        sync (bool): flush the copy to disk before returning.
+        cancel_event (threading.Event): stop the copy with InterruptedError once set. None copies it all.
+    """
+    Path(destination_file).parent.mkdir(parents=True, exist_ok=True)
+    buffer = bytearray(config.scratch_buffer_size)
+    with open(source_file, "rb") as source, open(destination_file, "wb") as destination:
+        with contextlib.suppress(OSError, AttributeError):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while read_size := source.readinto(buffer):
+            if cancel_event is not None and cancel_event.is_set():
+                raise InterruptedError(f"Copy of '{source_file}' was cancelled.")
+            destination.write(memoryview(buffer)[:read_size])
+        if sync:
+            destination.flush()
+            os.fsync(destination.fileno())
+    source_stat = os.stat(source_file)
+    os.utime(destination_file, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+
+def get_scratch_space():
+    """Get the scratch space from SCRATCH_DIR and SCRATCH_BUDGET.
+
+    Returns:
+        ScratchSpace, or a null context when SCRATCH_DIR is not set.
+    """
+    if not SCRATCH_DIR:
+        return contextlib.nullcontext()
+    try:
+        budget = int(float(SCRATCH_BUDGET) * 1024 ** 3)
+    except ValueError:
+        value_error_msg = f"SCRATCH_BUDGET is not a number. {SCRATCH_BUDGET=}."
+        logger.error(value_error_msg)
+        budget = 0
+    if budget <= 0:
+        Path(SCRATCH_DIR).mkdir(parents=True, exist_ok=True)
+        budget = int(shutil.disk_usage(SCRATCH_DIR).free * config.scratch_free_fraction)
+    return ScratchSpace(SCRATCH_DIR, budget)
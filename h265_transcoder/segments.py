@@ -0,0 +1,280 @@
+"""Contains the keyframe-segmented transcoding of long video files."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ffmpeg import FFmpeg, FFmpegError
+
+from h265_transcoder import config, governor, workers
+from h265_transcoder.progress import ProgressSampler
+
+logger = logging.getLogger("app")
+SEGMENTS = os.getenv("SEGMENTS", "0")
+SEGMENT_MIN_DURATION = os.getenv("SEGMENT_MIN_DURATION", "1800")
+
+
+class SegmentedTranscode:
+    """Transcode a long video file in segments, encoded in parallel.
+
+    The video stream is split at keyframes with stream copy, and the
+    segments are encoded by separate ffmpeg processes with the same x265
+    settings. The encoded segments are joined with the concat demuxer,
+    and the other streams are copied once from the original video file.
+    """
+    def __init__(self, input_file: str, output_file: str, segment_count: int,
+                 cpus: list | None = None, preset: str | None = None,
+                 resource_governor: governor.Governor | None = None) -> None:
+        """Setup the working directory for the segments of the video file.
+
+        The working directory is named after the video file and its
+        fingerprint, so an interrupted transcoding resumes with the
+        segments which were already encoded.
+
+        Args:
+            input_file (str): the video file to transcode.
+            output_file (str): the transcoded MP4 file.
+            segment_count (int): number of segments to split the video file into.
+            cpus (list): CPUs shared by the segment encoders. None uses all CPUs.
+            preset (str): x265 preset of the segment encoders. None is the x265 default preset.
+            resource_governor (Governor): governor stopping the segment encoders while throttled.
+        """
+        self.input_file = input_file
+        self.output_file = output_file
+        self.segment_count = segment_count
+        self.cpus = cpus or sorted(os.sched_getaffinity(0))
+        self.preset = preset
+        self.governor = resource_governor
+        input_stat = Path(input_file).stat()
+        fingerprint = f"{input_file}:{input_stat.st_size}:{input_stat.st_mtime_ns}"
+        work_name = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+        self.work_dir = Path(config.segment_dir) / work_name
+
+    def transcode(self, output_options: dict, stream_maps: list,
+                  sampler: ProgressSampler | None = None) -> None:
+        """Split, encode, and join the video file.
+
+        Args:
+            output_options (dict): ffmpeg output options for the joined MP4 file,
+                except the stream maps, and the video and audio codecs.
+            stream_maps (list): ffmpeg maps of the streams to keep from the original video file, as input 0.
+                The first is the video stream which is encoded.
+            sampler (ProgressSampler): progress sampler watching each segment encoder.
+
+        Raises:
+            FFmpegError: when any of the ffmpeg steps fail.
+                The finished segments are kept for the next attempt.
+        """
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        source_segments = self.split()
+        segment_cpus = workers.get_cpu_slots(min(len(source_segments), len(self.cpus)))
+        with ThreadPoolExecutor(max_workers=len(segment_cpus),
+                                thread_name_prefix="segment") as executor:
+            encode_jobs = []
+            for index, source_segment in enumerate(source_segments):
+                cpus = segment_cpus[index % len(segment_cpus)]
+                encode_jobs.append(executor.submit(self.encode_segment, source_segment,
+                                                   cpus, sampler))
+            encoded_segments = [encode_job.result() for encode_job in encode_jobs]
+        self.join(encoded_segments, stream_maps, output_options)
+        self.remove()
+
+    def remove(self) -> None:
+        """Remove the working directory, and the segments in it."""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        logger.debug("Removed the segments working directory.")
+
+    def split(self) -> list:
+        """Split the video stream at keyframes into segments with stream copy.
+
+        Returns:
+            Sorted list of the source segment files.
+        """
+        split_done = self.work_dir / "split.done"
+        if not split_done.exists():
+            duration = get_duration(self.input_file)
+            segment_time = max(1.0, duration / self.segment_count)
+            split_msg = f"Splitting '{self.input_file}' into {self.segment_count} segments."
+            logger.info(split_msg)
+            for stale_segment in self.work_dir.glob("source_*.mkv"):
+                stale_segment.unlink()
+            ffmpeg = (
+                FFmpeg()
+                .option("y")
+                .input(self.input_file)
+                .output(
+                    str(self.work_dir / "source_%03d.mkv"),
+                    {
+                        "map": "0:v:0",
+                        "codec:v": "copy",
+                        "f": "segment",
+                        "segment_time": f"{segment_time:.3f}",
+                        "reset_timestamps": 1
+                    }
+                )
+            )
+            ffmpeg.execute()
+            split_done.touch()
+        return sorted(self.work_dir.glob("source_*.mkv"))
+
+    def encode_segment(self, source_segment: Path, cpus: list,
+                       sampler: ProgressSampler | None = None) -> Path:
+        """Encode a source segment, unless it was encoded by a previous attempt.
+
+        Args:
+            source_segment (Path): the source segment file.
+            cpus (list): CPUs for the x265 thread pool of the segment.
+            sampler (ProgressSampler): progress sampler watching the segment encoder.
+
+        Returns:
+            The encoded segment file.
+        """
+        encoded_segment = source_segment.with_name(source_segment.name.replace("source_", "encoded_"))
+        if encoded_segment.exists():
+            resume_msg = f"Segment '{encoded_segment.name}' is already encoded. Skipping."
+            logger.info(resume_msg)
+            return encoded_segment
+        partial_segment = encoded_segment.with_suffix(".part.mkv")
+        if workers.AFFINITY:
+            os.sched_setaffinity(0, cpus)
+        segment_options = {
+            "codec:v": "libx265",
+            "x265-params": workers.get_x265_params(cpus),
+            "an": None
+        }
+        if self.preset:
+            segment_options["preset"] = self.preset
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .input(str(source_segment))
+            .output(str(partial_segment), segment_options)
+        )
+        if sampler:
+            sampler.watch(ffmpeg)
+        if self.governor:
+            self.governor.watch(ffmpeg, self.input_file)
+        encode_msg = f"Encoding segment '{source_segment.name}' of '{self.input_file}'."
+        logger.info(encode_msg)
+        ffmpeg.execute()
+        partial_segment.replace(encoded_segment)
+        return encoded_segment
+
+    def join(self, encoded_segments: list, stream_maps: list, output_options: dict) -> None:
+        """Join the encoded segments, and copy the other streams from the original video file.
+
+        Args:
+            encoded_segments (list): the encoded segment files, in order.
+            stream_maps (list): ffmpeg maps of the streams to keep from the original video file, as input 0.
+                The first is the video stream, which is replaced by the joined segments.
+            output_options (dict): ffmpeg output options for the joined MP4 file.
+        """
+        # The original video file is the second input of the join
+        join_maps = ["0:v:0", *(f"1:{stream_map.removeprefix('0:')}" for stream_map in stream_maps[1:])]
+        concat_list = self.work_dir / "concat.txt"
+        with concat_list.open(mode="w", encoding="utf-8") as concat_file:
+            for encoded_segment in encoded_segments:
+                concat_file.write(f"file '{encoded_segment.name}'\n")
+        join_msg = f"Joining {len(encoded_segments)} segments into '{self.output_file}'."
+        logger.info(join_msg)
+        ffmpeg = (
+            FFmpeg()
+            .option("y")
+            .input(str(concat_list), {"f": "concat", "safe": 0})
+            .input(self.input_file)
+            .output(
+                self.output_file,
+                {
+                    "map": join_maps,
+                    "codec:v": "copy",
+                    "codec:a": "copy",
+                    **output_options
+                }
+            )
+        )
+        ffmpeg.execute()
+
+
+def get_duration(video_file: str) -> float:
+    """Get the duration of the video file with ffprobe.
+
+    Args:
+        video_file (str): the video file.
+
+    Returns:
+        Duration in seconds.
+    """
+    ffprobe = (
+        FFmpeg(executable="ffprobe")
+        .input(video_file, {"print_format": "json", "show_format": None})
+    )
+    probe_output = json.loads(ffprobe.execute())
+    try:
+        return float(probe_output["format"]["duration"])
+    except (KeyError, ValueError) as duration_err:
+        raise FFmpegError(f"No duration found for '{video_file}'.", ffprobe.arguments) from duration_err
+
+
+def prune_segments() -> int:
+    """Remove the segment working directories which were not used for 'segment_max_age' seconds in the config.
+
+    A working directory is named after the fingerprint of its video file,
+    so the segments of a video file which changed, was removed, or is
+    not retried are never resumed.
+
+    Returns:
+        Amount of working directories removed.
+    """
+    segment_dir = Path(config.segment_dir)
+    if not segment_dir.is_dir():
+        return 0
+    oldest_mtime = time.time() - config.segment_max_age
+    pruned_count = 0
+    for work_dir in segment_dir.iterdir():
+        try:
+            if not work_dir.is_dir() or work_dir.stat().st_mtime >= oldest_mtime:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(work_dir, ignore_errors=True)
+        pruned_count += 1
+    if pruned_count:
+        pruned_msg = f"Removed {pruned_count} stale segment working directories."
+        logger.info(pruned_msg)
+    return pruned_count
+
+
+def get_segment_count(video_file: str) -> int:
+    """Get the number of segments to split the video file into.
+
+    Video files shorter than SEGMENT_MIN_DURATION are not split.
+
+    Args:
+        video_file (str): the video file.
+
+    Returns:
+        Number of segments. 1 transcodes the video file without splitting.
+    """
+    try:
+        segment_count = int(SEGMENTS)
+        min_duration = float(SEGMENT_MIN_DURATION)
+    except ValueError:
+        value_error_msg = f"SEGMENTS or SEGMENT_MIN_DURATION is not a number. {SEGMENTS=}, {SEGMENT_MIN_DURATION=}."
+        logger.error(value_error_msg)
+        return 1
+    if segment_count < 2:
+        return 1
+    try:
+        duration = get_duration(video_file)
+    except FFmpegError:
+        duration_err_msg = f"Unable to get the duration of '{video_file}'. Transcoding without segments."
+        logger.warning(duration_err_msg)
+        return 1
+    if duration < min_duration:
+        return 1
+    return segment_count
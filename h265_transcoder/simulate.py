@@ -0,0 +1,408 @@
+"""Contains the simulation backend, for testing the queue at library scale.
+
+With SIMULATE, ffmpeg, exiftool, the in-process MP4 and Matroska readers,
+and the scratch staging copies are replaced by deterministic fakes,
+so scans and transcoding of a synthetic library of sparse files take
+minutes instead of hours. The same video file always gets the same
+metadata, result, and output size, so runs can be compared.
+
+Usage:
+    python -m h265_transcoder.simulate DIRECTORY [--files 100000] [--per-directory 50]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from ffmpeg import FFmpegError, Progress
+
+from h265_transcoder import config
+
+logger = logging.getLogger("app")
+SIMULATE = bool(os.getenv("SIMULATE", "False").lower() == "true")
+SIMULATE_FAILURE_RATE = os.getenv("SIMULATE_FAILURE_RATE", "0.05")
+SIMULATE_LATENCY = os.getenv("SIMULATE_LATENCY", "0.1")
+SIMULATE_OUTPUT_RATIO = os.getenv("SIMULATE_OUTPUT_RATIO", "0.5")
+# Written at the start of the simulated output files, which are reported as HVC1
+OUTPUT_MARKER = b"SIMULATED-HVC1\n"
+# stderr of a simulated corrupt input, which is classified as the corrupt failure class
+CORRUPT_STDERR = "[h264 @ 0x5581c3a0] error while decoding MB 41 20, bytes left 1337"
+RESOLUTIONS = ((1280, 720), (1920, 1080), (3840, 2160))
+START_TIME = time.monotonic()
+
+
+class FakeFFmpeg:
+    """Deterministic stand-in for the python-ffmpeg 'FFmpeg' command.
+
+    Each run waits for SIMULATE_LATENCY, sending progress events meanwhile,
+    then writes a sparse output file of SIMULATE_OUTPUT_RATIO times the
+    input size. x265 encodes fail at SIMULATE_FAILURE_RATE, half of them
+    as corrupt input which the tolerant fallback fixes.
+    """
+    def __init__(self, executable: str = "ffmpeg") -> None:
+        """Setup the command arguments and the event handlers."""
+        self.executable = executable
+        self.arguments = [executable]
+        self.inputs = []
+        self.input_options = []
+        self.outputs = []
+        self.handlers = {}
+
+    def option(self, key: str, value=None) -> "FakeFFmpeg":
+        """Add a global option."""
+        self.arguments.extend(format_option(key, value))
+        return self
+
+    def input(self, url: str, options: dict | None = None, **kwargs) -> "FakeFFmpeg":
+        """Add an input file."""
+        input_options = {**(options or {}), **kwargs}
+        for key, value in input_options.items():
+            self.arguments.extend(format_option(key, value))
+        self.arguments.extend(["-i", str(url)])
+        self.inputs.append(str(url))
+        self.input_options.append(input_options)
+        return self
+
+    def output(self, url: str, options: dict | None = None, **kwargs) -> "FakeFFmpeg":
+        """Add an output file."""
+        output_options = {**(options or {}), **kwargs}
+        for key, value in output_options.items():
+            self.arguments.extend(format_option(key, value))
+        self.arguments.append(str(url))
+        self.outputs.append((str(url), output_options))
+        return self
+
+    def on(self, event: str, handler=None):
+        """Add an event handler, directly or as a decorator."""
+        def add_handler(event_handler):
+            self.handlers.setdefault(event, []).append(event_handler)
+            return event_handler
+        if handler is None:
+            return add_handler
+        return add_handler(handler)
+
+    def emit(self, event: str, *args) -> None:
+        """Call the handlers of an event."""
+        for handler in self.handlers.get(event, []):
+            handler(*args)
+
+    def execute(self) -> bytes:
+        """Simulate the command.
+
+        Returns:
+            stdout of the command. ffprobe returns the format duration as JSON.
+        """
+        self.emit("start", self.arguments)
+        input_file = self.inputs[0]
+        if self.executable == "ffprobe":
+            probe_output = {"format": {"duration": str(get_duration(input_file))}}
+            return json.dumps(probe_output).encode("utf-8")
+
+        latency = get_setting(SIMULATE_LATENCY, "SIMULATE_LATENCY", 0.1)
+        duration = get_duration(input_file)
+        # Sample encodes read a part of the input, and write a matching part of the output
+        sample_fraction = 1.0
+        if "t" in self.input_options[0]:
+            sample_fraction = min(1.0, float(self.input_options[0]["t"]) / duration)
+            duration *= sample_fraction
+        progress_events = config.simulate_progress_events
+        for progress_event in range(1, progress_events + 1):
+            time.sleep(latency / progress_events)
+            media_seconds = duration * progress_event / progress_events
+            self.emit("progress", Progress(frame=int(media_seconds * 24),
+                                           fps=24 * duration / latency if latency else 0.0,
+                                           size=0,
+                                           time=timedelta(seconds=media_seconds),
+                                           bitrate=0.0,
+                                           speed=duration / latency if latency else 0.0))
+
+        output_file, output_options = self.outputs[0]
+        failure_rate = get_setting(SIMULATE_FAILURE_RATE, "SIMULATE_FAILURE_RATE", 0.05)
+        # Only the x265 encodes fail, not the pre-flight checks, remuxes, splits, or joins
+        if output_options.get("codec:v") == "libx265" and get_fraction(f"fail:{input_file}") < failure_rate:
+            corrupt = get_fraction(f"corrupt:{input_file}") < 0.5
+            if not (corrupt and "err_detect" in self.input_options[0]):
+                stderr_line = CORRUPT_STDERR if corrupt else "Simulated encoder failure."
+                self.emit("stderr", stderr_line)
+                raise FFmpegError(stderr_line, self.arguments)
+
+        if output_options.get("f") == "segment":
+            output_file = output_file.replace("%03d", "000")
+        input_size = sum(get_size(input_url) for input_url in self.inputs) * sample_fraction
+        output_ratio = get_setting(SIMULATE_OUTPUT_RATIO, "SIMULATE_OUTPUT_RATIO", 0.5)
+        write_sparse_file(Path(output_file), int(input_size * output_ratio), OUTPUT_MARKER)
+        self.emit("completed")
+        return b""
+
+
+class FakeExifTool:
+    """Deterministic stand-in for the 'ExifToolInterface' session.
+
+    Simulated output files report the HVC1 Compressor ID. Other video
+    files get a codec, duration, and resolution derived from their path.
+    """
+    def __init__(self, executable: str = config.exiftool_path) -> None:
+        """Setup the queued writes. There is no process to start."""
+        self.executable = executable
+        self.write_queue = []
+
+    def __enter__(self) -> "FakeExifTool":
+        """Returns the fake exiftool session."""
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        """Write any queued metadata."""
+        if not exception_type:
+            self.flush_writes()
+
+    def close(self) -> None:
+        """There is no process to stop."""
+
+    def read_tags(self, video_files: list, tags: list) -> dict:
+        """Read simulated tags of the video files.
+
+        Args:
+            video_files (list): video files to read.
+            tags (list): tag names to read from each video file.
+
+        Returns:
+            Dictionary of each video file to a dictionary of its tags.
+        """
+        metadata = {}
+        for video_file in video_files:
+            file_metadata = get_metadata(video_file)
+            metadata[video_file] = {
+                "SourceFile": video_file,
+                **{tag: value for tag, value in file_metadata.items() if tag in tags}
+            }
+        return metadata
+
+    def queue_write(self, video_file: str, tags: dict) -> None:
+        """Queue tags to write to a video file."""
+        self.write_queue.append((video_file, tags))
+
+    def flush_writes(self) -> dict:
+        """Simulate writing all of the queued tags.
+
+        Returns:
+            Dictionary of each video file to True if it exists.
+        """
+        write_results = {video_file: Path(video_file).exists() for video_file, _tags in self.write_queue}
+        self.write_queue.clear()
+        return write_results
+
+
+def copy_file(source_file: str, destination_file: str, sync: bool,
+              cancel_event: threading.Event | None = None) -> None:
+    """Copy a sparse file for the scratch staging, without reading its zeros.
+
+    Args:
+        source_file (str): file to copy.
+        destination_file (str): sparse copy of the file, with the same size and modification time.
+        sync (bool): unused, as the copy takes no disk space.
+        cancel_event (threading.Event): raise InterruptedError when already set.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise InterruptedError(f"Copy of '{source_file}' was cancelled.")
+    source_stat = os.stat(source_file)
+    with Path(source_file).open(mode="rb") as source:
+        header = source.read(len(OUTPUT_MARKER))
+    Path(destination_file).parent.mkdir(parents=True, exist_ok=True)
+    write_sparse_file(Path(destination_file), source_stat.st_size, header if header == OUTPUT_MARKER else b"")
+    os.utime(destination_file, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+
+def format_option(key: str, value) -> list:
+    """Format an ffmpeg option as command arguments."""
+    if value is None:
+        return [f"-{key}"]
+    if isinstance(value, list):
+        return [argument for item in value for argument in (f"-{key}", str(item))]
+    return [f"-{key}", str(value)]
+
+
+def generate_tree(root: Path, file_count: int, per_directory: int) -> None:
+    """Generate a synthetic library of sparse video files.
+
+    The files take no disk space, but have the sizes of real video files.
+    Every 10th directory is a season of MKV files.
+
+    Args:
+        root (Path): directory of the synthetic library.
+        file_count (int): amount of video files.
+        per_directory (int): amount of video files in each directory.
+    """
+    for file_index in range(file_count):
+        directory_index = file_index // per_directory
+        directory = root / f"show_{directory_index // 10:05d}" / f"season_{directory_index % 10:02d}"
+        if file_index % per_directory == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+        extension = "mkv" if directory_index % 10 == 0 else "mp4"
+        video_file = directory / f"episode_{file_index:07d}.{extension}"
+        video_size = int(200_000_000 + get_fraction(f"size:{file_index}") * 7_800_000_000)
+        write_sparse_file(video_file, video_size)
+    tree_msg = f"Generated {file_count} sparse video files in '{root}'."
+    logger.info(tree_msg)
+
+
+def get_duration(video_file: str) -> float:
+    """Get the simulated duration of a video file, between 10 and 110 minutes."""
+    return round(600 + get_fraction(f"duration:{video_file}") * 6000, 3)
+
+
+def get_fraction(key: str) -> float:
+    """Get a deterministic fraction between 0 and 1 for a key."""
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+
+
+def get_metadata(video_file: str) -> dict:
+    """Get the simulated exiftool tags of a video file.
+
+    Args:
+        video_file (str): the video file.
+
+    Returns:
+        Dictionary of the exiftool tags.
+    """
+    try:
+        with Path(video_file).open(mode="rb") as video:
+            is_output = video.read(len(OUTPUT_MARKER)) == OUTPUT_MARKER
+    except OSError:
+        return {"SourceFile": video_file, "Error": "File not found"}
+    codec_fraction = get_fraction(f"codec:{video_file}")
+    width, height = RESOLUTIONS[int(get_fraction(f"resolution:{video_file}") * len(RESOLUTIONS)) % len(RESOLUTIONS)]
+    metadata = {"Duration": get_duration(video_file), "ImageWidth": width, "ImageHeight": height}
+    if is_output:
+        metadata["CompressorID"] = "hvc1"
+    elif video_file.endswith(".mkv"):
+        metadata["DocType"] = "matroska"
+        metadata["CodecID"] = "V_MPEGH/ISO/HEVC" if codec_fraction < 0.1 else "V_MPEG4/ISO/AVC"
+    elif codec_fraction < 0.1:
+        metadata["CompressorID"] = "hvc1"
+    elif codec_fraction < 0.15:
+        metadata["CompressorID"] = "hev1"
+    else:
+        metadata["CompressorID"] = "avc1"
+    return metadata
+
+
+def get_setting(value: str, name: str, default: float) -> float:
+    """Parse a numeric simulation setting.
+
+    Args:
+        value (str): value of the environment variable.
+        name (str): name of the environment variable.
+        default (float): value when it is not a number.
+
+    Returns:
+        The setting, at least 0.
+    """
+    try:
+        setting = float(value)
+    except ValueError:
+        value_error_msg = f"{name} is not a number. {value=}. Using {default}."
+        logger.error(value_error_msg)
+        setting = default
+    return max(0.0, setting)
+
+
+def get_size(video_file: str) -> int:
+    """Get the size of a file, or 0 if it is not found."""
+    try:
+        return Path(video_file).stat().st_size
+    except OSError:
+        return 0
+
+
+def install() -> None:
+    """Replace ffmpeg, exiftool, the MP4 tag reader and writer, and the scratch copies with fakes.
+
+    The sparse video files have no boxes or elements to parse, and copying
+    them would write gigabytes of zeros to SCRATCH_DIR.
+    The tasks are imported here, so generating a synthetic library does not
+    need the environment variables of the transcoding tool.
+    """
+    from h265_transcoder import estimate, failures, mp4tags, probe, scratch, segments, tasks
+
+    tasks.FFmpeg = FakeFFmpeg
+    tasks.ExifToolInterface = FakeExifTool
+    segments.FFmpeg = FakeFFmpeg
+    estimate.FFmpeg = FakeFFmpeg
+    failures.FFmpeg = FakeFFmpeg
+    probe.probe_metadata = probe_metadata
+    mp4tags.write_tags = write_tags
+    scratch.copy_file = copy_file
+    simulate_msg = (f"Simulating ffmpeg, exiftool, and the scratch copies. {SIMULATE_LATENCY=}, "
+                    f"{SIMULATE_FAILURE_RATE=}, {SIMULATE_OUTPUT_RATIO=}.")
+    logger.warning(simulate_msg)
+
+
+def log_usage() -> None:
+    """Log the wall time and the peak memory use of the simulated run."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_msg = (f"Simulation finished in {time.monotonic() - START_TIME:.1f}s, "
+                 f"with a peak memory use of {peak_rss / 1024:.1f}MB.")
+    logger.info(usage_msg)
+
+
+def probe_metadata(video_file: str) -> dict | None:
+    """Get the simulated tags of a video file, as the in-process reader reports them.
+
+    Args:
+        video_file (str): the video file.
+
+    Returns:
+        Dictionary of the tags, or None when the file is not found, so exiftool reports the error.
+    """
+    metadata = get_metadata(video_file)
+    if "Error" in metadata:
+        return None
+    return metadata
+
+
+def write_sparse_file(video_file: Path, size: int, header: bytes = b"") -> None:
+    """Write a sparse file of a size, which takes no disk space beyond its header.
+
+    Args:
+        video_file (Path): file to write.
+        size (int): size of the file in bytes.
+        header (bytes): bytes to write at the start of the file.
+    """
+    with video_file.open(mode="wb") as sparse_file:
+        sparse_file.write(header)
+        sparse_file.truncate(max(size, len(header)))
+
+
+def write_tags(video_file: str, title: str) -> bool:
+    """Simulate writing the title of an MP4 file in place.
+
+    Args:
+        video_file (str): MP4 file to update.
+        title (str): the new title.
+
+    Returns:
+        True, as the simulated tags are never up to date.
+
+    Raises:
+        OSError: when the file is not found, so exiftool reports the error.
+    """
+    Path(video_file).stat()
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic library of sparse video files.")
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--per-directory", type=int, default=50)
+    args = parser.parse_args()
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    generate_tree(args.directory, args.files, args.per_directory)
@@ -1,35 +1,63 @@
 """Defines all of the jobs and shared functions."""
 
-import datetime
+import json
 import logging
 import os
+import queue
 import sqlite3
-import subprocess
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 from pathlib import Path
 
-from ffmpeg import FFmpeg, FFmpegError, Progress
+from ffmpeg import FFmpeg, FFmpegError
 
-from h265_transcoder import config
-from h265_transcoder.interfaces import DatabaseInterface
+from h265_transcoder import (budget, config, estimate, failures, governor, lease, memory, metrics, mp4tags, probe,
+                             scratch, segments, workers)
+from h265_transcoder.interfaces import DatabaseInterface, ExifToolInterface
+from h265_transcoder.progress import ProgressSampler
+from h265_transcoder.segments import SegmentedTranscode
+from h265_transcoder.workers import WorkerPool
 
 logger = logging.getLogger("app")
 BATCH = os.getenv("BATCH", "0")
+BATCH_ORDER = os.getenv("BATCH_ORDER", "efficiency")
 DELETE = bool(os.environ["DELETE"].lower() == "true")
+SCAN_PRUNE = bool(os.getenv("SCAN_PRUNE", "True").lower() == "true")
+# Streams of the original video file kept in the output, with or without segments. Subtitles are dropped
+STREAM_MAPS = ["0:v:0", "0:a?"]
 
 
 class Transcode:
     """Instantiate the video file for transcoding."""
-    def __init__(self, sqlite_db: str, path: str, filename: str) -> None:
+    def __init__(self, sqlite_db: str, path: str, filename: str,
+                 cpus: list | None = None, remux: bool = False,
+                 scratch_space: scratch.ScratchSpace | None = None, preset: str | None = None,
+                 resource_governor: governor.Governor | None = None) -> None:
         """Setup the path and filename instance for video transcoding.
 
         Args:
             sqlite_db (str): SQLite database file to use.
             path (str): the absolute path to the video file.
             filename (str): the video filename.
+            cpus (list): CPUs for the x265 thread pool. None uses all CPUs.
+            remux (bool): copy the h.265 video stream instead of transcoding it.
+            scratch_space (ScratchSpace): local scratch space to stage the video file in.
+            preset (str): x265 preset. None is the x265 default preset.
+            resource_governor (Governor): governor stopping the ffmpeg processes while throttled.
         """
         self.sqlite_db = sqlite_db
         self.path = path
         self.filename = filename
+        self.cpus = cpus
+        self.remux = remux
+        self.scratch_space = scratch_space
+        self.preset = preset
+        self.governor = resource_governor
+        self.staged = False
         self.input_file = f"{self.path}/{self.filename}"
         if self.filename.endswith(".mkv"):
             self.output_file = self.input_file.replace(".mkv", ".mp4")
@@ -45,86 +73,157 @@ class Transcode:
         During the transcoding, metadata will be cleaned up.
         Title tag will match the filename without an extension.
         Comment tag will be cleared.
+        Video files which are already h.265 are remuxed with stream copy.
+        The video file is already 'active', claimed by this worker.
+        A staged video file stays active until its output is copied back.
+        A retry adds the fallback for the failure class of the last attempt,
+        and a pre-flight check fails the doomed video files within seconds.
 
         Returns:
             transcode_status: "done" for success, "failed" for errors.
         """
-        update_status(self.sqlite_db, self.path, self.filename, "active")
+        read_file, write_file = self.input_file, self.output_file
+        if self.scratch_space:
+            staged_files = self.scratch_space.stage(self.input_file, self.output_file)
+            if staged_files:
+                read_file, write_file = staged_files
+                self.staged = True
+        last_failure, last_fallback = get_failure(self.sqlite_db, self.path, self.filename)
+        fallbacks = failures.split_fallbacks(last_fallback)
+        if last_failure:
+            # A retry which is not retryable, such as RETRY_FAILED on a full disk, reuses the fallbacks
+            fallbacks = failures.get_retry(last_failure, fallbacks) or fallbacks
+        preflight_failure = None
+        segmented = None
+        if not self.remux:
+            fallbacks, preflight_failure = failures.preflight(read_file, fallbacks)
+        input_options = {}
+        container_options = {
+            "vtag": "hvc1",
+            "metadata": [
+                            f"title={self.video_title}",
+                            "comment="
+                         ],
+            "f": "mp4"
+        }
+        # The audio fallback is in the container options, which the segmented join also uses
+        failures.apply_fallbacks(fallbacks, input_options, container_options)
+        output_options = {
+            "map": STREAM_MAPS,
+            "codec:v": "libx265",
+            "codec:a": "copy",
+            **container_options
+        }
+        if self.remux:
+            output_options["codec:v"] = "copy"
+        else:
+            if self.cpus:
+                output_options["x265-params"] = workers.get_x265_params(self.cpus)
+            if self.preset:
+                output_options["preset"] = self.preset
         ffmpeg = (
             FFmpeg()
             .option("y")
-            .input(self.input_file)
-            .output(
-                self.output_file,
-                {
-                    "codec:v": "libx265",
-                    "vtag": "hvc1",
-                    "codec:a": "copy",
-                    "metadata": [
-                                    f"title={self.video_title}",
-                                    "comment="
-                                 ],
-                    "f": "mp4"
-                }
-            )
+            .input(read_file, input_options)
+            .output(write_file, output_options)
         )
+        stderr_lines = deque(maxlen=config.failure_stderr_lines)
 
         @ffmpeg.on("start")
         def on_start(command: list[str]):
             ffmpeg_cmd_msg = f"{command=}"
             logger.debug(ffmpeg_cmd_msg)
 
-        @ffmpeg.on("progress")
-        def on_progress(progress: Progress):
-            frame = progress.frame
-            fps = int(progress.fps)
-            size = (str(progress.size) + "B")
-            try:
-                seconds = datetime.datetime.strptime(str(progress.time), "%H:%M:%S.%f")
-            except ValueError:
-                seconds = datetime.datetime.strptime(str(progress.time), "%H:%M:%S")
-            time = seconds.strftime("%H:%M:%S.") + str(seconds.strftime("%f"))[:2]
-            bitrate = str(progress.bitrate) + "kb/s"
-            speed = (str(progress.speed) + "x")
-            progress_bar = (
-                f"File={self.filename} "
-                f"Frame={frame} "
-                f"FPS={fps} "
-                f"Size={size} "
-                f"Time={time} "
-                f"Bitrate={bitrate} "
-                f"Speed={speed}"
-            )
-            logger.transcode(progress_bar)
+        @ffmpeg.on("stderr")
+        def on_stderr(line: str):
+            stderr_lines.append(line)
+
+        paused_seconds = partial(self.governor.get_paused_seconds, read_file) if self.governor else None
+        sampler = ProgressSampler(self.sqlite_db, self.path, self.filename,
+                                  "R" if self.remux else "Y", None if self.remux else self.preset, paused_seconds)
+        sampler.watch(ffmpeg)
+        if self.governor:
+            self.governor.watch(ffmpeg, read_file)
 
         try:
-            transcode_msg = f"Transcoding '{self.input_file}' to '{self.output_file}'."
+            if self.remux:
+                transcode_msg = f"Remuxing '{self.input_file}' to '{self.output_file}'."
+            elif self.preset:
+                transcode_msg = (f"Transcoding '{self.input_file}' to '{self.output_file}' "
+                                 f"with the '{self.preset}' preset.")
+            else:
+                transcode_msg = f"Transcoding '{self.input_file}' to '{self.output_file}'."
+            if preflight_failure:
+                raise FFmpegError(f"Pre-flight check failed with the {preflight_failure} failure class.",
+                                  ffmpeg.arguments)
+            if fallbacks:
+                fallback_msg = f"Using the '{failures.join_fallbacks(fallbacks)}' fallback(s)."
+                logger.info(fallback_msg)
             logger.info(transcode_msg)
-            ffmpeg.execute()
-        except FFmpegError:
+            # The segments are split without the tolerant decoding, so corrupt input is not segmented
+            segment_count = (1 if self.remux or "tolerant" in fallbacks
+                             else segments.get_segment_count(read_file))
+            if segment_count > 1:
+                segmented = SegmentedTranscode(read_file, write_file, segment_count,
+                                               self.cpus, self.preset, self.governor)
+                segmented.transcode(container_options, STREAM_MAPS, sampler)
+            else:
+                ffmpeg.execute()
+        except FFmpegError as transcode_err:
             transcode_status = "failed"
-            transcode_err_msg = f"Failed to transcode '{self.input_file}'"
+            return_code = getattr(getattr(ffmpeg, "_process", None), "returncode", None)
+            failure = preflight_failure or failures.classify_failure(transcode_err.message, stderr_lines,
+                                                                     return_code)
+            transcode_err_msg = f"Failed to transcode '{self.input_file}' with the {failure} failure class."
             logger.error(transcode_err_msg)
-            if Path(self.output_file).exists():
+            # The segments are only resumed by a retry which is segmented too
+            retry_fallbacks = failures.get_retry(failure, fallbacks)
+            if segmented and (retry_fallbacks is None or "tolerant" in retry_fallbacks):
+                segmented.remove()
+            if Path(write_file).exists():
                 logger.debug("Removing the failed output file.")
-                Path(self.output_file).unlink()
+                Path(write_file).unlink()
                 logger.debug("Removed output file.")
             else:
-                cleanup_msg = f"Nothing to remove. '{self.output_file}' not found."
+                cleanup_msg = f"Nothing to remove. '{write_file}' not found."
                 logger.debug(cleanup_msg)
         else:
             transcode_status = "done"
+            failure = None
             success_msg = f"'{self.input_file}' transcoded successfully."
             logger.info(success_msg)
-            input_size = get_file_size(self.input_file)
-            output_size = get_file_size(self.output_file)
+            input_size = get_file_size(read_file)
+            output_size = get_file_size(write_file)
             diff_size = input_size-output_size
             diff_size_msg = f"Recovered {diff_size:,} bytes in trandcoding."
             logger.info(diff_size_msg)
         finally:
-            update_status(self.sqlite_db, self.path, self.filename, transcode_status)
+            sampler.finish(transcode_status, write_file)
+            if self.governor:
+                self.governor.release(read_file)
+            update_failure(self.sqlite_db, self.path, self.filename, failure, fallbacks)
+            if self.staged and transcode_status == "done":
+                self.scratch_space.unstage(self.input_file, keep_output=True)
+                self.scratch_space.copy_back(write_file, self.output_file, sampler.bytes_in, self.finish_copy)
+            else:
+                if self.staged:
+                    self.scratch_space.unstage(self.input_file, keep_output=False)
+                update_status(self.sqlite_db, self.path, self.filename, transcode_status)
         return transcode_status
 
+    def finish_copy(self, copied: bool) -> None:
+        """Update the status of a staged video file after its output is copied back.
+
+        The original is deleted when enabled, once the output is on the network share.
+
+        Args:
+            copied (bool): True if the output was copied back.
+        """
+        transcode_status = "done" if copied else "failed"
+        update_status(self.sqlite_db, self.path, self.filename, transcode_status)
+        if copied and DELETE:
+            self.delete_original()
+
 
     def delete_original(self) -> None:
         """Remove the original input file.
@@ -141,6 +240,32 @@ class Transcode:
         logger.info(cleanup_msg)
 
 
+class ScanThread(threading.Thread):
+    """Scan for video files in the background, while the queue is transcoded."""
+    def __init__(self, sqlite_db: str) -> None:
+        """Setup the scan of the SQLite database.
+
+        Args:
+            sqlite_db (str): SQLite database file to use.
+        """
+        super().__init__(name="scan", daemon=True)
+        self.sqlite_db = sqlite_db
+        self.scan_error = None
+
+    def run(self) -> None:
+        """Scan the directory, keeping the exit of a failed scan for 'wait'."""
+        try:
+            scan_directory(self.sqlite_db)
+        except (SystemExit, Exception) as scan_error:
+            self.scan_error = scan_error
+
+    def wait(self) -> None:
+        """Wait for the scan to finish, and exit if the scan failed."""
+        self.join()
+        if self.scan_error:
+            raise self.scan_error
+
+
 def final_results(sqlite_db: str) -> None:
     """Get the final count per status, and filenames with a failed status.
 
@@ -151,10 +276,11 @@ def final_results(sqlite_db: str) -> None:
         "done": 0,
         "failed": 0,
         "queued": 0,
+        "removed": 0,
         "skipped": 0,
         "unknown": 0
     }
-    status_query = "SELECT status, COUNT(status) FROM queue GROUP BY status ;"
+    status_query = "SELECT status, count FROM status_count ;"
     failed_query = "SELECT path, filename FROM queue WHERE status = 'failed' ;"
     with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
         try:
@@ -172,7 +298,8 @@ def final_results(sqlite_db: str) -> None:
         states[values[0]] = values[1]
 
     final_count_msg = (f"{states["done"]} done, {states["failed"]} failed, "
-                       f"{states["queued"]} queued, {states["skipped"]} skipped, "
+                       f"{states["queued"]} queued, {states["removed"]} removed, "
+                       f"{states["skipped"]} skipped, "
                        f"{states['unknown']} unknown.")
     logger.info(final_count_msg)
 
@@ -183,14 +310,65 @@ def final_results(sqlite_db: str) -> None:
             logger.info(failed_result_msg)
 
 
-def get_batch(sqlite_db: str) -> list:
-    """Obtain a list of files to transcode based on batch limit.
+def get_batch(sqlite_db: str, limit: int | None = None, order: str = "scan", extra_filter: str = "") -> list:
+    """Obtain a list of files to transcode.
 
     Args:
         sqlite_db (str): SQLite database file to use.
+        limit (int): maximum amount of files. None is unlimited.
+        order (str): name of the batch order policy.
+        extra_filter (str): more SQLite 'WHERE' conditions, such as the memory budget filter.
 
     Returns:
-        List of tuples containing the '(path, filename)' of files to transcode.
+        List of tuples containing the '(path, filename, transcode)' of files to transcode.
+    """
+    order_by = get_order_policies()[order]
+    batch_query = f"""SELECT path, filename, transcode
+                        FROM queue
+                        WHERE transcode IN ('Y', 'R') AND
+                        status = 'queued'
+                        {get_batch_filter()}
+                        {extra_filter}
+                        ORDER BY {order_by} ;"""
+    if limit:
+        batch_query = batch_query.replace(";", f"LIMIT {limit} ;")
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            with metrics.db_seconds.time(operation="batch"):
+                batch_result = db_cursor.execute(batch_query)
+                batch_queue = batch_result.fetchall()
+        except sqlite3.Error:
+            logger.error("SQLite transcode selection query failed.")
+            logger.exception(sqlite3.Error)
+            raise SystemExit(1) from sqlite3.Error
+        else:
+            db_cursor.close()
+            logger.debug("Successfully retrieved batch of files to transcode.")
+            return batch_queue
+
+
+def get_batch_filter() -> str:
+    """Get the extra SQLite 'WHERE' conditions of the batches.
+
+    With ESTIMATE, video files predicted under MIN_SAVINGS stay queued,
+    in case the threshold is lowered, but are left out of the batches.
+
+    Returns:
+        Conditions starting with 'AND', or an empty string.
+    """
+    if not estimate.ESTIMATE:
+        return ""
+    return f"""AND NOT (transcode = 'Y' AND
+                        est_size IS NOT NULL AND
+                        size > 0 AND
+                        (size - est_size) * 100.0 / size < {estimate.get_min_savings()})"""
+
+
+def get_batch_limit() -> int | None:
+    """Get the limit of files to transcode from the BATCH variable.
+
+    Returns:
+        Amount of files to transcode. None is unlimited.
     """
     try:
         batch = int(BATCH)
@@ -215,22 +393,47 @@ def get_batch(sqlite_db: str) -> list:
             limit = None
         else:
             limit = None
+    return limit
 
-    batch_query = "SELECT path, filename FROM queue WHERE transcode = 'Y' AND status = 'queued' ;"
-    if limit:
-        batch_query = batch_query.replace(";", f"LIMIT {limit} ;")
+
+def get_batch_order() -> str:
+    """Get the batch order policy from the BATCH_ORDER variable.
+
+    Returns:
+        Name of the batch order policy.
+    """
+    order = BATCH_ORDER.lower().strip()
+    if order not in get_order_policies():
+        order_err_msg = f"{BATCH_ORDER=} is not a batch order. Use one of: {', '.join(get_order_policies())}."
+        logger.warning(order_err_msg)
+        order = "efficiency"
+    order_msg = f"Ordering batches by '{order}'."
+    logger.info(order_msg)
+    return order
+
+
+def get_failure(sqlite_db: str, path: str, filename: str) -> tuple:
+    """Get the failure class and the fallbacks of the last attempt of a video file.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+
+    Returns:
+        Tuple of the failure class and the comma-separated fallbacks. The values are None when not known.
+    """
+    failure_query = "SELECT failure, fallback FROM queue WHERE path = ? AND filename = ? ;"
+    failure_data = None
     with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
         try:
-            batch_result = db_cursor.execute(batch_query)
-            batch_queue = batch_result.fetchall()
+            failure_data = db_cursor.execute(failure_query, (path, filename)).fetchone()
         except sqlite3.Error:
-            logger.error("SQLite transcode selection query failed.")
+            logger.error("SQLite failure query failed.")
             logger.exception(sqlite3.Error)
-            raise SystemExit(1) from sqlite3.Error
         else:
             db_cursor.close()
-            logger.info("Successfully retrieved batch of files to transcode.")
-            return batch_queue
+    return failure_data or (None, None)
 
 
 def get_file_size(filename: str) -> int:
@@ -257,89 +460,378 @@ def get_file_size(filename: str) -> int:
     return byte_size
 
 
-def insert_scan_results(sqlite_db: str, insert_list: list) -> None:
-    """Insert scan results list into SQLite database.
+def get_directories(sqlite_db: str) -> dict:
+    """Get the directory listings of the last scan.
 
     Args:
         sqlite_db (str): SQLite database file to use.
-        insert_list (list): list containing a list of scan results.
-    """
-    insert_statement = """INSERT INTO queue (
-                                path, filename, transcode, status)
-                            VALUES (
-                                ?, ?, ?, ?) ;
+
+    Returns:
+        Dictionary of each directory to a tuple of its 'mtime_ns', and its list of subdirectories.
     """
+    directory_query = "SELECT path, mtime_ns, subdirs FROM directories ;"
+    directories = {}
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            with metrics.db_seconds.time(operation="directories"):
+                directory_result = db_cursor.execute(directory_query)
+                for path, mtime_ns, subdirs in directory_result:
+                    directories[path] = (mtime_ns, json.loads(subdirs))
+        except sqlite3.Error:
+            logger.error("SQLite directories query failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+    return directories
 
-    logger.debug("Inserting scanned results into SQLite database.")
 
+def get_fingerprints(sqlite_db: str, video_list: list) -> dict:
+    """Get the fingerprints of a batch of video files in the queue.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        video_list (list): list of tuples containing the path and filename.
+
+    Returns:
+        Dictionary of '(path, filename)' to a tuple of the
+        '(size, mtime_ns, inode, status, duration)' of the video files found in the queue.
+    """
+    fingerprint_query = """SELECT size, mtime_ns, inode, status, duration
+                            FROM queue
+                            WHERE path = ? AND
+                            filename = ? ;
+    """
+    fingerprints = {}
     with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
         try:
-            db_cursor.executemany(insert_statement, insert_list)
-        except sqlite3.IntegrityError:
-            logger.error("Duplicate filename found in SQLite table.")
+            with metrics.db_seconds.time(operation="fingerprint"):
+                for path, filename in video_list:
+                    fingerprint_result = db_cursor.execute(fingerprint_query, (path, filename))
+                    fingerprint_data = fingerprint_result.fetchone()
+                    if fingerprint_data:
+                        fingerprints[(path, filename)] = fingerprint_data
         except sqlite3.Error:
-            logger.error("SQLite insert execution failed.")
+            logger.error("SQLite fingerprint query failed.")
             logger.exception(sqlite3.Error)
             raise SystemExit(1) from sqlite3.Error
         else:
             db_cursor.close()
-        finally:
-            insert_msg = f"Successfully inserted {len(insert_list)} entries into SQLite 'queue' table."
-            logger.info(insert_msg)
+    return fingerprints
+
+
+def get_media_info(file_metadata: dict) -> list:
+    """Get the duration and resolution from the video file metadata.
+
+    Args:
+        file_metadata (dict): metadata tags from the probe or exiftool.
+
+    Returns:
+        List containing the duration in seconds, width, and height.
+        Missing or invalid values are None.
+    """
+    media_info = []
+    for tag, tag_type in (("Duration", float), ("ImageWidth", int), ("ImageHeight", int)):
+        try:
+            tag_value = tag_type(file_metadata[tag])
+        except (KeyError, TypeError, ValueError):
+            tag_value = None
+        media_info.append(tag_value if tag_value else None)
+    return media_info
+
+
+def get_order_policies() -> dict:
+    """Get the batch order policies.
+
+    The expected h.265 size is estimated from the duration and resolution,
+    at the h.265 bitrate per pixel in the config. Video files without
+    the media values from the scan are ordered last.
+
+    Returns:
+        Dictionary of each policy name to its SQLite 'ORDER BY' clause.
+        - efficiency: largest expected savings for the encoding time first.
+          Remuxing takes little time, so it is first.
+        - savings: largest expected savings first. Remuxing saves nothing, so it is last.
+        - shortest: shortest duration first, starting with remuxing.
+        - smallest: smallest files first.
+        - predicted: largest savings for the encoding time predicted by the
+          sample-encode estimator first. Remuxing is first, and video files
+          without a prediction are last.
+        - scan: the order the scan found the video files.
+    """
+    expected_size = f"duration * width * height * {config.hevc_bitrate_per_pixel} / 8"
+    return {
+        "efficiency": "transcode = 'R' DESC, bitrate * 1.0 / (width * height) DESC NULLS LAST, rowid",
+        "savings": f"CASE WHEN transcode = 'R' THEN 0 ELSE size - {expected_size} END DESC NULLS LAST, rowid",
+        "shortest": "transcode = 'R' DESC, duration ASC NULLS LAST, rowid",
+        "smallest": "size ASC NULLS LAST, rowid",
+        "predicted": "transcode = 'R' DESC, (size - est_size) / est_seconds DESC NULLS LAST, rowid",
+        "scan": "rowid"
+    }
+
+
+def get_schema_version(db_cursor: sqlite3.Cursor) -> int:
+    """Get the schema version of the SQLite database.
+
+    Databases created before the versioned schema have a 'user_version'
+    of 0, and their version is detected from the 'queue' table columns.
+
+    Args:
+        db_cursor (sqlite3.Cursor): cursor of the SQLite database.
+
+    Returns:
+        Schema version of the SQLite database. 0 for a new database.
+    """
+    schema_version = db_cursor.execute("PRAGMA user_version ;").fetchone()[0]
+    if schema_version == 0:
+        table_info = db_cursor.execute("PRAGMA table_info(queue) ;").fetchall()
+        queue_columns = [column[1] for column in table_info]
+        if "inode" in queue_columns:
+            schema_version = 2
+        elif queue_columns:
+            schema_version = 1
+    return schema_version
+
+
+def insert_scan_results(sqlite_db: str, insert_list: list) -> None:
+    """Insert or update scan results in the SQLite database.
+
+    The scan results are upserted in chunks, each in its own transaction.
+    A rescanned video file keeps its 'done' status when it is already transcoded,
+    its 'active' status while a worker has claimed it, and its predictions from the
+    estimator and its last failure while its size and modification time match.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        insert_list (list): list containing a list of scan results.
+    """
+    insert_statement = """INSERT INTO queue (
+                                path, filename, transcode, status,
+                                duration, width, height,
+                                size, mtime_ns, inode, bitrate, scan_id)
+                            VALUES (
+                                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (path, filename) DO UPDATE SET
+                                transcode = excluded.transcode,
+                                status = CASE
+                                    WHEN queue.status = 'done' AND excluded.status = 'skipped'
+                                    THEN 'done'
+                                    WHEN queue.status = 'active' AND excluded.status = 'queued'
+                                    THEN 'active'
+                                    ELSE excluded.status
+                                END,
+                                duration = excluded.duration,
+                                width = excluded.width,
+                                height = excluded.height,
+                                size = excluded.size,
+                                mtime_ns = excluded.mtime_ns,
+                                inode = excluded.inode,
+                                bitrate = excluded.bitrate,
+                                est_size = CASE
+                                    WHEN queue.size IS excluded.size AND queue.mtime_ns IS excluded.mtime_ns
+                                    THEN queue.est_size
+                                END,
+                                est_seconds = CASE
+                                    WHEN queue.size IS excluded.size AND queue.mtime_ns IS excluded.mtime_ns
+                                    THEN queue.est_seconds
+                                END,
+                                est_cpu_seconds = CASE
+                                    WHEN queue.size IS excluded.size AND queue.mtime_ns IS excluded.mtime_ns
+                                    THEN queue.est_cpu_seconds
+                                END,
+                                failure = CASE
+                                    WHEN queue.size IS excluded.size AND queue.mtime_ns IS excluded.mtime_ns
+                                    THEN queue.failure
+                                END,
+                                fallback = CASE
+                                    WHEN queue.size IS excluded.size AND queue.mtime_ns IS excluded.mtime_ns
+                                    THEN queue.fallback
+                                END,
+                                scan_id = excluded.scan_id ;
+    """
+
+    logger.debug("Inserting scanned results into SQLite database.")
 
+    inserted_count = 0
+    chunk_size = config.db_chunk_size
+    with DatabaseInterface(sqlite_db) as (connection, db_cursor):
+        for chunk_start in range(0, len(insert_list), chunk_size):
+            insert_chunk = insert_list[chunk_start:chunk_start + chunk_size]
+            try:
+                with connection, metrics.db_seconds.time(operation="insert"):
+                    db_cursor.executemany(insert_statement, insert_chunk)
+            except sqlite3.Error:
+                chunk_err_msg = f"SQLite insert execution failed for {len(insert_chunk)} entries."
+                logger.error(chunk_err_msg)
+                logger.exception(sqlite3.Error)
+            else:
+                inserted_count += len(insert_chunk)
+        db_cursor.close()
+    insert_msg = f"Successfully inserted {inserted_count} entries into SQLite 'queue' table."
+    logger.info(insert_msg)
 
-def read_metadata(path: str, filename: str) -> tuple:
-    """Read video file metadata for Compressor ID.
+
+def log_metadata_results(write_results: dict) -> None:
+    """Log the results of the queued metadata updates.
 
     Args:
-        path (str): Absolute path to the video file.
-        filename (str): Filename for the video.
+        write_results (dict): video files and whether their metadata was updated.
+    """
+    for video_file, updated in write_results.items():
+        if updated:
+            update_metadata_msg = f"Updated metadata for '{video_file}'."
+            logger.info(update_metadata_msg)
+        else:
+            update_metadata_err = f"Invalid MP4 file type for '{video_file}'. Transcode to update the metadata."
+            logger.error(update_metadata_err)
+
+
+def list_directory(directory: str, video_queue: queue.Queue, walk_errors: list,
+                   known_directories: dict | None) -> tuple | None:
+    """List a directory, and queue each video file with its fingerprint.
+
+    The entry types from 'os.scandir' tell the subdirectories apart without
+    a stat of each entry, so only the video files are stat. A directory with
+    the same modification time as its last listing is not listed again, as
+    no entries were added, removed, or renamed. Its path is queued with None
+    instead of a filename, and the subdirectories of the last listing are kept.
+
+    Args:
+        directory (str): directory to list.
+        video_queue (queue.Queue): queue of tuples containing the path, filename, and fingerprint.
+        walk_errors (list): list of directory errors during the walk.
+        known_directories (dict): directory listings of the last scan. None lists every directory.
 
     Returns:
-        Tuple of the filename and transcoding status.
+        Tuple of the directory, its 'mtime_ns', its list of subdirectories, and True if
+        every video file was read. None when the directory could not be read.
     """
-    video_file = f"{path}/{filename}"
+    video_extensions = (".mkv", ".mp4")
+    listing_start = time.perf_counter()
     try:
-        reader_cmd = ["/usr/bin/exiftool",
-                      "-api", "largefilesupport",
-                      "-s3", "-CompressorID",
-                      video_file]
-        metadata_sp = subprocess.run(reader_cmd,
-                                        capture_output = True,
-                                        check = True,
-                                        text = True)
-        compressor_metadata = metadata_sp.stdout.lower().strip()
-    except subprocess.CalledProcessError:
-        non_video_msg = f"'{video_file}' is not a not a video file. Verify file type."
-        logger.error(non_video_msg)
-        result = (filename, "N", "unknown")
-    else:
+        # The modification time is read before the listing, so a change during the listing is found next scan
+        mtime_ns = os.stat(directory).st_mtime_ns
+        known_directory = known_directories.get(directory) if known_directories else None
+        if known_directory and known_directory[0] == mtime_ns:
+            video_queue.put((directory, None, None))
+            return directory, mtime_ns, known_directory[1], True
+        subdirs = []
+        video_files = []
+        complete = True
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                elif entry.name.endswith(video_extensions):
+                    try:
+                        file_stat = entry.stat()
+                    except OSError:
+                        stat_err_msg = f"Unable to read '{entry.path}'. Skipping."
+                        logger.warning(stat_err_msg)
+                        walk_errors.append(stat_err_msg)
+                        complete = False
+                        continue
+                    video_files.append((entry.name, (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)))
+    except OSError as walk_error:
+        walk_errors.append(walk_error)
+        walk_err_msg = f"Unable to read '{directory}': {walk_error.strerror}"
+        logger.warning(walk_err_msg)
+        return None
+    finally:
+        metrics.walk_seconds.observe(time.perf_counter() - listing_start)
+    for filename, fingerprint in video_files:
+        found_msg = f"Found '{directory}/{filename}'."
+        logger.info(found_msg)
+        video_queue.put((directory, filename, fingerprint))
+    return directory, mtime_ns, subdirs, complete
+
+
+def read_metadata(exiftool: ExifToolInterface, video_list: list) -> list:
+    """Read video file metadata for Compressor ID, duration, and resolution.
+
+    Each video file is probed in-process, and the files the probe
+    could not parse are read with a single exiftool command.
+    Video files which are already h.265, but not HVC1 MP4, are queued for remuxing.
+
+    Args:
+        exiftool (ExifToolInterface): running exiftool session.
+        video_list (list): list of tuples containing the path and filename.
+
+    Returns:
+        List of lists containing the path, filename, transcoding status,
+        duration, width, and height. The transcode value is "Y" to transcode,
+        "R" to remux, or "N". Unknown media values are None.
+    """
+    metadata = {}
+    exiftool_files = []
+    for path, filename in video_list:
+        video_file = f"{path}/{filename}"
+        with metrics.probe_seconds.time(method="probe"):
+            probe_result = probe.probe_metadata(video_file)
+        if probe_result is None:
+            exiftool_files.append(video_file)
+        else:
+            metadata[video_file] = probe_result
+    if exiftool_files:
+        exiftool_msg = f"Reading metadata of {len(exiftool_files)} video file(s) with exiftool."
+        logger.debug(exiftool_msg)
+        with metrics.probe_seconds.time(method="exiftool"):
+            metadata.update(exiftool.read_tags(exiftool_files, ["CompressorID", "DocType", "CodecID",
+                                                                "Duration", "ImageWidth", "ImageHeight",
+                                                                "Error"]))
+
+    results = []
+    for path, filename in video_list:
+        video_file = f"{path}/{filename}"
+        file_metadata = metadata.get(video_file, {"Error": "File not read"})
+        compressor_metadata = str(file_metadata.get("CompressorID", "")).lower().strip()
+        file_type = str(file_metadata.get("DocType", "")).lower().strip()
+        codec_id = str(file_metadata.get("CodecID", "")).upper().strip()
         if compressor_metadata == "hvc1":
             transcoded_msg = f"'{video_file}' is already transcoded."
             logger.info(transcoded_msg)
-            result = (filename, "N", "skipped")
+            result = [path, filename, "N", "skipped"]
+        elif compressor_metadata == "hev1" or codec_id == "V_MPEGH/ISO/HEVC":
+            remux_msg = f"'{video_file}' is already h.265. Queued for remuxing."
+            logger.info(remux_msg)
+            result = [path, filename, "R", "queued"]
+        elif filename.endswith(".mkv"):
+            transcode_msg = f"'{video_file}' needs to be transcoded."
+            logger.info(transcode_msg)
+            result = [path, filename, "Y", "queued"]
+        elif "Error" in file_metadata and file_type == "":
+            non_video_msg = f"'{video_file}' is not a not a video file. Verify file type."
+            logger.error(non_video_msg)
+            result = [path, filename, "N", "unknown"]
         elif compressor_metadata == "":
             unknown_msg = f"'{video_file}' returned empty Compressor ID. Verifying video integrity."
             logger.warning(unknown_msg)
-            verified_status = verify_metadata(video_file)
-            result = (filename, *verified_status)
+            verified_status = verify_metadata(video_file, file_type)
+            result = [path, filename, *verified_status]
         else:
             transcode_msg = f"'{video_file}' needs to be transcoded."
             logger.info(transcode_msg)
-            result = (filename, "Y", "queued")
-    return result
+            result = [path, filename, "Y", "queued"]
+        result.extend(get_media_info(file_metadata))
+        metrics.files_total.inc(stage="scan", status=result[3])
+        results.append(result)
+    return results
 
 
 def retry_failed(sqlite_db: str) -> list:
     """Retry transcoding files that failed transcoding on the first attempt.
 
+    Failures which are not retryable are skipped, such as a full disk,
+    or a failure which its fallback already did not fix.
+
     Args:
         sqlite_db (str): SQLite database file to use.
 
     Returns:
-        list of tuples containing the path and filename of failed transcoding.
+        list of tuples containing the path, filename, and transcode value of failed transcoding.
     """
-    failed_status_query = "SELECT path, filename FROM queue WHERE status = 'failed';"
+    failed_status_query = "SELECT path, filename, transcode, failure, fallback FROM queue WHERE status = 'failed';"
+    failed_status_data = []
 
     with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
         try:
@@ -351,105 +843,428 @@ def retry_failed(sqlite_db: str) -> list:
         else:
             db_cursor.close()
 
+    retry_data = [(path, filename, transcode)
+                  for path, filename, transcode, failure, fallback in failed_status_data
+                  if failures.get_retry(failure, failures.split_fallbacks(fallback)) is not None]
     if failed_status_data:
         failed_results_msg = f"Found {len(failed_status_data)} failed transcoding(s)."
         logger.info(failed_results_msg)
     else:
         logger.info("No failed transcodings.")
+    skipped_count = len(failed_status_data) - len(retry_data)
+    if skipped_count:
+        skipped_msg = f"Skipping {skipped_count} failed transcoding(s) which are not retryable."
+        logger.warning(skipped_msg)
 
-    return failed_status_data
+    return retry_data
 
 
-def scan_directory(sqlite_db: str) -> None:
-    """Scan for video files.
+def scan_batch(sqlite_db: str, exiftool: ExifToolInterface, video_batch: list, scan_id: int) -> int:
+    """Probe and insert a batch of scanned video files.
 
-    Creates a tuple of the absolute path and filename,
-    then appends to the list of the scan results.
+    Only new video files, video files with a changed fingerprint, and queued
+    video files without a duration, are probed.
+    Unchanged video files are marked as seen by this scan.
 
     Args:
         sqlite_db (str): SQLite database file to use.
+        exiftool (ExifToolInterface): running exiftool session.
+        video_batch (list): list of tuples containing the path, filename, and fingerprint.
+        scan_id (int): identifier of the running scan.
 
     Returns:
-        List of tuples containing the absolute path and filename.
+        Amount of new or changed video files.
     """
-    scan_path = "/mnt"
-    video_extensions = (".mkv", ".mp4")
-    video_list = []
-    queue_list = []
+    known_files = get_fingerprints(sqlite_db, [(path, filename) for path, filename, _fingerprint in video_batch])
+    fingerprints = {}
+    unchanged_list = []
+    for path, filename, fingerprint in video_batch:
+        known_file = known_files.get((path, filename))
+        if (known_file and known_file[:3] == fingerprint and known_file[3] != "removed"
+                and not (known_file[3] == "queued" and known_file[4] is None)):
+            unchanged_list.append([scan_id, path, filename])
+        else:
+            fingerprints[(path, filename)] = fingerprint
+    if unchanged_list:
+        update_scan_id(sqlite_db, unchanged_list)
+    if fingerprints:
+        queue_list = read_metadata(exiftool, list(fingerprints))
+        for result in queue_list:
+            fingerprint = fingerprints[(result[0], result[1])]
+            duration = result[4]
+            bitrate = int(fingerprint[0] * 8 / duration) if duration else None
+            result.extend([*fingerprint, bitrate, scan_id])
+        insert_scan_results(sqlite_db, queue_list)
+    return len(fingerprints)
+
+
+def scan_directory(sqlite_db: str) -> None:
+    """Scan for new or changed video files.
+
+    The directory walk, metadata probing, and database inserts run as a
+    pipeline, so the first video files are queued while the scan continues.
+    Each video file is fingerprinted by its size, modification time, and inode.
+    With SCAN_PRUNE, directories which are unchanged since the last scan are
+    not listed, and their video files in the queue are marked as seen.
+    Video files in the queue which are no longer found are marked as removed.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+    """
+    scan_path = config.scan_path
+    scan_id = time.time_ns()
+    video_queue = queue.Queue(maxsize=config.scan_queue_size)
+    walk_errors = []
+    known_directories = get_directories(sqlite_db) if SCAN_PRUNE else None
+    scanned_directories = {}
+    found_count = 0
+    changed_count = 0
 
     logger.info("Beginning scan...")
-    for root, _dirs, files in os.walk(scan_path):
-        for filename in files:
-            if filename.endswith(video_extensions):
-                video_list.append((root, filename))
-                found_msg = f"Found '{root}/{filename}'."
-                logger.info(found_msg)
-    scan_results_msg = f"Scan complete. Found {len(video_list)} video file(s)."
+    scan_start = time.perf_counter()
+    walker = threading.Thread(target=walk_directory,
+                              args=(scan_path, video_queue, walk_errors, known_directories, scanned_directories),
+                              name="walk",
+                              daemon=True)
+    walker.start()
+    with ExifToolInterface() as exiftool:
+        video_batch = []
+        pruned_batch = []
+        while True:
+            video_file = video_queue.get()
+            if video_file is not None and video_file[1] is None:
+                pruned_batch.append(video_file[0])
+            elif video_file is not None:
+                video_batch.append(video_file)
+                found_count += 1
+            batch_ready = video_file is None or video_queue.empty()
+            if video_batch and (batch_ready or len(video_batch) >= config.exiftool_batch):
+                changed_count += scan_batch(sqlite_db, exiftool, video_batch, scan_id)
+                video_batch = []
+            if pruned_batch and (batch_ready or len(pruned_batch) >= config.exiftool_batch):
+                found_count += update_directory_scan_id(sqlite_db, pruned_batch, scan_id)
+                pruned_batch = []
+            if video_file is None:
+                break
+    walker.join()
+    # Stored after the video files are inserted, so an interrupted scan lists the directories again
+    update_directories(sqlite_db, scanned_directories, scan_id, not walk_errors)
+    metrics.scan_seconds.observe(time.perf_counter() - scan_start)
+    scan_results_msg = f"Scan complete. Found {found_count} video file(s)."
     logger.info(scan_results_msg)
 
-    if len(video_list) == 0:
+    if found_count == 0:
         logger.warning("Empty scan results. Is the volume mounted? Exiting.")
         raise SystemExit(1)
 
-    logger.debug("Checking metadata on video files.")
-    for result in video_list:
-        path = result[0]
-        filename = result[1]
-        if filename.endswith(".mkv"):
-            transcode_msg = f"'{path}/{filename}' needs to be transcoded."
-            logger.info(transcode_msg)
-            queue_list.append([path, filename, "Y", "queued"])
-        else:
-            filename, transcode, status = read_metadata(path, filename)
-            queue_list.append([path, filename, transcode, status])
-    insert_scan_results(sqlite_db, queue_list)
+    if walk_errors:
+        walk_err_msg = f"{len(walk_errors)} director(ies) could not be read. Not marking any video files as removed."
+        logger.warning(walk_err_msg)
+        removed_count = 0
+    else:
+        removed_count = update_removed(sqlite_db, scan_id)
+    changes_msg = (f"{changed_count} new or changed, "
+                   f"{found_count - changed_count} unchanged, "
+                   f"{removed_count} removed video file(s).")
+    logger.info(changes_msg)
 
 
 def setup_database(sqlite_db: str) -> int:
-    """Setup the SQLite database.
+    """Setup the SQLite database, applying the schema migrations it is missing.
+
+    Each migration file is applied in a single transaction, and the
+    schema version is stored in the database 'user_version'.
 
     Args:
         sqlite_db (str): SQLite database file to use.
 
     Returns:
-        0 - successfully import schema_file into SQLite DB.
-        Any non-zero value is a failure to import the schema_file.
+        0 - successfully applied the schema migrations to the SQLite DB.
+        Any non-zero value is a failure to apply the schema migrations.
     """
-    schema_file = config.schema_file
-    try:
-        with Path(schema_file).open(mode="r", encoding="utf-8") as db_schema:
-            create_table = db_schema.read()
-    except FileNotFoundError:
-        file_not_found_msg = f"Schema file not found. Expected: '{schema_file}'."
+    schema_dir = config.schema_dir
+    migration_files = sorted(Path(schema_dir).glob("[0-9][0-9][0-9][0-9]_*.sql"))
+    if not migration_files:
+        file_not_found_msg = f"Schema migrations not found. Expected: '{schema_dir}'."
         logger.error(file_not_found_msg)
         raise SystemExit(1) from FileNotFoundError
-    else:
-        with DatabaseInterface(sqlite_db) as (connection, cursor):
-            cursor.executescript(create_table)
-            cursor.close()
-            logger.debug("SQLite database is ready.")
-        return 0
+
+    with DatabaseInterface(sqlite_db) as (connection, cursor):
+        schema_version = get_schema_version(cursor)
+        for migration_file in migration_files:
+            migration_version = int(migration_file.name.split("_")[0])
+            if migration_version <= schema_version:
+                continue
+            migration = migration_file.read_text(encoding="utf-8")
+            migration_msg = f"Applying schema migration '{migration_file.name}'."
+            logger.info(migration_msg)
+            try:
+                cursor.executescript(f"BEGIN ;\n{migration}\n"
+                                     f"PRAGMA user_version = {migration_version} ;\n"
+                                     "COMMIT ;")
+            except sqlite3.Error:
+                connection.rollback()
+                migration_err_msg = f"SQLite schema migration '{migration_file.name}' failed."
+                logger.error(migration_err_msg)
+                logger.exception(sqlite3.Error)
+                raise SystemExit(1) from sqlite3.Error
+        cursor.close()
+        logger.debug("SQLite database is ready.")
+    return 0
+
+
+def transcode_file(sqlite_db: str, path: str, filename: str, transcode: str,
+                   scratch_space: scratch.ScratchSpace | None, time_budget: budget.TimeBudget | None,
+                   resource_governor: governor.Governor | None, cpus: list | None) -> str:
+    """Transcode a video file, and delete the original when enabled.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+        transcode (str): "Y" to transcode, or "R" to remux the video file.
+        scratch_space (ScratchSpace): local scratch space to stage the video file in. None is disabled.
+        time_budget (TimeBudget): time budget selecting the x265 preset. None uses the default preset.
+        resource_governor (Governor): governor throttling the ffmpeg processes. None is disabled.
+        cpus (list): CPUs for the x265 thread pool. None uses all CPUs.
+
+    Returns:
+        transcode_status: "done" for success, "failed" for errors,
+        "queued" when ESTIMATE predicts less than MIN_SAVINGS, or the time budget is over.
+    """
+    # The claimed video file is released to the queue when it is not transcoded
+    if ((time_budget and time_budget.is_over()) or
+            (estimate.ESTIMATE and transcode == "Y" and not estimate.check_savings(sqlite_db, path, filename, cpus))):
+        update_status(sqlite_db, path, filename, "queued")
+        return "queued"
+    preset = time_budget.select_preset(resource_governor) if time_budget and transcode == "Y" else None
+    video_file = Transcode(sqlite_db, path, filename, cpus, remux=(transcode == "R"),
+                           scratch_space=scratch_space, preset=preset,
+                           resource_governor=resource_governor)
+    transcode_video = video_file.transcode()
+    # A staged video file is deleted after its output is copied back
+    if (transcode_video == "done") and (DELETE) and not video_file.staged:
+        video_file.delete_original()
+    return transcode_video
+
+
+def transcode_queue(sqlite_db: str, queue_list: list, time_budget: budget.TimeBudget | None = None,
+                    memory_budget: memory.MemoryBudget | None = None) -> None:
+    """Transcode the list of failed files with the worker pool.
+
+    Each video file is claimed first, so another worker retrying it at the same time skips it.
+    With GOVERNOR, the jobs over the allowed number are stopped until the throttling ends.
+    With MEMORY_BUDGET, each video file waits until its predicted memory fits.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        queue_list (list): list of tuples containing a path, filename, and transcode value.
+        time_budget (TimeBudget): time budget selecting the x265 presets. None uses the default preset.
+        memory_budget (MemoryBudget): memory budget admitting the jobs. None admits every job.
+    """
+    worker_count = workers.get_workers()
+    with (lease.LeaseHeartbeat(sqlite_db), scratch.get_scratch_space() as scratch_space,
+          WorkerPool(worker_count) as pool, governor.get_governor(worker_count) as resource_governor):
+        transcode_jobs = []
+        for entry in queue_list:
+            path = entry[0]
+            filename = entry[1]
+            transcode = entry[2]
+            if memory_budget:
+                memory_budget.acquire(path, filename, transcode)
+            if not lease.claim_file(sqlite_db, path, filename, "failed"):
+                if memory_budget:
+                    memory_budget.release(path, filename)
+                continue
+            transcode_job = pool.submit(transcode_file, sqlite_db, path, filename, transcode,
+                                        scratch_space, time_budget, resource_governor)
+            if memory_budget:
+                transcode_job.add_done_callback(lambda _job, path=path, filename=filename:
+                                                memory_budget.release(path, filename))
+            transcode_jobs.append(transcode_job)
+        for transcode_job in transcode_jobs:
+            transcode_job.result()
+
+
+def transcode_stream(sqlite_db: str, scan_thread: threading.Thread, limit: int | None = None,
+                     order: str = "scan", time_budget: budget.TimeBudget | None = None,
+                     memory_budget: memory.MemoryBudget | None = None) -> int:
+    """Transcode queued files as the running scan inserts them.
+
+    The queue is polled for new files whenever a worker is free,
+    until the scan has finished and no queued files are left.
+    Files are claimed with a lease, so other hosts can drain the same queue.
+    With SCRATCH_DIR, the next queued file is prefetched while every worker is busy.
+    With TIME_BUDGET, no more files are started once the time budget is over.
+    With GOVERNOR, no more files are started than the governor allows.
+    With MEMORY_BUDGET, files are claimed one at a time, and only while their predicted memory fits.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        scan_thread (threading.Thread): the running scan, or the watch of the scan path.
+        limit (int): maximum amount of files to transcode. None is unlimited.
+        order (str): name of the batch order policy.
+        time_budget (TimeBudget): time budget selecting the x265 presets. None uses the default preset.
+        memory_budget (MemoryBudget): memory budget admitting the jobs. None admits every job.
+
+    Returns:
+        Amount of files transcoded.
+    """
+    worker_count = workers.get_workers()
+    submitted_count = 0
+    running_jobs = {}
+    order_by = get_order_policies()[order]
+    with (lease.LeaseHeartbeat(sqlite_db), scratch.get_scratch_space() as scratch_space,
+          WorkerPool(worker_count) as pool, governor.get_governor(worker_count) as resource_governor):
+        while True:
+            scan_finished = not scan_thread.is_alive()
+            budget_over = bool(time_budget and time_budget.is_over())
+            allowed_workers = resource_governor.get_allowed_workers() if resource_governor else worker_count
+            free_workers = 0 if budget_over else allowed_workers - len(running_jobs)
+            if limit:
+                free_workers = min(free_workers, limit - submitted_count)
+            # Each claim with a memory budget is within the memory left by the previous claims
+            claim_limit = 1 if memory_budget else free_workers
+            while free_workers > 0:
+                memory_filter = memory_budget.get_filter() if memory_budget else ""
+                batch_queue = lease.claim_batch(sqlite_db, get_batch_filter() + memory_filter, order_by, claim_limit)
+                for path, filename, transcode in batch_queue:
+                    if memory_budget:
+                        memory_budget.reserve(path, filename, transcode)
+                    transcode_job = pool.submit(transcode_file, sqlite_db, path, filename, transcode,
+                                                scratch_space, time_budget, resource_governor)
+                    running_jobs[(path, filename)] = transcode_job
+                    submitted_count += 1
+                free_workers -= len(batch_queue)
+                if len(batch_queue) < claim_limit:
+                    break
+            if scratch_space:
+                # The next claim of this loop, with the same filters, so a prefetch is not stranded
+                next_file = None
+                if not budget_over and not (limit and submitted_count >= limit):
+                    memory_filter = memory_budget.get_filter() if memory_budget else ""
+                    for path, filename, _transcode in get_batch(sqlite_db, 1, order, memory_filter):
+                        next_file = f"{path}/{filename}"
+                scratch_space.prefetch(next_file, {f"{path}/{filename}" for path, filename in running_jobs})
+            if not running_jobs and (budget_over or (limit and submitted_count >= limit)):
+                break
+            # The governor holds the queued files while it allows no jobs
+            if not running_jobs and scan_finished and not (allowed_workers < 1 and get_batch(sqlite_db, 1, order)):
+                break
+            if not running_jobs:
+                # Idle until the scan or watch finds more files, or the governor allows jobs again
+                if scan_finished:
+                    time.sleep(config.pipeline_poll_interval)
+                else:
+                    scan_thread.join(config.pipeline_poll_interval)
+                continue
+            done_jobs, _pending = wait(running_jobs.values(),
+                                       timeout=config.pipeline_poll_interval,
+                                       return_when=FIRST_COMPLETED)
+            for video_key, transcode_job in list(running_jobs.items()):
+                if transcode_job in done_jobs:
+                    del running_jobs[video_key]
+                    if memory_budget:
+                        memory_budget.release(*video_key)
+                    transcode_job.result()
+    return submitted_count
+
+
+def update_directories(sqlite_db: str, scanned_directories: dict, scan_id: int, remove_missing: bool) -> None:
+    """Store the directory listings of the scan.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        scanned_directories (dict): dictionary of each directory to a tuple of
+            its 'mtime_ns', and its list of subdirectories.
+        scan_id (int): identifier of the completed scan.
+        remove_missing (bool): delete the directories which were not found by the scan.
+    """
+    directory_statement = """INSERT INTO directories (path, mtime_ns, subdirs, scan_id)
+                                VALUES (?, ?, ?, ?)
+                                ON CONFLICT (path) DO UPDATE SET
+                                    mtime_ns = excluded.mtime_ns,
+                                    subdirs = excluded.subdirs,
+                                    scan_id = excluded.scan_id ;
+    """
+    missing_statement = "DELETE FROM directories WHERE scan_id IS NOT ? ;"
+    directory_list = [
+        (path, mtime_ns, json.dumps(subdirs), scan_id)
+        for path, (mtime_ns, subdirs) in scanned_directories.items()
+    ]
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            with metrics.db_seconds.time(operation="directories"):
+                db_cursor.executemany(directory_statement, directory_list)
+                if remove_missing:
+                    db_cursor.execute(missing_statement, (scan_id,))
+        except sqlite3.Error:
+            logger.error("SQLite directories update failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+
+
+def update_directory_scan_id(sqlite_db: str, directory_list: list, scan_id: int) -> int:
+    """Mark the video files of unchanged directories as seen by the running scan.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        directory_list (list): list of the unchanged directories.
+        scan_id (int): identifier of the running scan.
+
+    Returns:
+        Amount of video files marked as seen.
+    """
+    scan_id_update_query = """UPDATE queue
+                                SET scan_id = ?
+                                WHERE path = ? AND
+                                status != 'removed' ;
+    """
+    unchanged_count = 0
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            with metrics.db_seconds.time(operation="unchanged"):
+                db_cursor.executemany(scan_id_update_query, [(scan_id, path) for path in directory_list])
+        except sqlite3.Error:
+            logger.error("SQLite scan_id update failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            unchanged_count = db_cursor.rowcount
+            db_cursor.close()
+    return unchanged_count
 
 
-def transcode_queue(sqlite_db: str, queue_list: list) -> None:
-    """Transcode the list of files.
+def update_failure(sqlite_db: str, path: str, filename: str, failure: str | None, fallbacks: set) -> None:
+    """Update the failure class and the fallbacks of the last attempt of a video file.
+
+    The update is queued like the status updates, and written before them.
 
     Args:
         sqlite_db (str): SQLite database file to use.
-        queue_list (list): list of tuples containing a path and filename.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+        failure (str): failure class of the attempt. None for success.
+        fallbacks (set): fallbacks used by the attempt.
+    """
+    failure_update_query = """UPDATE queue
+                                SET failure = ?,
+                                fallback = ?
+                                WHERE path = ? AND
+                                filename = ? AND
+                                (worker_id IS NULL OR worker_id = ?) ;
     """
-    for entry in queue_list:
-        path = entry[0]
-        filename = entry[1]
-        video_file = Transcode(sqlite_db, path, filename)
-        transcode_video = video_file.transcode()
-        if (transcode_video == "done") and (DELETE):
-            video_file.delete_original()
+    failure_update_data = (failure, failures.join_fallbacks(fallbacks), path, filename, lease.get_worker_id())
+    DatabaseInterface(sqlite_db).queue_write(failure_update_query, failure_update_data, (path, filename))
 
 
 def update_metadata(sqlite_db: str) -> None:
     """Update the metadata of the video file.
 
+    MP4 files are updated in place, and skipped when their title and
+    comment already match. exiftool is used for the MP4 files which
+    could not be updated in place.
+
     Args:
         sqlite_db (str): SQLite database file to use.
     """
@@ -466,60 +1281,157 @@ def update_metadata(sqlite_db: str) -> None:
             db_cursor.close()
             logger.debug("Successfully retrieved list of files to update metadata.")
 
-    for file in metadata_queue:
-        path = file[0]
-        filename = file[1]
-        video_file = f"{path}/{filename}"
-        if filename.endswith(".mp4"):
-            try:
+    with ExifToolInterface() as exiftool:
+        for index, file in enumerate(metadata_queue, start=1):
+            path = file[0]
+            filename = file[1]
+            video_file = f"{path}/{filename}"
+            if filename.endswith(".mp4"):
                 video_title = filename.removesuffix(".mp4")
-                update_metadata_cmd = ["/usr/bin/exiftool",
-                                        "-overwrite_original",
-                                        f"-title={video_title}",
-                                        "-comment=",
-                                        video_file]
-                subprocess.run(update_metadata_cmd,
-                                capture_output = True,
-                                check = True,
-                                text = True)
-            except subprocess.CalledProcessError:
-                update_metadata_err = f"Invalid MP4 file type for '{video_file}'. Transcode to update the metadata."
-                logger.error(update_metadata_err)
+                try:
+                    updated = mp4tags.write_tags(video_file, video_title)
+                except (OSError, probe.ProbeError, struct.error) as tag_err:
+                    tag_err_msg = f"Unable to update '{video_file}' in place: {tag_err}. Using exiftool."
+                    logger.debug(tag_err_msg)
+                    exiftool.queue_write(video_file, {"title": video_title, "comment": ""})
+                else:
+                    if updated:
+                        update_metadata_msg = f"Updated metadata for '{video_file}'."
+                        logger.info(update_metadata_msg)
+                    else:
+                        unchanged_msg = f"Metadata for '{video_file}' is already up to date."
+                        logger.debug(unchanged_msg)
             else:
-                update_metadata_msg = f"Updated metadata for '{video_file}'."
-                logger.info(update_metadata_msg)
+                file_type_warn = f"'{video_file}' is not MP4. Transcode to update the metadata."
+                logger.warning(file_type_warn)
+            if (index % config.exiftool_batch == 0) or (index == len(metadata_queue)):
+                log_metadata_results(exiftool.flush_writes())
+
+
+def update_removed(sqlite_db: str, scan_id: int) -> int:
+    """Mark the video files which were not found by the scan as removed.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        scan_id (int): identifier of the completed scan.
+
+    Returns:
+        Amount of video files marked as removed.
+    """
+    removed_update_query = """UPDATE queue
+                                SET status = 'removed',
+                                transcode = 'N'
+                                WHERE scan_id IS NOT ? AND
+                                status != 'removed' ;
+    """
+    removed_count = 0
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            with metrics.db_seconds.time(operation="removed"):
+                db_cursor.execute(removed_update_query, (scan_id,))
+        except sqlite3.Error:
+            logger.error("SQLite removed status update failed.")
+            logger.exception(sqlite3.Error)
         else:
-            file_type_warn = f"'{video_file}' is not MP4. Transcode to update the metadata."
-            logger.warning(file_type_warn)
+            removed_count = db_cursor.rowcount
+            db_cursor.close()
+            removed_msg = f"Marked {removed_count} video file(s) as removed."
+            logger.debug(removed_msg)
+    return removed_count
 
 
-def update_status(sqlite_db: str, path: str, filename: str, status: str) -> None:
-    """Update the status of the video file.
+def update_removed_paths(sqlite_db: str, removed_paths: list) -> int:
+    """Mark deleted video files, or every video file in deleted directories, as removed.
 
     Args:
         sqlite_db (str): SQLite database file to use.
-        path (str): path for the video file.
-        filename (str): filename for the video file.
-        status (str): new status for the video file.
+        removed_paths (list): list of tuples containing the path and filename
+            of a video file, or the path and None for a directory.
+
+    Returns:
+        Amount of video files marked as removed.
     """
-    status_update_query = """UPDATE queue
-                                SET status = ?
+    removed_file_query = """UPDATE queue
+                                SET status = 'removed',
+                                transcode = 'N'
+                                WHERE path = ? AND
+                                filename = ? AND
+                                status != 'removed' ;
+    """
+    removed_directory_query = """UPDATE queue
+                                    SET status = 'removed',
+                                    transcode = 'N'
+                                    WHERE (path = ? OR substr(path, 1, length(?)) = ?) AND
+                                    status != 'removed' ;
+    """
+    removed_count = 0
+    with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
+        try:
+            with metrics.db_seconds.time(operation="removed"):
+                for path, filename in removed_paths:
+                    if filename is None:
+                        db_cursor.execute(removed_directory_query, (path, f"{path}/", f"{path}/"))
+                    else:
+                        db_cursor.execute(removed_file_query, (path, filename))
+                    removed_count += db_cursor.rowcount
+        except sqlite3.Error:
+            logger.error("SQLite removed status update failed.")
+            logger.exception(sqlite3.Error)
+        else:
+            db_cursor.close()
+            removed_msg = f"Marked {removed_count} video file(s) as removed."
+            logger.info(removed_msg)
+    return removed_count
+
+
+def update_scan_id(sqlite_db: str, unchanged_list: list) -> None:
+    """Mark the unchanged video files as seen by the running scan.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        unchanged_list (list): list containing a list of the scan_id, path, and filename.
+    """
+    scan_id_update_query = """UPDATE queue
+                                SET scan_id = ?
                                 WHERE path = ? AND
                                 filename = ? ;
     """
-    status_update_data = (status, path, filename)
     with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
         try:
-            db_cursor.execute(status_update_query, status_update_data)
+            with metrics.db_seconds.time(operation="unchanged"):
+                db_cursor.executemany(scan_id_update_query, unchanged_list)
         except sqlite3.Error:
-            update_query_msg = f"{status_update_data=}"
-            logger.debug(update_query_msg)
-            logger.error("SQLite transcode status update failed.")
+            logger.error("SQLite scan_id update failed.")
             logger.exception(sqlite3.Error)
         else:
             db_cursor.close()
-            sql_update_msg = f"Updated status for '{path}/{filename}' to '{status}'."
-            logger.info(sql_update_msg)
+
+
+def update_status(sqlite_db: str, path: str, filename: str, status: str) -> None:
+    """Update the status of the video file, and release its lease.
+
+    The status update is queued, and written with other queued updates
+    in a single transaction. A video file claimed by another worker, after
+    the lease of this worker expired, is left to the other worker.
+
+    Args:
+        sqlite_db (str): SQLite database file to use.
+        path (str): path for the video file.
+        filename (str): filename for the video file.
+        status (str): new status for the video file.
+    """
+    status_update_query = """UPDATE queue
+                                SET status = ?,
+                                worker_id = NULL,
+                                lease_expires = NULL
+                                WHERE path = ? AND
+                                filename = ? AND
+                                (worker_id IS NULL OR worker_id = ?) ;
+    """
+    status_update_data = (status, path, filename, lease.get_worker_id())
+    DatabaseInterface(sqlite_db).queue_write(status_update_query, status_update_data, (path, filename))
+    sql_update_msg = f"Updated status for '{path}/{filename}' to '{status}'."
+    logger.info(sql_update_msg)
 
 
 def verify_database() -> int:
@@ -532,7 +1444,7 @@ def verify_database() -> int:
     setup_database(sqlite_db)
 
     queue_count = 0
-    query_queue = "SELECT COUNT(*) FROM queue ;"
+    query_queue = "SELECT COALESCE(SUM(count), 0) FROM status_count ;"
     with DatabaseInterface(sqlite_db) as (_connect, db_cursor):
         try:
             queue_result = db_cursor.execute(query_queue)
@@ -548,23 +1460,16 @@ def verify_database() -> int:
     return queue_count
 
 
-def verify_metadata(filename: str) -> tuple:
+def verify_metadata(filename: str, file_type: str) -> tuple:
     """Verify the metadata for an invalid video file type.
 
     Args:
         filename (str): video file to check its metadata.
+        file_type (str): DocType metadata read from the video file.
 
     Returns:
         A tuple containing the transcode and queue status values.
     """
-    file_type_cmd = ["/usr/bin/exiftool",
-                     "-s3", "-DocType",
-                     filename]
-    file_type_sp = subprocess.run(file_type_cmd,
-                                    capture_output = True,
-                                    check = True,
-                                    text = True)
-    file_type = file_type_sp.stdout.lower().strip()
     if file_type == "matroska":
         filetype_mkv_msg = f"'{filename}' is MKV file type, not MP4. Queued for transcoding."
         logger.warning(filetype_mkv_msg)
@@ -574,3 +1479,40 @@ def verify_metadata(filename: str) -> tuple:
         logger.error(filetype_unknown_msg)
         transcode_status = ("N", "unknown")
     return transcode_status
+
+
+def walk_directory(scan_path: str, video_queue: queue.Queue, walk_errors: list,
+                   known_directories: dict | None = None, scanned_directories: dict | None = None) -> None:
+    """Walk the scan path, and queue each video file with its fingerprint.
+
+    The directories are listed by a bounded thread pool, so the round trips
+    of a network mount overlap instead of adding up. The queue is bounded,
+    so the walk waits for the probing to keep up.
+
+    Args:
+        scan_path (str): directory to scan recursively.
+        video_queue (queue.Queue): queue of tuples containing the path, filename,
+            and '(size, mtime_ns, inode)' fingerprint. None is queued when the walk ends.
+        walk_errors (list): list of directory errors during the walk.
+        known_directories (dict): directory listings of the last scan. None lists every directory.
+        scanned_directories (dict): dictionary to add the listing of each complete directory to.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=config.scan_threads, thread_name_prefix="walk") as pool:
+            pending_listings = {pool.submit(list_directory, scan_path, video_queue, walk_errors, known_directories)}
+            while pending_listings:
+                done_listings, pending_listings = wait(pending_listings, return_when=FIRST_COMPLETED)
+                for listing in done_listings:
+                    directory_listing = listing.result()
+                    if directory_listing is None:
+                        continue
+                    directory, mtime_ns, subdirs, complete = directory_listing
+                    if complete and scanned_directories is not None:
+                        scanned_directories[directory] = (mtime_ns, subdirs)
+                    pending_listings.update(
+                        pool.submit(list_directory, os.path.join(directory, subdir), video_queue,
+                                    walk_errors, known_directories)
+                        for subdir in subdirs
+                    )
+    finally:
+        video_queue.put(None)
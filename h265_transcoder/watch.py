@@ -0,0 +1,353 @@
+"""Contains the watch mode, which queues new or changed video files as they appear."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+from h265_transcoder import config, tasks
+from h265_transcoder.interfaces import ExifToolInterface
+
+logger = logging.getLogger("app")
+WATCH = bool(os.getenv("WATCH", "False").lower() == "true")
+WATCH_POLL_INTERVAL = os.getenv("WATCH_POLL_INTERVAL", "300")
+WATCH_STABLE_SECONDS = os.getenv("WATCH_STABLE_SECONDS", "60")
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+# Network and FUSE file systems do not send inotify events for changes from other hosts
+POLLING_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "ceph", "glusterfs", "fuse")
+VIDEO_EXTENSIONS = (".mkv", ".mp4")
+
+
+class InotifyError(Exception):
+    """inotify is not available, or ran out of watches."""
+
+
+class Inotify:
+    """Recursive inotify watch of a directory tree, with the libc calls through ctypes."""
+    def __init__(self) -> None:
+        """Create the inotify instance."""
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.libc.inotify_init1.argtypes = [ctypes.c_int]
+            self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError) as libc_err:
+            raise InotifyError(f"inotify is not available: {libc_err}") from libc_err
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise InotifyError(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self.directories = {}
+
+    def add_tree(self, directory: str) -> list:
+        """Watch a directory and all of its subdirectories.
+
+        Args:
+            directory (str): root of the directory tree.
+
+        Returns:
+            List of tuples containing the path and filename of the video files in the tree.
+        """
+        video_files = []
+        for root, _dirs, files in os.walk(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                watch_errno = ctypes.get_errno()
+                if watch_errno == errno.ENOSPC:
+                    raise InotifyError("Out of inotify watches. Raise fs.inotify.max_user_watches.")
+                watch_err_msg = f"Unable to watch '{root}': {os.strerror(watch_errno)}"
+                logger.warning(watch_err_msg)
+                continue
+            self.directories[wd] = root
+            video_files.extend((root, filename) for filename in files if filename.endswith(VIDEO_EXTENSIONS))
+        return video_files
+
+    def read_events(self, timeout: float) -> list:
+        """Wait for inotify events.
+
+        Args:
+            timeout (float): seconds to wait for events.
+
+        Returns:
+            List of tuples containing the event mask, the directory, and the name.
+            The directory is None when the event queue overflowed.
+        """
+        readable, _writable, _errors = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\x00"))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None, ""))
+                continue
+            directory = self.directories.get(wd)
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            if directory is not None:
+                events.append((mask, directory, name))
+        return events
+
+    def close(self) -> None:
+        """Close the inotify instance, which removes all of the watches."""
+        os.close(self.fd)
+
+
+class WatchThread(threading.Thread):
+    """Scan once, then queue the new or changed video files while running.
+
+    Video files are queued when their size and modification time have been
+    stable for WATCH_STABLE_SECONDS, so files which are still being copied
+    are not probed. Changes come from inotify, or from polling the directory
+    tree every WATCH_POLL_INTERVAL on network file systems.
+    """
+    def __init__(self, sqlite_db: str) -> None:
+        """Setup the watch of the scan path.
+
+        Args:
+            sqlite_db (str): SQLite database file to use.
+        """
+        super().__init__(name="watch", daemon=True)
+        self.sqlite_db = sqlite_db
+        self.scan_path = config.scan_path
+        self.stable_seconds = get_setting(WATCH_STABLE_SECONDS, "WATCH_STABLE_SECONDS", 60.0)
+        self.poll_interval = get_setting(WATCH_POLL_INTERVAL, "WATCH_POLL_INTERVAL", 300.0)
+        self.pending = {}
+        self.removed = []
+        self.stop_event = threading.Event()
+        self.scan_error = None
+
+    def run(self) -> None:
+        """Scan the directory, then watch it until stopped."""
+        try:
+            tasks.scan_directory(self.sqlite_db)
+            # From tasks, so the simulation backend replaces it
+            with tasks.ExifToolInterface() as exiftool:
+                inotify = None
+                if get_filesystem_type(self.scan_path).startswith(POLLING_FILESYSTEMS):
+                    polling_msg = f"'{self.scan_path}' is a network file system. Polling for changes."
+                    logger.info(polling_msg)
+                else:
+                    try:
+                        inotify = Inotify()
+                        inotify.add_tree(self.scan_path)
+                    except InotifyError as inotify_err:
+                        inotify_err_msg = f"{inotify_err} Polling for changes."
+                        logger.warning(inotify_err_msg)
+                        if inotify is not None:
+                            inotify.close()
+                        inotify = None
+                if inotify is None:
+                    self.poll(exiftool)
+                else:
+                    watch_msg = f"Watching {len(inotify.directories)} directories for changes."
+                    logger.info(watch_msg)
+                    try:
+                        self.watch(inotify, exiftool)
+                    finally:
+                        inotify.close()
+        except (SystemExit, Exception) as scan_error:
+            self.scan_error = scan_error
+
+    def watch(self, inotify: Inotify, exiftool: ExifToolInterface) -> None:
+        """Queue the video files from the inotify events.
+
+        Args:
+            inotify (Inotify): inotify watch of the scan path.
+            exiftool (ExifToolInterface): running exiftool session.
+        """
+        while not self.stop_event.is_set():
+            for mask, directory, name in inotify.read_events(config.watch_tick):
+                if directory is None:
+                    logger.warning("inotify events were lost. Rescanning.")
+                    tasks.scan_directory(self.sqlite_db)
+                    inotify.add_tree(self.scan_path)
+                elif mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        for video_file in inotify.add_tree(f"{directory}/{name}"):
+                            self.add_pending(*video_file)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.removed.append((f"{directory}/{name}", None))
+                elif name.endswith(VIDEO_EXTENSIONS):
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.pending.pop((directory, name), None)
+                        self.removed.append((directory, name))
+                    else:
+                        self.add_pending(directory, name)
+            self.queue_stable(exiftool)
+
+    def poll(self, exiftool: ExifToolInterface) -> None:
+        """Queue the video files which changed between walks of the directory tree.
+
+        Args:
+            exiftool (ExifToolInterface): running exiftool session.
+        """
+        known_files = scan_tree(self.scan_path)
+        next_poll = time.monotonic() + self.poll_interval
+        while not self.stop_event.wait(config.watch_tick):
+            if time.monotonic() >= next_poll:
+                current_files = scan_tree(self.scan_path)
+                for video_file, fingerprint in current_files.items():
+                    if known_files.get(video_file) != fingerprint:
+                        self.add_pending(*video_file)
+                self.removed.extend(video_file for video_file in known_files
+                                    if video_file not in current_files)
+                known_files = current_files
+                next_poll = time.monotonic() + self.poll_interval
+            self.queue_stable(exiftool)
+
+    def add_pending(self, path: str, filename: str) -> None:
+        """Wait for a video file to be stable before queueing it.
+
+        Args:
+            path (str): path of the video file.
+            filename (str): filename of the video file.
+        """
+        if (path, filename) not in self.pending:
+            self.pending[(path, filename)] = [None, time.monotonic()]
+
+    def queue_stable(self, exiftool: ExifToolInterface) -> None:
+        """Probe and queue the pending video files which are stable, and mark the removed ones.
+
+        Args:
+            exiftool (ExifToolInterface): running exiftool session.
+        """
+        if self.removed:
+            tasks.update_removed_paths(self.sqlite_db, self.removed)
+            self.removed = []
+        now = time.monotonic()
+        stable_batch = []
+        for (path, filename), pending_file in list(self.pending.items()):
+            try:
+                file_stat = os.stat(f"{path}/{filename}")
+            except OSError:
+                del self.pending[(path, filename)]
+                continue
+            fingerprint = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+            if fingerprint != pending_file[0]:
+                self.pending[(path, filename)] = [fingerprint, now]
+            elif now - pending_file[1] >= self.stable_seconds:
+                del self.pending[(path, filename)]
+                stable_batch.append((path, filename, fingerprint))
+        for batch_start in range(0, len(stable_batch), config.exiftool_batch):
+            video_batch = stable_batch[batch_start:batch_start + config.exiftool_batch]
+            changed_count = tasks.scan_batch(self.sqlite_db, exiftool, video_batch, time.time_ns())
+            watch_msg = f"Queued {changed_count} new or changed video file(s)."
+            logger.info(watch_msg)
+
+    def stop(self) -> None:
+        """Stop watching after the current events."""
+        self.stop_event.set()
+
+    def wait(self) -> None:
+        """Wait for the watch to stop, and exit if the scan failed."""
+        self.join()
+        if self.scan_error:
+            raise self.scan_error
+
+
+def get_filesystem_type(directory: str) -> str:
+    """Get the file system type of the mount containing a directory.
+
+    Args:
+        directory (str): the directory.
+
+    Returns:
+        File system type from '/proc/mounts', or an empty string if not found.
+    """
+    directory = os.path.realpath(directory)
+    filesystem_type = ""
+    mount_length = -1
+    try:
+        mounts = Path("/proc/mounts").read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return filesystem_type
+    for mount in mounts:
+        mount_fields = mount.split()
+        if len(mount_fields) < 3:
+            continue
+        mount_point = mount_fields[1].replace("\\040", " ")
+        if ((directory == mount_point or directory.startswith(mount_point.rstrip("/") + "/"))
+                and len(mount_point) > mount_length):
+            filesystem_type = mount_fields[2]
+            mount_length = len(mount_point)
+    return filesystem_type
+
+
+def get_setting(value: str, name: str, default: float) -> float:
+    """Parse a numeric watch setting.
+
+    Args:
+        value (str): value of the environment variable.
+        name (str): name of the environment variable.
+        default (float): value when it is not a number.
+
+    Returns:
+        The setting in seconds, at least 0.
+    """
+    try:
+        setting = float(value)
+    except ValueError:
+        value_error_msg = f"{name} is not a number. {value=}. Using {default}."
+        logger.error(value_error_msg)
+        setting = default
+    return max(0.0, setting)
+
+
+def scan_tree(directory: str) -> dict:
+    """Walk a directory tree with 'os.scandir', and fingerprint each video file.
+
+    Args:
+        directory (str): root of the directory tree.
+
+    Returns:
+        Dictionary of '(path, filename)' to the '(size, mtime_ns, inode)' of each video file.
+    """
+    video_files = {}
+    directories = [directory]
+    while directories:
+        current_directory = directories.pop()
+        try:
+            with os.scandir(current_directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.endswith(VIDEO_EXTENSIONS):
+                        file_stat = entry.stat()
+                        video_files[(current_directory, entry.name)] = (file_stat.st_size,
+                                                                        file_stat.st_mtime_ns,
+                                                                        file_stat.st_ino)
+        except OSError:
+            scandir_err_msg = f"Unable to read '{current_directory}'."
+            logger.warning(scandir_err_msg)
+    return video_files
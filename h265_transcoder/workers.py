@@ -0,0 +1,157 @@
+"""Contains the transcoding worker pool and CPU partitioning."""
+
+import logging
+import os
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from h265_transcoder import governor
+
+logger = logging.getLogger("app")
+WORKERS = os.getenv("WORKERS", "1")
+AFFINITY = bool(os.getenv("AFFINITY", "False").lower() == "true")
+
+
+class WorkerPool:
+    """Run transcoding jobs concurrently, each with its own share of the CPUs."""
+    def __init__(self, workers: int) -> None:
+        """Setup the worker threads and their CPU slots.
+
+        Args:
+            workers (int): number of concurrent transcoding jobs.
+        """
+        self.workers = workers
+        self.cpu_slots = get_cpu_slots(workers)
+        self.free_slots = queue.Queue()
+        for slot in range(len(self.cpu_slots)):
+            self.free_slots.put(slot)
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="transcode")
+        pool_msg = f"Started {workers} transcoding worker(s)."
+        logger.debug(pool_msg)
+
+    def __enter__(self) -> "WorkerPool":
+        """Returns the worker pool."""
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback) -> None:
+        """Wait for the running jobs, then stop the worker threads."""
+        if exception_type:
+            exception_msg = f"An exception occurred: {exception_type}, {exception_value}"
+            logger.error(exception_msg)
+        self.executor.shutdown(wait=True)
+        logger.debug("Transcoding workers stopped.")
+
+    def run_job(self, job, *args) -> str:
+        """Run a job in a free CPU slot.
+
+        With AFFINITY, the worker thread is pinned to the CPU slot,
+        and the ffmpeg process started by the job inherits it.
+        With GOVERNOR, it also inherits the lowered CPU and I/O priority.
+
+        Args:
+            job: callable accepting the job arguments, and the CPUs to use.
+            args: arguments for the job.
+
+        Returns:
+            The job result.
+        """
+        slot = self.free_slots.get()
+        cpus = self.cpu_slots[slot]
+        try:
+            if AFFINITY:
+                os.sched_setaffinity(0, cpus)
+            if governor.GOVERNOR:
+                governor.set_priority()
+            return job(*args, cpus if self.workers > 1 else None)
+        finally:
+            self.free_slots.put(slot)
+
+    def submit(self, job, *args) -> Future:
+        """Queue a job for the next free worker.
+
+        Args:
+            job: callable accepting the job arguments, and the CPUs to use.
+            args: arguments for the job.
+
+        Returns:
+            Future of the job result.
+        """
+        return self.executor.submit(self.run_job, job, *args)
+
+
+def get_cpu_slots(workers: int) -> list:
+    """Partition the available CPUs between the workers.
+
+    Args:
+        workers (int): number of concurrent transcoding jobs.
+
+    Returns:
+        List with a list of CPU numbers for each worker.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    slot_size = max(1, len(cpus) // workers)
+    cpu_slots = []
+    for slot in range(workers):
+        cpu_slot = cpus[slot * slot_size:(slot + 1) * slot_size]
+        cpu_slots.append(cpu_slot or cpus)
+    if workers > len(cpus):
+        oversubscribe_msg = f"{workers} workers share {len(cpus)} CPU(s)."
+        logger.warning(oversubscribe_msg)
+    return cpu_slots
+
+
+def get_frame_threads(cpu_count: int) -> int:
+    """Get the x265 frame threads for a number of CPUs.
+
+    Matches the x265 defaults for a machine with the same number of CPUs.
+
+    Args:
+        cpu_count (int): number of CPUs for the job.
+
+    Returns:
+        Number of frame threads.
+    """
+    if cpu_count >= 32:
+        frame_threads = 6
+    elif cpu_count >= 16:
+        frame_threads = 5
+    elif cpu_count >= 8:
+        frame_threads = 3
+    elif cpu_count >= 4:
+        frame_threads = 2
+    else:
+        frame_threads = 1
+    return frame_threads
+
+
+def get_workers() -> int:
+    """Get the number of concurrent transcoding jobs.
+
+    Returns:
+        Number of workers, at least 1.
+    """
+    try:
+        workers = int(WORKERS)
+    except ValueError:
+        value_error_msg = f"WORKERS is not an integer. {WORKERS=}."
+        logger.error(value_error_msg)
+        workers = 1
+    if workers < 1:
+        workers_msg = f"{workers=}. WORKERS variable must be a positive number. Setting to 1."
+        logger.warning(workers_msg)
+        workers = 1
+    return workers
+
+
+def get_x265_params(cpus: list) -> str:
+    """Get the x265 parameters limiting the encoder to a share of the CPUs.
+
+    Args:
+        cpus (list): CPUs for the x265 thread pool.
+
+    Returns:
+        x265 parameters for the 'x265-params' ffmpeg option.
+    """
+    frame_threads = get_frame_threads(len(cpus))
+    return f"pools={len(cpus)}:frame-threads={frame_threads}"
@@ -0,0 +1,32 @@
+"""Shared setup of the unit tests."""
+
+import os
+
+import pytest
+
+# Variables read when the modules are imported, which docker-compose always sets
+os.environ.setdefault("DEBUG", "false")
+os.environ.setdefault("DELETE", "false")
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """SQLite database with every schema migration applied."""
+    from h265_transcoder import tasks
+    from h265_transcoder.interfaces import DatabaseInterface
+
+    sqlite_db = str(tmp_path / "transcode.db")
+    tasks.setup_database(sqlite_db)
+    yield sqlite_db
+    DatabaseInterface(sqlite_db).close()
+
+
+def add_queue(sqlite_db: str, *rows: dict) -> None:
+    """Insert video files into the queue, with the columns of each row."""
+    import sqlite3
+
+    with sqlite3.connect(sqlite_db) as connection:
+        for row in rows:
+            connection.execute(f"INSERT INTO queue ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                               tuple(row.values()))
+    connection.close()
@@ -0,0 +1,56 @@
+"""Tests of the time-budget preset selection."""
+
+import sqlite3
+from datetime import datetime
+from types import SimpleNamespace
+
+from h265_transcoder import budget, governor, lease
+from tests.conftest import add_queue
+
+
+def add_history(sqlite_db: str, preset: str, pixel_rate: float) -> None:
+    """Add a finished 1080p job of a preset, with a throughput in pixel-seconds per wall second."""
+    add_queue(sqlite_db, {"path": "/mnt", "filename": f"{preset}.mkv", "transcode": "Y", "status": "done",
+                          "width": 1920, "height": 1080, "duration": 600})
+    with sqlite3.connect(sqlite_db) as connection:
+        connection.execute("""INSERT INTO job_stats (path, filename, started, transcode, preset, status,
+                                wall_time, avg_speed) VALUES ('/mnt', ?, 0, 'Y', ?, 'done', 100, ?)""",
+                           (f"{preset}.mkv", preset, pixel_rate / (1920 * 1080)))
+    connection.close()
+
+
+def test_quiet_seconds():
+    quiet_hours = [(22 * 60, 6 * 60)]
+    start = datetime(2026, 1, 1, 20, 0)
+    assert governor.get_quiet_seconds(quiet_hours, start, 4 * 3600) == 2 * 3600
+    assert governor.get_quiet_seconds(quiet_hours, start, 24 * 3600) == 8 * 3600
+    assert governor.get_quiet_seconds([], start, 3600) == 0.0
+
+
+def test_other_hosts_share_the_queue(sqlite_db, monkeypatch):
+    monkeypatch.setattr(lease, "WORKER_ID", "host-a")
+    time_budget = budget.TimeBudget(sqlite_db, 3600)
+    time_budget.workers = 2
+    assert time_budget.get_job_count(3600, None) == 2
+    add_queue(sqlite_db, *({"path": "/mnt", "filename": f"{index}.mkv", "transcode": "Y", "status": "active",
+                            "worker_id": worker_id} for index, worker_id in enumerate(["host-a", "host-b", "host-b"])))
+    assert time_budget.get_job_count(3600, None) == 4
+
+
+def test_quiet_hours_throttle(sqlite_db, monkeypatch):
+    time_budget = budget.TimeBudget(sqlite_db, 4 * 3600)
+    time_budget.workers = 4
+    monkeypatch.setattr(governor, "get_quiet_seconds", lambda _quiet_hours, _start, seconds: seconds / 2)
+    resource_governor = SimpleNamespace(quiet_hours=[(0, 0)], throttle_workers=1)
+    assert time_budget.get_job_count(4 * 3600, resource_governor) == 2.5
+
+
+def test_select_preset(sqlite_db):
+    add_history(sqlite_db, "medium", 1920 * 1080 * 10)
+    add_queue(sqlite_db, {"path": "/mnt", "filename": "next.mkv", "transcode": "Y", "status": "queued",
+                          "width": 1920, "height": 1080, "duration": 3600})
+    time_budget = budget.TimeBudget(sqlite_db, 400)
+    time_budget.workers = 1
+    assert time_budget.select_preset() == "medium"
+    time_budget.deadline -= 200
+    assert time_budget.select_preset() == "faster"
@@ -0,0 +1,22 @@
+"""Tests of the benchmark corpus."""
+
+import json
+
+from benchmarks import corpus
+
+
+def test_generated_corpus_is_reused(tmp_path, monkeypatch):
+    generated = []
+
+    def generate_media(media_file, *_args):
+        generated.append(media_file)
+        media_file.write_bytes(bytes(64))
+
+    monkeypatch.setitem(corpus.PROFILES, "test", (("160x120",), (1,), 3))
+    monkeypatch.setattr(corpus, "generate_media", generate_media)
+    monkeypatch.setattr(corpus, "generate_invalid", lambda _invalid_dir, _media_file: None)
+    manifest = corpus.generate_corpus(tmp_path, "test")
+    assert len(generated) == len(corpus.VARIANTS)
+    assert corpus.generate_corpus(tmp_path, "test") == manifest
+    assert len(generated) == len(corpus.VARIANTS)
+    assert json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))["settings"] == [["160x120"], [1], 3]
@@ -0,0 +1,138 @@
+"""Tests of the ffmpeg failure classification and its fallbacks."""
+
+import shutil
+import subprocess
+
+import pytest
+from ffmpeg import FFmpegError
+
+from h265_transcoder import failures
+
+# stderr samples of failed ffmpeg 7 runs
+WMA_IN_MP4 = [
+    "[mp4 @ 0x28cf7240] Could not find tag for codec wmav2 in stream #0, codec not currently supported in container",
+    "[out#0/mp4 @ 0x28cf7fc0] Could not write header (incorrect codec parameters ?): Invalid argument",
+    "Conversion failed!"
+]
+WMV_IN_MP4 = [
+    "[mp4 @ 0x365c6280] Could not find tag for codec wmv2 in stream #0, codec not currently supported in container",
+    "[out#0/mp4 @ 0x365c6140] Could not write header (incorrect codec parameters ?): Invalid argument",
+    "Conversion failed!"
+]
+REJECTED_HEADER = [
+    "[out#0/mp4 @ 0x18b84440] Could not write header (incorrect codec parameters ?): "
+    "Invalid data found when processing input",
+    "Conversion failed!"
+]
+GARBAGE_INPUT = [
+    "[in#0 @ 0x18a36a40] Error opening input: Invalid data found when processing input",
+    "Error opening input file garbage.mkv.",
+    "Error opening input files: Invalid data found when processing input"
+]
+TRUNCATED_MP4 = [
+    "[mov,mp4,m4a,3gp,3g2,mj2 @ 0x1f704d80] moov atom not found",
+    "[in#0 @ 0x1f704a40] Error opening input: Invalid data found when processing input",
+    "Error opening input file trunc.mp4."
+]
+DISK_FULL = [
+    "[out#0/mp4 @ 0x33a81180] Error muxing a packet",
+    "av_interleaved_write_frame(): No space left on device",
+    "Error writing trailer: No space left on device"
+]
+SIGTERM = [
+    "frame=  120 fps= 24 q=30.0 size=    1024KiB time=00:00:05.00 bitrate=1677.7kbits/s speed=0.98x",
+    "Exiting normally, received signal 15."
+]
+
+
+@pytest.mark.parametrize(("stderr_lines", "return_code", "failure"), [
+    (WMA_IN_MP4, 234, "audio"),
+    (WMV_IN_MP4, 234, "unknown"),
+    (REJECTED_HEADER, 234, "unknown"),
+    (GARBAGE_INPUT, 183, "corrupt"),
+    (TRUNCATED_MP4, 183, "corrupt"),
+    (DISK_FULL, 228, "disk"),
+    (SIGTERM, 255, "killed"),
+    (["Conversion failed!"], -9, "killed"),
+    (["Conversion failed!"], 1, "unknown")
+])
+def test_classify_failure(stderr_lines, return_code, failure):
+    assert failures.classify_failure(stderr_lines[-1], stderr_lines[:-1], return_code) == failure
+
+
+def test_experimental_codecs():
+    assert failures.classify_failure("opus in MP4 support is experimental, add '-strict -2'", []) == "audio"
+    assert failures.classify_failure("vp9 in MP4 support is experimental, add '-strict -2'", []) == "unknown"
+
+
+def test_get_retry():
+    assert failures.get_retry("audio", set()) == {"aac"}
+    assert failures.get_retry("corrupt", {"aac"}) == {"aac", "tolerant"}
+    assert failures.get_retry("audio", {"aac"}) is None
+    assert failures.get_retry("disk", set()) is None
+    assert failures.get_retry("unknown", {"tolerant"}) == {"tolerant"}
+
+
+def test_fallbacks_column():
+    assert failures.join_fallbacks(set()) is None
+    assert failures.split_fallbacks(failures.join_fallbacks({"tolerant", "aac"})) == {"aac", "tolerant"}
+    input_options, output_options = {}, {"codec:a": "copy"}
+    failures.apply_fallbacks({"aac", "tolerant"}, input_options, output_options)
+    assert output_options["codec:a"] == "aac"
+    assert input_options["err_detect"] == "ignore_err"
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+@pytest.mark.parametrize(("video_codec", "audio_codec", "fallbacks"), [
+    ("libx264", "aac", set()),
+    ("wmv2", "aac", set()),
+    ("libx264", "wmav2", {"aac"})
+])
+def test_preflight(tmp_path, video_codec, audio_codec, fallbacks):
+    video_file = tmp_path / "video.mkv"
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=s=160x120:d=3",
+                    "-f", "lavfi", "-i", "sine=d=3", "-codec:v", video_codec, "-codec:a", audio_codec,
+                    "-shortest", str(video_file)], check=True)
+    assert failures.preflight(str(video_file), set()) == (fallbacks, None)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_preflight_garbage(tmp_path):
+    video_file = tmp_path / "video.mkv"
+    video_file.write_bytes(bytes(index * 7 % 256 for index in range(65536)))
+    assert failures.preflight(str(video_file), set()) == ({"tolerant"}, "corrupt")
+
+
+class FailingFFmpeg:
+    """ffmpeg command which fails with a stderr line."""
+    stderr_line = ""
+
+    def __init__(self):
+        self.handlers = []
+
+    def option(self, *_args):
+        return self
+
+    def input(self, *_args):
+        return self
+
+    def output(self, *_args):
+        return self
+
+    def on(self, _event, handler):
+        self.handlers.append(handler)
+
+    def execute(self):
+        for handler in self.handlers:
+            handler(self.stderr_line)
+        raise FFmpegError(self.stderr_line, [])
+
+
+@pytest.mark.parametrize(("stderr_line", "failure"), [
+    ("/mnt/video.mkv: Input/output error", None),
+    ("Error writing trailer of preflight.mp4: No space left on device", "disk")
+])
+def test_preflight_only_fails_doomed_files(monkeypatch, stderr_line, failure):
+    monkeypatch.setattr(FailingFFmpeg, "stderr_line", stderr_line)
+    monkeypatch.setattr(failures, "FFmpeg", FailingFFmpeg)
+    assert failures.preflight("/mnt/video.mkv", set()) == (set(), failure)
@@ -0,0 +1,25 @@
+"""Tests of the resource governor."""
+
+import time
+
+from h265_transcoder import governor
+
+
+def test_paused_seconds():
+    resource_governor = governor.Governor(2)
+    resource_governor.throttle_workers = 1
+    with resource_governor.lock:
+        resource_governor.jobs = {"first.mkv": [], "second.mkv": []}
+        resource_governor.throttle_reason = "quiet_hours"
+        resource_governor.apply()
+    time.sleep(0.2)
+    with resource_governor.lock:
+        resource_governor.throttle_reason = None
+        resource_governor.apply()
+    assert resource_governor.get_paused_seconds("first.mkv") == 0.0
+    paused_seconds = resource_governor.get_paused_seconds("second.mkv")
+    assert 0.2 <= paused_seconds < 1.0
+    time.sleep(0.1)
+    assert resource_governor.get_paused_seconds("second.mkv") == paused_seconds
+    resource_governor.release("second.mkv")
+    assert resource_governor.get_paused_seconds("second.mkv") == 0.0
@@ -0,0 +1,72 @@
+"""Tests of the lease-based claiming of queued video files."""
+
+import multiprocessing
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from h265_transcoder import lease
+from tests.conftest import add_queue
+
+QUEUED_COUNT = 120
+
+
+def add_files(sqlite_db: str) -> None:
+    """Queue video files, with others which can not be claimed."""
+    add_queue(sqlite_db, *({"path": f"/mnt/{index % 3}", "filename": f"{index}.mkv", "transcode": "Y",
+                            "status": "queued"} for index in range(QUEUED_COUNT)))
+    add_queue(sqlite_db, {"path": "/mnt/0", "filename": "done.mkv", "transcode": "Y", "status": "done"},
+              {"path": "/mnt/0", "filename": "skipped.mp4", "transcode": "N", "status": "queued"})
+
+
+def claim_all(sqlite_db: str, worker_id: str, start: threading.Barrier | None = None) -> list:
+    """Claim batches of video files as a worker until none are left."""
+    lease.WORKER_ID = worker_id
+    if start is not None:
+        start.wait()
+    claimed_files = []
+    while batch := lease.claim_batch(sqlite_db, "", "rowid", 3):
+        claimed_files.extend(f"{path}/{filename}" for path, filename, _transcode in batch)
+    return claimed_files
+
+
+def get_workers(sqlite_db: str) -> dict:
+    """Get the worker of each active video file."""
+    with sqlite3.connect(sqlite_db) as connection:
+        workers = dict(connection.execute("SELECT path || '/' || filename, worker_id FROM queue "
+                                          "WHERE status = 'active' ;"))
+    connection.close()
+    return workers
+
+
+def test_threads_never_claim_the_same_file(sqlite_db, monkeypatch):
+    monkeypatch.setattr(lease, "WORKER_ID", "worker")
+    add_files(sqlite_db)
+    start = threading.Barrier(8)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        claim_jobs = [executor.submit(claim_all, sqlite_db, "worker", start) for _index in range(8)]
+        claimed_files = [video_file for claim_job in claim_jobs for video_file in claim_job.result()]
+    assert len(claimed_files) == QUEUED_COUNT
+    assert set(claimed_files) == set(get_workers(sqlite_db))
+
+
+def test_processes_never_claim_the_same_file(sqlite_db):
+    add_files(sqlite_db)
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context("spawn")) as executor:
+        claim_jobs = {f"host-{index}": executor.submit(claim_all, sqlite_db, f"host-{index}")
+                      for index in range(4)}
+        claimed = {worker_id: claim_job.result() for worker_id, claim_job in claim_jobs.items()}
+    claimed_files = [video_file for video_files in claimed.values() for video_file in video_files]
+    assert len(claimed_files) == len(set(claimed_files)) == QUEUED_COUNT
+    workers = get_workers(sqlite_db)
+    for worker_id, video_files in claimed.items():
+        assert all(workers[video_file] == worker_id for video_file in video_files)
+
+
+def test_batch_filter(sqlite_db, monkeypatch):
+    monkeypatch.setattr(lease, "WORKER_ID", "worker")
+    add_files(sqlite_db)
+    claimed_files = lease.claim_batch(sqlite_db, "AND path = '/mnt/1'", "rowid", QUEUED_COUNT)
+    assert len(claimed_files) == QUEUED_COUNT // 3
+    assert {path for path, _filename, _transcode in claimed_files} == {"/mnt/1"}
+    assert not lease.claim_batch(sqlite_db, "AND path = '/mnt/1'", "rowid", QUEUED_COUNT)
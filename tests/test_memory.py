@@ -0,0 +1,95 @@
+"""Tests of the memory admission control."""
+
+import sqlite3
+
+import pytest
+
+from h265_transcoder import config, memory
+from tests.conftest import add_queue
+
+HD_PIXELS = 1920 * 1080
+UHD_PIXELS = 3840 * 2160
+SD_PIXELS = 1280 * 720
+
+
+@pytest.fixture
+def memory_budget(sqlite_db):
+    return memory.MemoryBudget(sqlite_db, 2 * 1073741824)
+
+
+def get_fitting(sqlite_db: str, batch_filter: str) -> set:
+    """Get the queued video files which the batch filter keeps."""
+    with sqlite3.connect(sqlite_db) as connection:
+        fitting = {filename for (filename,) in connection.execute(
+            f"SELECT filename FROM queue WHERE status = 'queued' {batch_filter} ;")}
+    connection.close()
+    return fitting
+
+
+def test_estimate_remux(memory_budget):
+    assert memory_budget.estimate("R", UHD_PIXELS, {UHD_PIXELS: 1}) == config.memory_remux_bytes
+
+
+def test_estimate_model(memory_budget):
+    hd_bytes = int(memory.get_model_bytes(HD_PIXELS) * config.memory_margin)
+    assert memory_budget.estimate("Y", HD_PIXELS, {}) == hd_bytes
+    # Unknown resolutions are the default resolution
+    assert memory_budget.estimate("Y", None, {}) == int(
+        memory.get_model_bytes(config.memory_default_pixels) * config.memory_margin)
+    assert memory_budget.estimate("Y", UHD_PIXELS, {}) > hd_bytes
+
+
+def test_estimate_history(memory_budget):
+    history = {HD_PIXELS: 2 * memory.get_model_bytes(HD_PIXELS)}
+    assert memory_budget.estimate("Y", HD_PIXELS, history) == int(history[HD_PIXELS] * config.memory_margin)
+    # The other resolutions are scaled from the nearest measured one
+    assert memory_budget.estimate("Y", UHD_PIXELS, history) == pytest.approx(
+        2 * memory.get_model_bytes(UHD_PIXELS) * config.memory_margin, abs=1)
+    history[SD_PIXELS] = memory.get_model_bytes(SD_PIXELS) / 2
+    assert memory_budget.estimate("Y", SD_PIXELS + 1, history) == pytest.approx(
+        memory.get_model_bytes(SD_PIXELS + 1) / 2 * config.memory_margin, abs=1)
+
+
+def test_get_history(sqlite_db, memory_budget):
+    add_queue(sqlite_db, {"path": "/mnt", "filename": "hd.mkv", "transcode": "Y", "status": "done",
+                          "width": 1920, "height": 1080},
+              {"path": "/mnt", "filename": "unknown.mkv", "transcode": "Y", "status": "done"})
+    with sqlite3.connect(sqlite_db) as connection:
+        connection.executemany("INSERT INTO job_stats (path, filename, started, transcode, status, peak_rss) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               [("/mnt", "hd.mkv", 1, "Y", "done", 500_000_000),
+                                ("/mnt", "hd.mkv", 2, "Y", "done", 700_000_000),
+                                ("/mnt", "hd.mkv", 3, "Y", "failed", 900_000_000),
+                                ("/mnt", "unknown.mkv", 1, "Y", "done", 800_000_000)])
+    connection.close()
+    assert memory_budget.get_history() == {HD_PIXELS: 700_000_000}
+
+
+def test_get_filter(sqlite_db, memory_budget):
+    add_queue(sqlite_db, {"path": "/mnt", "filename": "sd.mkv", "transcode": "Y", "status": "queued",
+                          "width": 1280, "height": 720},
+              {"path": "/mnt", "filename": "hd.mkv", "transcode": "Y", "status": "queued",
+               "width": 1920, "height": 1080},
+              {"path": "/mnt", "filename": "unknown.mkv", "transcode": "Y", "status": "queued"},
+              {"path": "/mnt", "filename": "uhd.mkv", "transcode": "Y", "status": "queued",
+               "width": 3840, "height": 2160},
+              {"path": "/mnt", "filename": "remux.mp4", "transcode": "R", "status": "queued",
+               "width": 3840, "height": 2160})
+    assert memory_budget.get_filter() == ""
+    memory_budget.reserve("/mnt", "running.mkv", "Y", 1_500_000_000)
+    assert get_fitting(sqlite_db, memory_budget.get_filter()) == {"sd.mkv", "remux.mp4"}
+    memory_budget.reserve("/mnt", "other.mkv", "Y", 600_000_000)
+    assert get_fitting(sqlite_db, memory_budget.get_filter()) == set()
+    memory_budget.release("/mnt", "other.mkv")
+    memory_budget.release("/mnt", "running.mkv")
+    memory_budget.reserve("/mnt", "running.mkv", "Y", 1_000_000_000)
+    assert get_fitting(sqlite_db, memory_budget.get_filter()) == {"sd.mkv", "hd.mkv", "unknown.mkv", "remux.mp4"}
+
+
+def test_acquire_alone_over_budget(sqlite_db):
+    add_queue(sqlite_db, {"path": "/mnt", "filename": "uhd.mkv", "transcode": "Y", "status": "queued",
+                          "width": 3840, "height": 2160})
+    memory_budget = memory.MemoryBudget(sqlite_db, 1073741824)
+    job_bytes = memory_budget.acquire("/mnt", "uhd.mkv", "Y")
+    assert job_bytes > memory_budget.budget_bytes
+    assert memory_budget.get_filter() == "AND 0"
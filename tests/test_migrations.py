@@ -0,0 +1,78 @@
+"""Tests of the SQLite schema migrations."""
+
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from h265_transcoder import config, tasks
+from h265_transcoder.interfaces import DatabaseInterface
+
+LATEST_VERSION = max(int(migration_file.name.split("_")[0])
+                     for migration_file in Path(config.schema_dir).glob("[0-9][0-9][0-9][0-9]_*.sql"))
+# The rows of a database created by the baseline schema, before 'user_version' was set
+BASELINE_ROWS = (
+    ("/mnt/show", "episode_01.mkv", "Y", "queued"),
+    ("/mnt/show", "episode_02.mp4", "N", "skipped"),
+    ("/mnt/movie", "movie.mp4", "Y", "done"),
+    ("/mnt/movie", "broken.mp4", "Y", "failed")
+)
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """SQLite database with the baseline 'queue' table, and some video files."""
+    sqlite_db = str(tmp_path / "transcode.db")
+    with sqlite3.connect(sqlite_db) as connection:
+        connection.executescript((Path(config.schema_dir) / "0001_queue.sql").read_text(encoding="utf-8"))
+        connection.executemany("INSERT INTO queue (path, filename, transcode, status) VALUES (?, ?, ?, ?)",
+                               BASELINE_ROWS)
+    connection.close()
+    yield sqlite_db
+    DatabaseInterface(sqlite_db).close()
+
+
+def get_columns(sqlite_db: str) -> list:
+    """Get the column names of the 'queue' table."""
+    with sqlite3.connect(sqlite_db) as connection:
+        columns = [column[1] for column in connection.execute("PRAGMA table_info(queue) ;")]
+    connection.close()
+    return columns
+
+
+def test_baseline_upgrade(baseline_db):
+    assert tasks.setup_database(baseline_db) == 0
+    with sqlite3.connect(baseline_db) as connection:
+        assert connection.execute("PRAGMA user_version ;").fetchone()[0] == LATEST_VERSION
+        rows = connection.execute("SELECT path, filename, transcode, status FROM queue ORDER BY id ;").fetchall()
+        status_count = dict(connection.execute("SELECT status, count FROM status_count WHERE count > 0 ;"))
+    connection.close()
+    assert rows == list(BASELINE_ROWS)
+    assert status_count == {"queued": 1, "skipped": 1, "done": 1, "failed": 1}
+
+
+def test_upgraded_schema_matches_new_schema(baseline_db, sqlite_db):
+    tasks.setup_database(baseline_db)
+    assert get_columns(baseline_db) == get_columns(sqlite_db)
+
+
+def test_upgraded_schema_is_usable(baseline_db):
+    tasks.setup_database(baseline_db)
+    with sqlite3.connect(baseline_db) as connection:
+        # Filenames are only unique per path since the third migration
+        connection.execute("INSERT INTO queue (path, filename, transcode, status) VALUES (?, ?, ?, ?)",
+                           ("/mnt/other", "movie.mp4", "Y", "queued"))
+        connection.execute("UPDATE queue SET status = 'done' WHERE filename = 'episode_01.mkv' ;")
+        status_count = dict(connection.execute("SELECT status, count FROM status_count WHERE count > 0 ;"))
+    connection.close()
+    assert status_count == {"queued": 1, "skipped": 1, "done": 2, "failed": 1}
+
+
+def test_setup_is_idempotent(baseline_db):
+    tasks.setup_database(baseline_db)
+    columns = get_columns(baseline_db)
+    assert tasks.setup_database(baseline_db) == 0
+    assert get_columns(baseline_db) == columns
+    with sqlite3.connect(baseline_db) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM queue ;").fetchone()[0] == len(BASELINE_ROWS)
+    connection.close()
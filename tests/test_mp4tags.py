@@ -0,0 +1,119 @@
+"""Tests of the in-place MP4 tag writer."""
+
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from h265_transcoder import mp4tags, probe
+from tests.test_probe import build_mp4, mp4_box
+
+FTYP = mp4_box(b"ftyp", b"isom" + bytes(4))
+MDAT = mp4_box(b"mdat", b"media payload " * 64)
+
+
+def build_moov(udta: bytes = b"") -> bytes:
+    """Build the movie box of 'build_mp4', with a user data box."""
+    return mp4_box(b"moov", build_mp4()[len(FTYP) + 8:] + udta)
+
+
+def build_udta(*items: tuple) -> bytes:
+    """Build a user data box with an item list of the item types and their text."""
+    ilst = b"".join(mp4_box(item_type, mp4_box(b"data", struct.pack(">II", 1, 0) + text))
+                    for item_type, text in items)
+    return mp4_box(b"udta", mp4_box(b"meta", bytes(4) + mp4_box(b"hdlr", mp4tags.METADATA_HANDLER)
+                                    + mp4_box(b"ilst", ilst)))
+
+
+def read_tags(video_file) -> tuple:
+    """Read the title and comment of the movie box, and check the media data is where it was."""
+    video_data = video_file.read_bytes()
+    with video_file.open(mode="rb") as video:
+        top_boxes = mp4tags.list_boxes(video, 0, len(video_data))
+    assert sum(box_end - box_start for _box_type, box_start, box_end in top_boxes) == len(video_data)
+    moov = [video_data[box_start:box_end] for box_type, box_start, box_end in top_boxes if box_type == b"moov"]
+    assert len(moov) == 1
+    udta = [child for child_type, child in mp4tags.split_boxes(moov[0], 8) if child_type == b"udta"]
+    assert len(udta) == 1
+    return mp4tags.get_tags(udta[0])
+
+
+def test_moov_last_grows_past_the_end(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(FTYP + MDAT + build_moov())
+    assert mp4tags.write_tags(str(video_file), "Title")
+    assert read_tags(video_file) == ("Title", False)
+    assert video_file.read_bytes().startswith(FTYP + MDAT)
+    assert probe.probe_metadata(str(video_file))["CompressorID"] == "avc1"
+
+
+def test_comment_is_removed_in_place(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    udta = build_udta((mp4tags.TITLE_ITEM, b"Old title"), (mp4tags.COMMENT_ITEM, b"A long comment"))
+    video_file.write_bytes(FTYP + build_moov(udta) + MDAT)
+    file_size = video_file.stat().st_size
+    assert mp4tags.write_tags(str(video_file), "New")
+    assert read_tags(video_file) == ("New", False)
+    assert video_file.stat().st_size == file_size
+    assert video_file.read_bytes().endswith(MDAT)
+
+
+def test_unchanged_tags(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(FTYP + build_moov(build_udta((mp4tags.TITLE_ITEM, b"Title"))) + MDAT)
+    video_data = video_file.read_bytes()
+    assert not mp4tags.write_tags(str(video_file), "Title")
+    assert video_file.read_bytes() == video_data
+
+
+def test_moov_grows_into_free_box(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(FTYP + build_moov() + mp4tags.make_free(1024) + MDAT)
+    file_size = video_file.stat().st_size
+    assert mp4tags.write_tags(str(video_file), "Title")
+    assert read_tags(video_file) == ("Title", False)
+    assert video_file.stat().st_size == file_size
+    assert video_file.read_bytes().endswith(MDAT)
+
+
+def test_moov_is_relocated(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    moov = build_moov()
+    video_file.write_bytes(FTYP + moov + MDAT)
+    assert mp4tags.write_tags(str(video_file), "Title")
+    video_data = video_file.read_bytes()
+    assert video_data.startswith(FTYP + b"".join((moov[:4], b"free", moov[8:])) + MDAT)
+    assert read_tags(video_file) == ("Title", False)
+    assert probe.probe_metadata(str(video_file))["CompressorID"] == "avc1"
+    # The padding lets the next update happen in place
+    assert mp4tags.write_tags(str(video_file), "A longer title")
+    assert len(video_file.read_bytes()) == len(video_data)
+    assert read_tags(video_file) == ("A longer title", False)
+
+
+def test_not_mp4(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(mp4_box(b"abcd", bytes(16)))
+    with pytest.raises(probe.ProbeError):
+        mp4tags.write_tags(str(video_file), "Title")
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is not installed")
+@pytest.mark.parametrize("movflags", ["+faststart", "-faststart"])
+def test_ffmpeg_reads_the_tags(tmp_path, movflags):
+    video_file = tmp_path / "video.mp4"
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=s=160x120:d=2",
+                    "-f", "lavfi", "-i", "sine=d=2", "-codec:v", "libx264", "-codec:a", "aac",
+                    "-metadata", "title=Old title", "-metadata", "comment=A comment",
+                    "-movflags", movflags, str(video_file)], check=True)
+    # Longer than the old tags, so the movie box is moved with faststart, and grows without it
+    title = "Title é " * 40
+    assert mp4tags.write_tags(str(video_file), title)
+    metadata = subprocess.run(["ffmpeg", "-v", "error", "-i", str(video_file), "-f", "ffmetadata", "-"],
+                              check=True, capture_output=True, text=True).stdout
+    assert f"title={title}" in metadata.splitlines()
+    assert "comment" not in metadata
+    decode = subprocess.run(["ffmpeg", "-v", "error", "-i", str(video_file), "-f", "null", "-"],
+                            check=True, capture_output=True, text=True)
+    assert decode.stderr == ""
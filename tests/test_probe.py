@@ -0,0 +1,90 @@
+"""Tests of the in-process MP4 and Matroska probe."""
+
+import struct
+
+from h265_transcoder import probe
+
+
+def mp4_box(box_type: bytes, payload: bytes) -> bytes:
+    """Build an MP4 box."""
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def ebml_element(element_id: int, data: bytes) -> bytes:
+    """Build an EBML element with an 8-byte size."""
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+    return id_bytes + (0x01 << 56 | len(data)).to_bytes(8, "big") + data
+
+
+def build_mp4(fourcc: bytes = b"avc1", width: int = 1920, height: int = 1080) -> bytes:
+    """Build an MP4 header with a 10 second movie, and one video track."""
+    mvhd = mp4_box(b"mvhd", bytes(4) + struct.pack(">IIII", 0, 0, 1000, 10000) + bytes(80))
+    hdlr = mp4_box(b"hdlr", bytes(8) + b"vide" + bytes(12))
+    sample_entry = struct.pack(">I4s", 86, fourcc) + bytes(24) + struct.pack(">HH", width, height) + bytes(50)
+    stsd = mp4_box(b"stsd", bytes(4) + struct.pack(">I", 1) + sample_entry)
+    minf = mp4_box(b"minf", mp4_box(b"stbl", stsd))
+    trak = mp4_box(b"trak", mp4_box(b"mdia", hdlr + minf))
+    return mp4_box(b"ftyp", b"isom" + bytes(4)) + mp4_box(b"moov", mvhd + trak)
+
+
+def build_matroska(codec_id: bytes = b"V_MPEG4/ISO/AVC") -> bytes:
+    """Build a Matroska header with one video track."""
+    header = ebml_element(probe.EBML_HEADER, ebml_element(probe.EBML_DOCTYPE, b"matroska"))
+    video = ebml_element(probe.MKV_VIDEO, ebml_element(probe.MKV_PIXEL_WIDTH, (1280).to_bytes(2, "big"))
+                         + ebml_element(probe.MKV_PIXEL_HEIGHT, (720).to_bytes(2, "big")))
+    entry = ebml_element(probe.MKV_TRACK_ENTRY, ebml_element(probe.MKV_TRACK_TYPE, b"\x01")
+                         + ebml_element(probe.MKV_CODEC_ID, codec_id) + video)
+    return header + ebml_element(probe.MKV_SEGMENT, ebml_element(probe.MKV_TRACKS, entry))
+
+
+def test_mp4(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(build_mp4(b"hvc1", 3840, 2160))
+    assert probe.probe_metadata(str(video_file)) == {
+        "Duration": 10.0, "CompressorID": "hvc1", "ImageWidth": 3840, "ImageHeight": 2160}
+
+
+def test_matroska(tmp_path):
+    video_file = tmp_path / "video.mkv"
+    video_file.write_bytes(build_matroska())
+    assert probe.probe_metadata(str(video_file)) == {
+        "DocType": "matroska", "CodecID": "V_MPEG4/ISO/AVC", "ImageWidth": 1280, "ImageHeight": 720}
+
+
+def test_truncated_mp4(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    mp4_data = build_mp4()
+    for length in range(len(mp4_data)):
+        video_file.write_bytes(mp4_data[:length])
+        probe.probe_metadata(str(video_file))
+
+
+def test_truncated_mvhd(tmp_path):
+    mvhd = mp4_box(b"mvhd", b"")
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(mp4_box(b"ftyp", b"isom") + mp4_box(b"moov", mvhd))
+    assert probe.probe_metadata(str(video_file)) is None
+
+
+def test_truncated_matroska(tmp_path):
+    video_file = tmp_path / "video.mkv"
+    matroska_data = build_matroska()
+    for length in range(len(matroska_data)):
+        video_file.write_bytes(matroska_data[:length])
+        probe.probe_metadata(str(video_file))
+
+
+def test_non_ascii_codec_id(tmp_path):
+    video_file = tmp_path / "video.mkv"
+    video_file.write_bytes(build_matroska(b"V_\xff\xfe"))
+    assert probe.probe_metadata(str(video_file)) is None
+
+
+def test_garbage(tmp_path):
+    video_file = tmp_path / "video.mkv"
+    for seed in range(64):
+        video_file.write_bytes(probe.EBML_HEADER.to_bytes(4, "big") + bytes((seed * 131 + index * 7) % 256
+                                                                             for index in range(512)))
+        probe.probe_metadata(str(video_file))
+        video_file.write_bytes(bytes((seed * 37 + index * 13) % 256 for index in range(512)))
+        probe.probe_metadata(str(video_file))
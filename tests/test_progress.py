@@ -0,0 +1,42 @@
+"""Tests of the job throughput summary."""
+
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from ffmpeg import Progress
+
+from h265_transcoder import progress
+
+
+@pytest.fixture
+def sampler(tmp_path, monkeypatch):
+    peaks = {}
+    monkeypatch.setattr(progress, "get_peak_rss", peaks.get)
+    monkeypatch.setattr(progress, "get_cpu_seconds", lambda _pid: None)
+    sampler = progress.ProgressSampler(str(tmp_path / "transcode.db"), str(tmp_path), "video.mkv", "Y")
+    sampler.peaks = peaks
+    return sampler
+
+
+def run_segment(sampler, pid: int, peak_rss: int):
+    """Send a progress event of a running segment encoder with its peak memory."""
+    ffmpeg = SimpleNamespace(_process=SimpleNamespace(pid=pid, returncode=None))
+    sampler.peaks[pid] = peak_rss
+    sampler.sample(ffmpeg, Progress(frame=10, fps=25.0, size=0, time=timedelta(seconds=1), bitrate=0.0, speed=1.0))
+    return ffmpeg._process
+
+
+def test_sequential_segments_peak(sampler):
+    for pid in range(100, 104):
+        run_segment(sampler, pid, 500).returncode = 0
+    assert sampler.summary()["peak_rss"] == 500
+    assert sampler.summary()["frames"] == 40
+
+
+def test_concurrent_segments_peak(sampler):
+    first = run_segment(sampler, 100, 500)
+    run_segment(sampler, 101, 300)
+    first.returncode = 0
+    run_segment(sampler, 102, 400)
+    assert sampler.summary()["peak_rss"] == 800
@@ -0,0 +1,57 @@
+"""Tests of the local scratch staging."""
+
+import threading
+
+import pytest
+
+from h265_transcoder import scratch
+
+
+@pytest.fixture
+def scratch_space(tmp_path):
+    with scratch.ScratchSpace(str(tmp_path / "scratch"), 1 << 30) as scratch_space:
+        yield scratch_space
+
+
+@pytest.fixture
+def video_files(tmp_path):
+    video_files = []
+    for index in range(2):
+        video_file = tmp_path / f"video{index}.mkv"
+        video_file.write_bytes(bytes(1000 * (index + 1)))
+        video_files.append(str(video_file))
+    return video_files
+
+
+def test_prefetch_used_by_stage(scratch_space, video_files):
+    scratch_space.prefetch(video_files[0], set())
+    assert scratch_space.prefetching == video_files[0]
+    local_input, _local_output = scratch_space.stage(video_files[0], video_files[0] + ".mp4")
+    assert scratch_space.prefetching is None
+    with open(local_input, "rb") as staged_file:
+        assert len(staged_file.read()) == 1000
+
+
+def test_prefetch_discarded_when_not_next(scratch_space, video_files):
+    scratch_space.prefetch(video_files[0], set())
+    scratch_space.prefetch(video_files[1], set())
+    assert scratch_space.prefetching == video_files[1]
+    assert scratch_space.reserved == 4000
+    scratch_space.prefetch(None, set())
+    assert scratch_space.prefetching is None
+    assert scratch_space.reserved == 0
+    assert not scratch_space.staged
+
+
+def test_prefetch_kept_while_claimed(scratch_space, video_files):
+    scratch_space.prefetch(video_files[0], set())
+    scratch_space.prefetch(video_files[1], {video_files[0]})
+    assert scratch_space.prefetching == video_files[0]
+    assert scratch_space.reserved == 2000
+
+
+def test_copy_cancelled(tmp_path, video_files):
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(InterruptedError):
+        scratch.copy_file(video_files[0], str(tmp_path / "copy.mkv"), False, cancel_event)
@@ -0,0 +1,74 @@
+"""Tests of the keyframe-segmented transcoding."""
+
+import os
+import re
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from h265_transcoder import config, segments, tasks
+from tests.conftest import add_queue
+
+
+@pytest.fixture
+def segment_dir(tmp_path, monkeypatch):
+    segment_dir = tmp_path / "segments"
+    monkeypatch.setattr(config, "segment_dir", str(segment_dir))
+    return segment_dir
+
+
+def test_prune_segments(segment_dir):
+    stale_dir = segment_dir / "stale"
+    recent_dir = segment_dir / "recent"
+    for work_dir in (stale_dir, recent_dir):
+        work_dir.mkdir(parents=True)
+        (work_dir / "source_000.mkv").write_bytes(bytes(16))
+    stale_mtime = time.time() - config.segment_max_age - 60
+    os.utime(stale_dir, (stale_mtime, stale_mtime))
+    assert segments.prune_segments() == 1
+    assert not stale_dir.exists()
+    assert recent_dir.exists()
+
+
+@pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="ffmpeg is not installed")
+def test_every_audio_track_is_kept(tmp_path, segment_dir):
+    video_file = tmp_path / "video.mkv"
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=s=160x120:d=4",
+                    "-f", "lavfi", "-i", "sine=d=4", "-f", "lavfi", "-i", "sine=f=880:d=4",
+                    "-map", "0", "-map", "1", "-map", "2", "-codec:v", "libx264", "-g", "25",
+                    "-codec:a", "aac", "-shortest", str(video_file)], check=True)
+    output_file = tmp_path / "video.mp4"
+    segmented = segments.SegmentedTranscode(str(video_file), str(output_file), 2, preset="ultrafast")
+    segmented.transcode({"vtag": "hvc1", "f": "mp4"}, ["0:v:0", "0:a?"])
+    assert not segmented.work_dir.exists()
+    output_info = subprocess.run(["ffmpeg", "-hide_banner", "-i", str(output_file)],
+                                 capture_output=True, text=True, check=False).stderr
+    assert len(re.findall(r"Stream #0:\d.*: Audio", output_info)) == 2
+    assert len(re.findall(r"Stream #0:\d.*: Video: hevc", output_info)) == 1
+
+
+def get_streams(video_file) -> list:
+    """Get the codec type of each stream of a video file."""
+    output_info = subprocess.run(["ffmpeg", "-hide_banner", "-i", str(video_file)],
+                                 capture_output=True, text=True, check=False).stderr
+    return re.findall(r"Stream #0:\d.*?: (Video|Audio|Subtitle)", output_info)
+
+
+@pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")), reason="ffmpeg is not installed")
+@pytest.mark.parametrize("segment_count", ["0", "2"])
+def test_same_streams_with_and_without_segments(tmp_path, segment_dir, sqlite_db, monkeypatch, segment_count):
+    subtitle_file = tmp_path / "video.srt"
+    subtitle_file.write_text("1\n00:00:00,000 --> 00:00:02,000\nHello\n", encoding="utf-8")
+    video_file = tmp_path / "video.mkv"
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc2=s=160x120:d=4",
+                    "-f", "lavfi", "-i", "sine=d=4", "-f", "lavfi", "-i", "sine=f=880:d=4", "-i", str(subtitle_file),
+                    "-map", "0", "-map", "1", "-map", "2", "-map", "3", "-codec:v", "libx264", "-g", "25",
+                    "-codec:a", "aac", "-codec:s", "srt", "-t", "4", str(video_file)], check=True)
+    monkeypatch.setattr(segments, "SEGMENTS", segment_count)
+    monkeypatch.setattr(segments, "SEGMENT_MIN_DURATION", "0")
+    add_queue(sqlite_db, {"path": str(tmp_path), "filename": "video.mkv", "transcode": "Y", "status": "active"})
+    transcode = tasks.Transcode(sqlite_db, str(tmp_path), "video.mkv", preset="ultrafast")
+    assert transcode.transcode() == "done"
+    assert get_streams(tmp_path / "video.mp4") == ["Video", "Audio", "Audio"]
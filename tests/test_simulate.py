@@ -0,0 +1,100 @@
+"""Tests of the simulation backend."""
+
+import os
+
+import pytest
+from ffmpeg import FFmpegError
+
+from h265_transcoder import estimate, failures, mp4tags, probe, scratch, segments, simulate, tasks
+
+
+@pytest.fixture
+def installed(monkeypatch):
+    """Install the simulated backend, and restore the real one afterwards."""
+    for module, name in ((tasks, "FFmpeg"), (tasks, "ExifToolInterface"), (segments, "FFmpeg"),
+                         (estimate, "FFmpeg"), (failures, "FFmpeg"), (probe, "probe_metadata"),
+                         (mp4tags, "write_tags"), (scratch, "copy_file")):
+        monkeypatch.setattr(module, name, getattr(module, name))
+    simulate.install()
+
+
+def test_install_replaces_probe_tags_and_copies(installed):
+    assert probe.probe_metadata is simulate.probe_metadata
+    assert mp4tags.write_tags is simulate.write_tags
+    assert scratch.copy_file is simulate.copy_file
+
+
+def test_probe_metadata(tmp_path):
+    video_file = tmp_path / "episode.mp4"
+    simulate.write_sparse_file(video_file, 10_000_000)
+    metadata = simulate.probe_metadata(str(video_file))
+    assert metadata == simulate.get_metadata(str(video_file))
+    assert metadata["CompressorID"] in ("hvc1", "hev1", "avc1")
+    assert simulate.probe_metadata(str(tmp_path / "missing.mp4")) is None
+
+
+def test_write_tags(tmp_path):
+    video_file = tmp_path / "episode.mp4"
+    simulate.write_sparse_file(video_file, 10_000_000)
+    assert simulate.write_tags(str(video_file), "episode")
+    with pytest.raises(OSError):
+        simulate.write_tags(str(tmp_path / "missing.mp4"), "missing")
+
+
+def test_copy_file_is_sparse(tmp_path):
+    output_file = tmp_path / "episode.mp4"
+    simulate.write_sparse_file(output_file, 4 * 1024 ** 3, simulate.OUTPUT_MARKER)
+    os.utime(output_file, ns=(1_000_000_000, 2_000_000_000))
+    copied_file = tmp_path / "staged" / "episode.mp4"
+    simulate.copy_file(str(output_file), str(copied_file), True)
+    copied_stat = copied_file.stat()
+    assert copied_stat.st_size == 4 * 1024 ** 3
+    assert copied_stat.st_mtime_ns == 2_000_000_000
+    assert copied_stat.st_blocks * 512 < 1024 ** 2
+    assert simulate.get_metadata(str(copied_file))["CompressorID"] == "hvc1"
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    """Fail every simulated x265 encode, without any latency."""
+    monkeypatch.setattr(simulate, "SIMULATE_FAILURE_RATE", "1")
+    monkeypatch.setattr(simulate, "SIMULATE_LATENCY", "0")
+    monkeypatch.setattr(failures, "FFmpeg", simulate.FakeFFmpeg)
+
+
+def encode(video_file, output_file, input_options: dict | None = None) -> None:
+    """Run a simulated x265 encode."""
+    (simulate.FakeFFmpeg().option("y").input(str(video_file), input_options or {})
+     .output(str(output_file), {"codec:v": "libx265", "codec:a": "copy"}).execute())
+
+
+def test_only_encodes_fail(tmp_path, failing):
+    video_file = tmp_path / "episode.mkv"
+    simulate.write_sparse_file(video_file, 10_000_000)
+    assert failures.preflight(str(video_file), set()) == (set(), None)
+    with pytest.raises(FFmpegError):
+        encode(video_file, tmp_path / "episode.mp4")
+
+
+def test_corrupt_failures_are_fixed_by_the_fallback(tmp_path, failing):
+    video_files = [tmp_path / f"episode_{index}.mkv" for index in range(20)]
+    corrupt_count = 0
+    for video_file in video_files:
+        simulate.write_sparse_file(video_file, 10_000_000)
+        stderr_lines = []
+        ffmpeg = (simulate.FakeFFmpeg().input(str(video_file))
+                  .output(str(tmp_path / "episode.mp4"), {"codec:v": "libx265"}))
+        ffmpeg.on("stderr", stderr_lines.append)
+        with pytest.raises(FFmpegError) as encode_err:
+            ffmpeg.execute()
+        failure = failures.classify_failure(encode_err.value.message, stderr_lines)
+        assert failure in ("corrupt", "unknown")
+        input_options = {}
+        failures.apply_fallbacks({"tolerant"}, input_options, {})
+        if failure == "corrupt":
+            corrupt_count += 1
+            encode(video_file, tmp_path / "episode.mp4", input_options)
+        else:
+            with pytest.raises(FFmpegError):
+                encode(video_file, tmp_path / "episode.mp4", input_options)
+    assert 0 < corrupt_count < len(video_files)